@@ -0,0 +1,362 @@
+"""asyncio client for the sensor web on an aiopg connection pool
+
+needs python 3 and aiopg, so it is not imported by the package:
+
+    from nclsensorweb.aio import AsyncSensorWeb
+
+    sensorweb = await AsyncSensorWeb.create(host, db_name, user, password)
+    groups = [await sensorweb.sensors.get('type', sensor_type)
+              for sensor_type in ('air', 'traffic')]
+    tables = await asyncio.gather(*[group.data.get(start, end)
+                                   for group in groups])
+    await sensorweb.close()
+
+queries share the SQL of SensorWeb and run concurrently, one pooled
+connection each. sensors come back as the usual Sensor objects, their own
+data functions query the database and need a blocking SensorWeb.
+
+under python 3 the coroutines here and the SensorDataGroup and
+LiveSensorDataGroup they return work, with stats, geometry and tools.
+SensorWeb itself, its migrations, maintenance and exporters are still
+python 2 only. the import needs a pygeocoder that loads, its last release
+does not on python 3.10 and later"""
+import time
+
+import aiopg
+import psycopg2
+
+import nclsensorweb.classes as cl
+import nclsensorweb.db_tools as db_tools
+import nclsensorweb.errors as error
+import nclsensorweb.interface as interface
+
+class AsyncDatabaseConnection:
+    """aiopg pool with the reading catalogue and migration list caches of
+    DatabaseConnection, refreshed before each operation. the catalogue
+    has no connection of its own so ReadingChecker never queries through
+    it"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.reading_catalogue = db_tools.ReadingCatalogue(None)
+        self.applied_migrations = None
+
+    @classmethod
+    async def create(cls, host, db_name, user, password,
+                     min_connections=1, max_connections=10):
+        pool = await aiopg.create_pool(host=host, dbname=db_name, user=user,
+                                       password=password,
+                                       minsize=min_connections,
+                                       maxsize=max_connections)
+        return cls(pool)
+
+    async def query(self, query_string):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(query_string)
+                    return await cur.fetchall()
+                except psycopg2.Error:
+                    raise NameError('DB ERROR')
+
+    async def insert(self, query_string):
+        """runs a write, aiopg connections autocommit each statement"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query_string)
+
+    async def refresh(self,):
+        """reloads the cached migration list and reading catalogue when
+        stale and returns the applied migrations. they are passed to the
+        SQL builders, which would otherwise look them up with a blocking
+        query"""
+        cached = self.applied_migrations
+        if not cached or time.time() - cached[0] > db_tools.MIGRATIONS_TTL:
+            try:
+                applied = set(row[0] for row in
+                              await self.query(db_tools.MIGRATIONS_QUERY))
+            except NameError:
+                applied = set()
+            self.applied_migrations = (time.time(), applied)
+        if self.reading_catalogue.expired():
+            self.reading_catalogue.load(
+                await self.query(db_tools.READINGS_QUERY))
+        return self.applied_migrations[1]
+
+    async def close(self,):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+async def insert_readings(db_conn, rows, batch_size=cl.BATCH_SIZE):
+    """cl.insert_readings on an AsyncDatabaseConnection"""
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += await _insert_reading_batch(db_conn, batch)
+            batch = []
+    if batch:
+        count += await _insert_reading_batch(db_conn, batch)
+    return count
+
+async def _insert_reading_batch(db_conn, batch):
+    applied = await db_conn.refresh()
+    await db_conn.insert(db_tools.sensor_data_insert(
+        db_conn, [cl.sensor_data_hstore(*row) for row in batch], applied))
+    query_string = db_tools.new_reading_insert(
+        db_conn.reading_catalogue, set((row[2], row[3]) for row in batch))
+    if query_string:
+        await db_conn.insert(query_string)
+    return len(batch)
+
+class AsyncSensorFunctions:
+    def __init__(self, sensorweb):
+        self.sensorweb = sensorweb
+
+    async def get(self, key=False, value=False, last_record=False,
+                  active=True, not_flagged=True, logged_in=False):
+        """retrives sensors matching the key value"""
+        db_conn = self.sensorweb.database_connection
+        applied = await db_conn.refresh()
+        query_string = interface.sensor_query(
+            db_tools.sensor_data_columns(db_conn, applied), key, value, last_record,
+            active, not_flagged, logged_in)
+        sensors = interface.rows_to_sensors(db_conn,
+                                            await db_conn.query(query_string))
+        if sensors:
+            return AsyncSensorGroup(self.sensorweb, sensors)
+
+class AsyncGeospatialFunctions:
+    def __init__(self, sensorweb):
+        self.sensorweb = sensorweb
+
+    async def create_geospatial(self, geospatial_id, geom, theme, source,
+                                timestamp, reading, units, value, extra=None):
+        """create geospatial class"""
+        db_conn = self.sensorweb.database_connection
+        hstore = interface.geospatial_hstore(geospatial_id, geom, theme,
+                                             source, timestamp, reading,
+                                             units, value, extra)
+        applied = await db_conn.refresh()
+        await db_conn.insert(db_tools.sensor_data_insert(db_conn, [hstore],
+                                                         applied))
+
+    async def get_all(self, starttime, endtime, not_flagged=True):
+        """Retrives all geospatial entries between 2 times"""
+        return await self.__get(starttime, endtime, not_flagged)
+
+    async def get(self, starttime, endtime, key, value, not_flagged=True):
+        """Retrives all geospatial entries between 2 times"""
+        return await self.__get(starttime, endtime, not_flagged, key, value)
+
+    async def __get(self, starttime, endtime, not_flagged, key=None,
+                    value=None):
+        db_conn = self.sensorweb.database_connection
+        applied = await db_conn.refresh()
+        query_string = interface.geospatial_query(
+            db_tools.sensor_data_columns(db_conn, applied), starttime, endtime,
+            not_flagged, key, value)
+        return interface.rows_to_geospatial(db_conn,
+                                            await db_conn.query(query_string))
+
+class AsyncAverageSensorDataFunctions:
+    def __init__(self, sensordatafunctions):
+        self.sensordatafunctions = sensordatafunctions
+
+    async def aggregates(self, starttime, endtime, timedelta,
+                         remove_outlier=True):
+        """AverageSensorDataFunctions.aggregates, always read from the raw
+        readings"""
+        sensors_id = [str(sensor.sensor_id) for sensor in
+                      self.sensordatafunctions.sensorgroup.sensors]
+        db_conn = self.sensordatafunctions.sensorgroup.sensorweb.database_connection
+        applied = await db_conn.refresh()
+        query_string = cl.raw_aggregates_query(
+            db_tools.sensor_data_columns(db_conn, applied), sensors_id, starttime,
+            endtime, timedelta, remove_outlier)
+        buckets = {}
+        cl.add_raw_aggregate_rows(buckets, await db_conn.query(query_string))
+        return cl.aggregates_from_buckets(buckets)
+
+    async def get(self, starttime, endtime, timedelta, remove_outlier=True):
+        return cl.data_from_aggregates(await self.aggregates(
+            starttime, endtime, timedelta, remove_outlier))
+
+class AsyncSensorGroupDataFunctions:
+    def __init__(self, sensorgroup):
+        self.sensorgroup = sensorgroup
+        self.average = AsyncAverageSensorDataFunctions(self)
+
+    async def __collect(self, starttime, endtime=None, variable=None):
+        db_conn = self.sensorgroup.sensorweb.database_connection
+        sensor_id_lookup = {}
+        for sensor in self.sensorgroup.sensors:
+            sensor_id_lookup[sensor.sensor_id] = sensor
+        applied = await db_conn.refresh()
+        query_string = cl.sensor_data_query(
+            db_conn, list(sensor_id_lookup), starttime, endtime, variable,
+            columns=db_tools.sensor_data_columns(db_conn, applied))
+        collector = cl.SensorRowCollector(db_tools.ReadingChecker(db_conn))
+        rows = await db_conn.query(query_string)
+        collector.add_rows(rows)
+        return rows, collector.sensor_data_group(sensor_id_lookup)
+
+    async def __transform(self, sensor_data_group, proj):
+        """gives the group its geometries in proj, it has no blocking
+        connection to transform them later"""
+        if proj is not None:
+            sensor_data_group.transformed_geoms[proj] = \
+                    await self.sensorgroup.geoms_transformed(proj)
+        return sensor_data_group
+
+    async def latest(self, variable, cutoff=cl.DEFAULT_CUTOFF, proj=None):
+        """SensorGroupDataFunctions.latest, json and csv take the proj
+        given here"""
+        rows, sensor_data_group = await self.__collect(cutoff,
+                                                       variable=variable)
+        if not rows:
+            return None
+        return cl.LiveSensorDataGroup(
+            await self.__transform(sensor_data_group, proj))
+
+    async def get(self, starttime, endtime, variable=None, proj=None):
+        """SensorGroupDataFunctions.get, grid and levels take the proj
+        given here"""
+        rows, sensor_data_group = await self.__collect(starttime, endtime,
+                                                       variable)
+        return await self.__transform(sensor_data_group, proj)
+
+class AsyncLiveSubscription:
+    """LiveSubscription as an async iterator of updates, listening on a
+    connection held from the pool until close(). json and csv are in the
+    proj given to start"""
+    def __init__(self, sensorgroup, variable, cutoff=cl.DEFAULT_CUTOFF,
+                 proj=None):
+        self.state = cl.LiveState(sensorgroup, variable)
+        self.cutoff = cutoff
+        self.proj = proj
+        self.transformed_geoms = {}
+        self.__conn = None
+
+    async def start(self,):
+        db_conn = self.state.sensorgroup.sensorweb.database_connection
+        applied = await db_conn.refresh()
+        if db_tools.NOTIFY_MIGRATION not in applied:
+            raise error.SensorError('run migrations.add_insert_notify() first')
+        if self.proj is not None:
+            self.transformed_geoms[self.proj] = \
+                    await self.state.sensorgroup.geoms_transformed(self.proj)
+        self.__conn = await db_conn.pool.acquire()
+        async with self.__conn.cursor() as cur:
+            await cur.execute("listen %s" % (db_tools.NOTIFY_CHANNEL,))
+        self.state.load_rows(await db_conn.query(self.state.query(
+            self.cutoff, db_tools.sensor_data_columns(db_conn, applied))))
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        db_conn = self.state.sensorgroup.sensorweb.database_connection
+        while self.__conn is not None:
+            notify = await self.__conn.notifies.get()
+            if notify is None:
+                break
+            await db_conn.refresh()
+            update = self.state.apply(notify.payload)
+            if update:
+                return update
+        raise StopAsyncIteration
+
+    def live(self,):
+        return self.state.live(self.transformed_geoms)
+
+    def json(self,):
+        live = self.live()
+        if live:
+            return live.json(self.proj)
+
+    def csv(self,):
+        live = self.live()
+        if live:
+            return live.csv(self.proj)
+        return []
+
+    async def close(self,):
+        if self.__conn is None:
+            return
+        conn, self.__conn = self.__conn, None
+        conn.notifies.put_nowait(None)
+        async with conn.cursor() as cur:
+            await cur.execute("unlisten %s" % (db_tools.NOTIFY_CHANNEL,))
+        await self.state.sensorgroup.sensorweb.database_connection.pool.release(conn)
+
+class AsyncSensorGroup(cl.SensorGroup):
+    """SensorGroup whose data, add_many, subscribe and geoms_transformed
+    are coroutines"""
+    def __init__(self, sensorweb, _sensors):
+        self.sensorweb = sensorweb
+        self.sensors = _sensors
+        self.data = AsyncSensorGroupDataFunctions(self)
+
+    async def add_many(self, readings, batch_size=cl.BATCH_SIZE):
+        rows = (cl.reading_args(reading) for reading in readings)
+        return await insert_readings(self.sensorweb.database_connection,
+                                     rows, batch_size)
+
+    async def subscribe(self, variable, cutoff=cl.DEFAULT_CUTOFF, proj=None):
+        """started AsyncLiveSubscription of the group, iterate it with
+        async for. json and csv are in proj"""
+        return await AsyncLiveSubscription(self, variable, cutoff,
+                                           proj).start()
+
+    async def geoms_transformed(self, proj):
+        """reprojects every sensor geometry in the group, returns
+        {sensor_id: geojson}"""
+        if proj is None:
+            return {}
+        transformed, missing = cl.cached_sensor_geoms(self.sensors, proj)
+        if not missing:
+            return transformed
+        db_conn = self.sensorweb.database_connection
+        try:
+            rows = await db_conn.query(cl.transform_geoms_query(missing, proj))
+        except NameError:
+            # one bad geometry fails the batch, fall back to one query each
+            rows = []
+            queried = []
+            for sensor in missing:
+                try:
+                    rows.extend(await db_conn.query(
+                        cl.transform_geoms_query([sensor], proj)))
+                except NameError:
+                    # the database may just be unavailable, not cached
+                    continue
+                queried.append(sensor)
+            missing = queried
+        return cl.cache_transformed_geoms(transformed, missing, proj, rows)
+
+class AsyncSensorWeb:
+    """SensorWeb on asyncio, create it with AsyncSensorWeb.create()"""
+    def __init__(self, database_connection):
+        self.database_connection = database_connection
+        self.readings = database_connection.reading_catalogue
+        self.sensors = AsyncSensorFunctions(self)
+        self.geospatial = AsyncGeospatialFunctions(self)
+
+    @classmethod
+    async def create(cls, host, db_name, user, password,
+                     min_connections=1, max_connections=10):
+        database_connection = await AsyncDatabaseConnection.create(
+            host, db_name, user, password, min_connections, max_connections)
+        await database_connection.refresh()
+        return cls(database_connection)
+
+    async def add_many(self, readings, batch_size=cl.BATCH_SIZE):
+        """adds readings for any sensors, see SensorGroup.add_many"""
+        rows = (cl.reading_args(reading) for reading in readings)
+        return await insert_readings(self.database_connection, rows,
+                                     batch_size)
+
+    async def close(self,):
+        await self.database_connection.close()
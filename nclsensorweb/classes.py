@@ -2,12 +2,507 @@
 import simplejson
 import nclsensorweb.tools as sensor_tools
 import nclsensorweb.db_tools as db_tools
+import nclsensorweb.errors as error
+import nclsensorweb.stats as stats
+import nclsensorweb.geometry as geometry
+import nclsensorweb.exporters as exporters
 import datetime
+import logging
+import array
+import base64
+import collections
+import threading
+import time
+import select
+import numpy
+import psycopg2
+from multiprocessing.pool import ThreadPool
+
+LOGGER = logging.getLogger(__name__)
 
 DATETIME_STRFORMAT = '%Y-%m-%d %H:%M:%S'
 
 DEFAULT_CUTOFF = datetime.datetime.now() - datetime.timedelta(hours=24)
 
+BATCH_SIZE = 1000
+
+STREAM_CHUNK_SIZE = 1000
+
+STREAM_ITERSIZE = 2000
+
+SHARD_SIZE = 500
+
+RESULT_CACHE_TTL = 60
+
+RESULT_CACHE_BUCKET = 60
+
+RESULT_CACHE_BYTES = 256 * 1024 * 1024
+
+LISTEN_TIMEOUT = 5
+
+LISTEN_RETRY_DELAY = 5
+
+UPDATE_BUFFER = 10000
+
+GRID_METHODS = ('idw', 'kde')
+
+GRID_BLOCK_CELLS = 1 << 20
+
+NO_LEVEL = 255
+
+SENSOR_INDEX_TTL = 300
+
+SPATIAL_CELL_POINTS = 4
+
+OUTLIER_WHISKER = 1.5
+
+def sensor_data_query(db_conn, sensors_id, starttime, endtime=None, variable=None,
+                      time_clause=None, columns=None):
+    """builds the query for unflagged readings of the sensors after
+    starttime, in timestamp order. time_clause replaces the time range,
+    columns the db_tools.sensor_data_columns of db_conn"""
+    if columns is None:
+        columns = db_tools.sensor_data_columns(db_conn)
+    if time_clause:
+        clauses = [time_clause]
+    else:
+        clauses = ["%s > '%s'" % (columns['ts'], starttime,)]
+        if endtime:
+            clauses.append("%s < '%s'" % (columns['ts'], endtime,))
+    clauses.append("%s in (%s)" % (columns['sensor_id'],
+                    ','.join([str(sensor_id) for sensor_id in sensors_id]),))
+    if variable:
+        clauses.append("%s = '%s'" % (columns['reading'], variable,))
+    clauses.append(columns['not_flagged'])
+    return "select hstore_to_matrix(info) from sensor_data where %s \
+            order by %s" % (' and '.join(clauses), columns['ts'])
+
+def time_range_clauses(db_conn, starttime, endtime, count):
+    """splits the (starttime, endtime) range of sensor_data_query into
+    count consecutive clauses that together match the same rows. ranges
+    that are not datetimes are not split"""
+    if count < 2 or not isinstance(starttime, datetime.datetime) \
+     or not isinstance(endtime, datetime.datetime):
+        return [None]
+    ts = db_tools.sensor_data_columns(db_conn)['ts']
+    step = (endtime - starttime) / count
+    clauses = []
+    lower = "%s > '%s'" % (ts, starttime)
+    for i in range(1, count):
+        bound = starttime + step * i
+        clauses.append("%s and %s <= '%s'" % (lower, ts, bound))
+        lower = "%s > '%s'" % (ts, bound)
+    clauses.append("%s and %s < '%s'" % (lower, ts, endtime))
+    return clauses
+
+def parse_timestamp(timestamp):
+    """parses a sensor_data timestamp, dropping fractional seconds"""
+    return datetime.datetime.strptime(timestamp.split('.')[0],
+                                      DATETIME_STRFORMAT)
+
+def stream_data_blocks(db_conn, query_string, chunk_size=STREAM_CHUNK_SIZE,
+                       itersize=STREAM_ITERSIZE):
+    """yields (sensor_id, Data) blocks of at most chunk_size readings from a
+    server side cursor. blocks for each sensor and variable come out in
+    timestamp order, memory is bounded by the open blocks"""
+    checker = db_tools.ReadingChecker(db_conn)
+    blocks = {}
+    for row in db_conn.stream(query_string, itersize):
+        info = dict(row[0])
+        key = (info['sensor_id'], info['reading'])
+        if key not in blocks:
+            units = checker.default_units[info['reading']]
+            blocks[key] = DataBuffer(Variable(info['reading'], units, info['theme']))
+        if info['value']:
+            reading_ok,value = checker.check(
+                info['reading'],
+                info['units'],
+                info['value']
+                        )
+            if reading_ok:
+                blocks[key].append(parse_timestamp(info['timestamp']), value)
+                if len(blocks[key]) >= chunk_size:
+                    yield key[0], blocks[key].data()
+                    blocks[key] = DataBuffer(blocks[key].var)
+    for key, block in blocks.items():
+        if block:
+            yield key[0], block.data()
+
+class SensorRowCollector:
+    """decodes sensor_data rows into per sensor, per variable buffers"""
+    def __init__(self, checker):
+        self.checker = checker
+        self.sensor_data = {}
+        self.variable_data = {}
+        self.variables = {}
+
+    def add_rows(self, rows):
+        for row in rows:
+            info = dict(row[0])
+            reading = info['reading']
+            if reading not in self.variables:
+                units = self.checker.default_units[reading]
+                self.variables[reading] = Variable(reading, units, info['theme'])
+                self.variable_data[reading] = []
+            sensor_readings = self.sensor_data.setdefault(info['sensor_id'], {})
+            if reading not in sensor_readings:
+                sensor_readings[reading] = DataBuffer(self.variables[reading])
+            if info['value']:
+                reading_ok,value = self.checker.check(
+                    reading,
+                    info['units'],
+                    info['value']
+                            )
+                if reading_ok:
+                    sensor_readings[reading].append(
+                        parse_timestamp(info['timestamp']), value)
+                    self.variable_data[reading].append(float(value))
+
+    def merge(self, other):
+        """adds the readings collected by other, which must be later than
+        this collector's readings of any sensor they share"""
+        for reading, variable in other.variables.items():
+            if reading not in self.variables:
+                self.variables[reading] = variable
+                self.variable_data[reading] = []
+            self.variable_data[reading].extend(other.variable_data[reading])
+        for sensor_id, other_readings in other.sensor_data.items():
+            sensor_readings = self.sensor_data.setdefault(sensor_id, {})
+            for reading, data in other_readings.items():
+                if reading not in sensor_readings:
+                    sensor_readings[reading] = DataBuffer(self.variables[reading])
+                sensor_readings[reading].extend(data)
+
+    def sensor_data_group(self, sensor_id_lookup, database_connection=None):
+        sensor_data =[]
+        for sensor_id, sensor_readings in self.sensor_data.items():
+            data_list = []
+            for data in sensor_readings.values():
+                if data:
+                    data_list.append(data.data())
+            sensor_data.append(SensorData(
+                                sensor_id_lookup[sensor_id],
+                                data_list
+                                ))
+        return SensorDataGroup(sensor_data,self.variable_data,
+                               list(self.variables.values()),database_connection)
+
+class GeometryCache:
+    """thread safe LRU cache of transformed GeoJSON geometries keyed by
+    (sensor_id, raw geom, srid). geometries that postgis transformed to
+    null are cached as TRANSFORM_FAILED, query errors are not cached"""
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__geoms = collections.OrderedDict()
+
+    def get(self, key):
+        with self.__lock:
+            geom = self.__geoms.pop(key, None)
+            if geom is not None:
+                self.__geoms[key] = geom
+            return geom
+
+    def set(self, key, geom):
+        with self.__lock:
+            self.__geoms.pop(key, None)
+            self.__geoms[key] = geom
+            while len(self.__geoms) > self.max_entries:
+                self.__geoms.popitem(last=False)
+
+    def clear(self,):
+        with self.__lock:
+            self.__geoms.clear()
+
+TRANSFORM_FAILED = False
+
+TRANSFORMED_GEOMS = GeometryCache()
+
+class ResultCache:
+    """thread safe LRU cache of SensorGroup.data latest and get results,
+    keyed by sensor set, variable and time window rounded down to bucket
+    seconds. entries expire after ttl seconds, the least recently used go
+    beyond max_entries or max_bytes of data, and entries holding a sensor
+    go when readings are added for it. concurrent callers of a missing key
+    wait for a single computation. results are shared, treat them as read
+    only"""
+    def __init__(self, ttl=RESULT_CACHE_TTL, bucket=RESULT_CACHE_BUCKET,
+                 max_entries=1000, max_bytes=RESULT_CACHE_BYTES):
+        self.ttl = ttl
+        self.bucket = bucket
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # key: (stored_at, sensors_id, size, result)
+        self.__entries = collections.OrderedDict()
+        self.__sensor_keys = {}
+        self.__pending = {}
+        self.__generation = 0
+        self.__invalidated = {}
+
+    def round_time(self, timestamp):
+        """rounds a datetime down to the bucket, other values are kept"""
+        if not isinstance(timestamp, datetime.datetime):
+            return timestamp
+        width = self.bucket * 1000
+        return sensor_tools.epoch_ms_to_datetime(
+            sensor_tools.datetime_to_epoch_ms(timestamp) // width * width)
+
+    def get(self, key, sensors_id, compute):
+        """returns the result cached for key, otherwise the result of
+        compute(), which returns (result, size in bytes)"""
+        while True:
+            with self.__lock:
+                entry = self.__entries.get(key)
+                if entry is not None and time.time() - entry[0] <= self.ttl:
+                    self.__entries[key] = self.__entries.pop(key)
+                    self.hits += 1
+                    return entry[3]
+                if entry is not None:
+                    self.__remove(key)
+                pending = self.__pending.get(key)
+                if pending is None:
+                    pending = threading.Event()
+                    self.__pending[key] = pending
+                    generation = self.__generation
+                    self.misses += 1
+                    break
+            pending.wait()
+        try:
+            result, size = compute()
+            with self.__lock:
+                # readings added while computing make the result stale
+                if all(self.__invalidated.get(sensor_id, -1) <= generation
+                       for sensor_id in sensors_id):
+                    self.__store(key, sensors_id, size, result)
+        finally:
+            with self.__lock:
+                del self.__pending[key]
+            pending.set()
+        return result
+
+    def __store(self, key, sensors_id, size, result):
+        self.__remove(key)
+        self.__entries[key] = (time.time(), sensors_id, size, result)
+        self.bytes += size
+        for sensor_id in sensors_id:
+            self.__sensor_keys.setdefault(sensor_id, set()).add(key)
+        while self.__entries and (len(self.__entries) > self.max_entries
+                                  or self.bytes > self.max_bytes):
+            self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[2]
+        for sensor_id in entry[1]:
+            keys = self.__sensor_keys.get(sensor_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__sensor_keys[sensor_id]
+
+    def invalidate(self, sensors_id):
+        """drops the results holding any of the sensors"""
+        with self.__lock:
+            self.__generation += 1
+            for sensor_id in sensors_id:
+                sensor_id = str(sensor_id)
+                self.__invalidated[sensor_id] = self.__generation
+                for key in list(self.__sensor_keys.get(sensor_id, ())):
+                    self.__remove(key)
+
+    def clear(self,):
+        with self.__lock:
+            self.__generation += 1
+            for sensor_id in list(self.__sensor_keys):
+                self.__invalidated[sensor_id] = self.__generation
+            self.__entries.clear()
+            self.__sensor_keys.clear()
+            self.bytes = 0
+
+def invalidate_results(db_conn, sensors_id):
+    """drops cached results of the sensors after adding readings"""
+    cache = getattr(db_conn, 'result_cache', None)
+    if cache is not None:
+        cache.invalidate(sensors_id)
+
+def data_group_size(sensor_data_group):
+    """approximate memory held by a SensorDataGroup in bytes"""
+    size = 0
+    for sensor_data in sensor_data_group.sensor_data:
+        for table in sensor_data.data_tables:
+            size += table.time_array.nbytes + table.value_array.nbytes
+    for values in sensor_data_group.variable_data.values():
+        # list slot plus float object
+        size += 32 * len(values)
+    return size
+
+def cached_sensor_geoms(sensors, proj):
+    """splits sensors into ({sensor_id: geojson} of cached transforms to
+    proj, sensors still to transform). cached failures are in neither"""
+    transformed = {}
+    missing = []
+    for sensor in sensors:
+        geom = TRANSFORMED_GEOMS.get((sensor.sensor_id, sensor._raw_geom, str(proj)))
+        if geom is None:
+            missing.append(sensor)
+        elif geom is not TRANSFORM_FAILED:
+            transformed[sensor.sensor_id] = geom
+    return transformed, missing
+
+def transform_geoms_query(sensors, proj):
+    values = ["('%s','%s'::geometry)" % (sensor.sensor_id, sensor._raw_geom)
+              for sensor in sensors]
+    return "select sensor_id, ST_AsGeoJSON(ST_Transform(geom, %s)) \
+    from (values %s) as sensor_geoms (sensor_id, geom)" % (proj, ','.join(values))
+
+def cache_transformed_geoms(transformed, sensors, proj, rows):
+    """caches the rows of transform_geoms_query and adds them to
+    transformed, sensors without a geometry in rows are cached as failed"""
+    sensor_lookup = dict((str(sensor.sensor_id), sensor) for sensor in sensors)
+    geojsons = dict((str(sensor_id), geojson) for sensor_id, geojson in rows)
+    for sensor_id, sensor in sensor_lookup.items():
+        key = (sensor.sensor_id, sensor._raw_geom, str(proj))
+        if geojsons.get(sensor_id):
+            geom = simplejson.loads(geojsons[sensor_id])
+            TRANSFORMED_GEOMS.set(key, geom)
+            transformed[sensor.sensor_id] = geom
+        else:
+            TRANSFORMED_GEOMS.set(key, TRANSFORM_FAILED)
+    return transformed
+
+def transform_sensor_geoms(db_conn, sensors, proj):
+    """reprojects sensor geometries to the proj SRID with one query for
+    every geometry not already cached, returns {sensor_id: geojson}.
+    sensors that cannot be transformed are left out"""
+    if proj is None:
+        return {}
+    transformed, missing = cached_sensor_geoms(sensors, proj)
+    if not missing:
+        return transformed
+    try:
+        rows = db_conn.query(transform_geoms_query(missing, proj))
+    except NameError:
+        # one bad geometry fails the batch, fall back to one query each
+        for sensor in missing:
+            geom = sensor.geom_transformed(proj)
+            if geom:
+                transformed[sensor.sensor_id] = geom
+        return transformed
+    return cache_transformed_geoms(transformed, missing, proj, rows)
+
+def planar_distances(x1, y1, x2, y2):
+    """planar distances between points, as st_distance of st_makepoints,
+    broadcasting numpy arrays so one call measures many pairs"""
+    return numpy.hypot(numpy.asarray(x2, dtype=numpy.float64) - x1,
+                       numpy.asarray(y2, dtype=numpy.float64) - y1)
+
+def geom_point(geom):
+    """x, y of a GeoJSON point, the mean coordinate of other geometries,
+    None when empty"""
+    if not geom or not geom.get('coordinates'):
+        return None
+    if geom.get('type') == 'Point':
+        return float(geom['coordinates'][0]), float(geom['coordinates'][1])
+    points = numpy.array(list(_flatten_coordinates(geom['coordinates'])),
+                         dtype=numpy.float64)
+    if not len(points):
+        return None
+    return float(points[:, 0].mean()), float(points[:, 1].mean())
+
+def _flatten_coordinates(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates[:2]
+        return
+    for item in coordinates:
+        for point in _flatten_coordinates(item):
+            yield point
+
+class SpatialIndex:
+    """uniform grid index of sensors by point, in the SRID of their
+    geometries. queries need no database and return sensors in index
+    order, nearest in distance order"""
+    def __init__(self, sensors, cell_size=None):
+        self.sensors = []
+        xs, ys = [], []
+        for sensor in sensors:
+            point = geom_point(sensor.geom)
+            if point:
+                self.sensors.append(sensor)
+                xs.append(point[0])
+                ys.append(point[1])
+        self.xs = numpy.array(xs, dtype=numpy.float64)
+        self.ys = numpy.array(ys, dtype=numpy.float64)
+        self.__cells = {}
+        if not self.sensors:
+            self.cell_size = cell_size or 1.0
+            return
+        if cell_size is None:
+            area = (self.xs.max() - self.xs.min()) * (self.ys.max() - self.ys.min())
+            cell_size = (area * SPATIAL_CELL_POINTS / len(self.sensors)) ** 0.5
+        self.cell_size = cell_size or 1.0
+        cols = numpy.floor(self.xs / self.cell_size).astype(numpy.int64)
+        rows = numpy.floor(self.ys / self.cell_size).astype(numpy.int64)
+        cells = {}
+        for i, cell in enumerate(zip(cols.tolist(), rows.tolist())):
+            cells.setdefault(cell, []).append(i)
+        for cell, indexes in cells.items():
+            self.__cells[cell] = numpy.array(indexes, dtype=numpy.int64)
+
+    def __len__(self,):
+        return len(self.sensors)
+
+    def __candidates(self, xmin, ymin, xmax, ymax):
+        col_min, col_max = int(numpy.floor(xmin / self.cell_size)), \
+                           int(numpy.floor(xmax / self.cell_size))
+        row_min, row_max = int(numpy.floor(ymin / self.cell_size)), \
+                           int(numpy.floor(ymax / self.cell_size))
+        if (col_max - col_min + 1) * (row_max - row_min + 1) > len(self.__cells):
+            blocks = [indexes for (col, row), indexes in self.__cells.items()
+                      if col_min <= col <= col_max and row_min <= row <= row_max]
+        else:
+            blocks = [self.__cells[(col, row)]
+                      for col in range(col_min, col_max + 1)
+                      for row in range(row_min, row_max + 1)
+                      if (col, row) in self.__cells]
+        if not blocks:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.sort(numpy.concatenate(blocks))
+
+    def within_bbox(self, xmin, ymin, xmax, ymax):
+        candidates = self.__candidates(xmin, ymin, xmax, ymax)
+        xs, ys = self.xs[candidates], self.ys[candidates]
+        found = candidates[(xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)]
+        return [self.sensors[i] for i in found.tolist()]
+
+    def within_radius(self, x, y, radius):
+        candidates = self.__candidates(x - radius, y - radius,
+                                       x + radius, y + radius)
+        distances = planar_distances(x, y, self.xs[candidates],
+                                     self.ys[candidates])
+        return [self.sensors[i] for i in candidates[distances <= radius].tolist()]
+
+    def nearest(self, x, y, k=1):
+        """the k sensors closest to x, y with their distances"""
+        if not self.sensors:
+            return []
+        distances = planar_distances(x, y, self.xs, self.ys)
+        k = min(k, len(distances))
+        closest = numpy.argpartition(distances, k - 1)[:k]
+        closest = closest[numpy.argsort(distances[closest], kind='mergesort')]
+        return [(self.sensors[i], float(distances[i])) for i in closest.tolist()]
+
+def invalidate_sensor_index(db_conn):
+    """drops the cached registry spatial indexes after sensors change"""
+    indexes = getattr(db_conn, 'sensor_indexes', None)
+    if indexes:
+        indexes.clear()
+
 class SensorData:
     def __init__(self,sensor,data_tables):
         self.sensor = sensor
@@ -23,14 +518,20 @@ class SensorData:
 class LiveSensorDataGroup:
     def __init__(self,sensordatagroup):
         self.__sensordatagroup = sensordatagroup
+
+    def __transformed_geoms(self,proj):
+        sensors = [data_blocks.sensor for data_blocks in
+                   self.__sensordatagroup.sensor_data]
+        return self.__sensordatagroup.geoms_transformed(sensors, proj)
        
     def json(self,proj=None):
         sensor_data = self.__sensordatagroup.sensor_data
         latest_sensors = []
         var = self.__sensordatagroup.variables[0].name
+        geoms = self.__transformed_geoms(proj)
         
         for data_blocks in sensor_data:
-            geom = data_blocks.sensor.geom_transformed(proj)
+            geom = geoms.get(data_blocks.sensor.sensor_id)
             if geom:
                 latest_sensors.append(dict(zip(['geom','properties','id'],[geom,{var:data_blocks.table(var).live()},data_blocks.sensor.sensor_id])))
         if latest_sensors:
@@ -40,16 +541,272 @@ class LiveSensorDataGroup:
         sensor_data = self.__sensordatagroup.sensor_data
         latest_sensors = []
         var = self.__sensordatagroup.variables[0].name
+        geoms = self.__transformed_geoms(proj)
         
         for data_blocks in sensor_data:
-            geom = data_blocks.sensor.geom_transformed(proj)
+            geom = geoms.get(data_blocks.sensor.sensor_id)
             if geom:
                 latest_sensors.append(geom['coordinates']+[data_blocks.table(var).live()])
         return latest_sensors
             
+class LiveState:
+    """latest value of a variable per sensor of a group, loaded once and
+    then kept up to date from sensor_data insert notifications"""
+    def __init__(self, sensorgroup, variable):
+        self.sensorgroup = sensorgroup
+        self.variable = variable
+        self.__sensor_lookup = dict((str(sensor.sensor_id), sensor)
+                                    for sensor in sensorgroup.sensors)
+        self.__lock = threading.Lock()
+        self.__latest = {}
+        self.__var = None
+
+    def query(self, cutoff, columns=None):
+        return sensor_data_query(self.sensorgroup.sensorweb.database_connection,
+                                 list(self.__sensor_lookup), cutoff,
+                                 variable=self.variable, columns=columns)
+
+    def load_rows(self, rows):
+        """replaces the state with the rows of query()"""
+        db_conn = self.sensorgroup.sensorweb.database_connection
+        collector = SensorRowCollector(db_tools.ReadingChecker(db_conn))
+        collector.add_rows(rows)
+        latest = {}
+        for sensor_id, sensor_readings in collector.sensor_data.items():
+            data = sensor_readings.get(self.variable)
+            if data:
+                latest[str(sensor_id)] = (data.times[-1], data.values[-1])
+        with self.__lock:
+            self.__latest = latest
+            self.__var = collector.variables.get(self.variable, self.__var)
+
+    def load(self, cutoff=DEFAULT_CUTOFF):
+        db_conn = self.sensorgroup.sensorweb.database_connection
+        self.load_rows(db_conn.query(self.query(cutoff)))
+
+    def apply(self, payload):
+        """applies a notification payload, returns the update as a dict of
+        sensor, reading, timestamp and value in default units, or None
+        when it is for another group or older than the state"""
+        info = simplejson.loads(payload)
+        sensor = self.__sensor_lookup.get(str(info.get('sensor_id')))
+        if sensor is None or info.get('reading') != self.variable \
+         or not info.get('value') or not info.get('timestamp'):
+            return None
+        catalogue = db_tools.reading_catalogue(
+            self.sensorgroup.sensorweb.database_connection)
+        reading_ok, value = catalogue.check(self.variable, info.get('units'),
+                                            info['value'])
+        if not reading_ok:
+            return None
+        timestamp = parse_timestamp(info['timestamp'])
+        epoch_ms = sensor_tools.datetime_to_epoch_ms(timestamp)
+        with self.__lock:
+            current = self.__latest.get(str(sensor.sensor_id))
+            if current and current[0] > epoch_ms:
+                return None
+            self.__latest[str(sensor.sensor_id)] = (epoch_ms, value)
+            if self.__var is None:
+                self.__var = Variable(self.variable,
+                                      catalogue.default_units(self.variable),
+                                      info.get('theme'))
+        return {'sensor':sensor, 'reading':self.variable,
+                'timestamp':timestamp, 'value':value}
+
+    def live(self, transformed_geoms=None):
+        """LiveSensorDataGroup of the state, None while it is empty.
+        transformed_geoms, {proj: {sensor_id: geojson}}, replaces the
+        database for reprojecting, as in the asyncio client"""
+        with self.__lock:
+            latest = dict(self.__latest)
+            var = self.__var
+        if not latest:
+            return None
+        sensor_data = []
+        for sensor_id, (epoch_ms, value) in sorted(latest.items()):
+            sensor_data.append(SensorData(self.__sensor_lookup[sensor_id],
+                               [Data.from_arrays(var, [epoch_ms], [value])]))
+        variable_data = {self.variable:[value for epoch_ms, value in
+                                        latest.values()]}
+        if transformed_geoms is not None:
+            sensor_data_group = SensorDataGroup(sensor_data, variable_data, [var])
+            sensor_data_group.transformed_geoms.update(transformed_geoms)
+        else:
+            sensor_data_group = SensorDataGroup(
+                sensor_data, variable_data, [var],
+                self.sensorgroup.sensorweb.database_connection)
+        return LiveSensorDataGroup(sensor_data_group)
+
+class LiveSubscription:
+    """keeps a LiveState of a sensor group up to date by listening for
+    sensor_data inserts on a dedicated connection in a background thread.
+    updates go to the callbacks, which must not block and whose errors are
+    logged, and to iteration over the subscription. after a lost
+    connection or a failed update it reconnects and reloads the state.
+    needs migrations.add_insert_notify()"""
+    def __init__(self, sensorgroup, variable, cutoff=DEFAULT_CUTOFF,
+                 callback=None):
+        db_conn = sensorgroup.sensorweb.database_connection
+        if db_tools.NOTIFY_MIGRATION not in db_tools.applied_migrations(db_conn):
+            raise error.SensorError('run migrations.add_insert_notify() first')
+        self.state = LiveState(sensorgroup, variable)
+        self.cutoff = cutoff
+        self.__callbacks = []
+        if callback:
+            self.__callbacks.append(callback)
+        self.__updates = collections.deque(maxlen=UPDATE_BUFFER)
+        self.__condition = threading.Condition()
+        self.__closed = threading.Event()
+        self.__conn = self.__listen()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __listen(self,):
+        # listen before loading so no insert falls between the two
+        db_conn = self.state.sensorgroup.sensorweb.database_connection
+        conn = db_conn.connect()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute("listen %s" % (db_tools.NOTIFY_CHANNEL,))
+            self.state.load(self.cutoff)
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def __run(self,):
+        while not self.__closed.is_set():
+            try:
+                if self.__conn is None:
+                    self.__conn = self.__listen()
+                if select.select([self.__conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                    continue
+                self.__conn.poll()
+                while self.__conn.notifies:
+                    update = self.state.apply(self.__conn.notifies.pop(0).payload)
+                    if update:
+                        self.__publish(update)
+            except (psycopg2.Error, NameError, select.error):
+                LOGGER.warning('live subscription lost its connection, '
+                               'reconnecting', exc_info=True)
+                self.__reconnect()
+            except Exception:
+                # anything else would end the thread and freeze the state,
+                # reload it from a fresh connection instead
+                LOGGER.exception('live subscription update failed, reloading')
+                self.__reconnect()
+        if self.__conn is not None:
+            self.__conn.close()
+
+    def __reconnect(self,):
+        if self.__conn is not None:
+            try:
+                self.__conn.close()
+            except psycopg2.Error:
+                pass
+            self.__conn = None
+        self.__closed.wait(LISTEN_RETRY_DELAY)
+
+    def __publish(self, update):
+        for callback in list(self.__callbacks):
+            try:
+                callback(update)
+            except Exception:
+                LOGGER.exception('live subscription callback %r failed',
+                                 callback)
+        with self.__condition:
+            self.__updates.append(update)
+            self.__condition.notify_all()
+
+    def add_callback(self, callback):
+        self.__callbacks.append(callback)
+
+    def __iter__(self,):
+        """yields updates as they arrive until close(), at most
+        UPDATE_BUFFER are kept for a slow reader"""
+        while True:
+            with self.__condition:
+                while not self.__updates and not self.__closed.is_set():
+                    self.__condition.wait(LISTEN_TIMEOUT)
+                if not self.__updates:
+                    return
+                update = self.__updates.popleft()
+            yield update
+
+    def live(self,):
+        return self.state.live()
+
+    def json(self,proj=None):
+        live = self.state.live()
+        if live:
+            return live.json(proj)
+
+    def csv(self,proj=None):
+        live = self.state.live()
+        if live:
+            return live.csv(proj)
+        return []
+
+    def close(self,):
+        self.__closed.set()
+        with self.__condition:
+            self.__condition.notify_all()
+
+def step_levels(steps, values):
+    """index of the nearest of steps for every value, the first on ties"""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    steps = numpy.asarray(steps, dtype=numpy.float64)
+    if not len(values):
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.abs(values[:, numpy.newaxis] - steps).argmin(axis=1)
+
+def rasterize(xs, ys, values, bbox, width, height, method='idw', power=2,
+              bandwidth=None):
+    """grids point values over bbox (xmin, ymin, xmax, ymax) into a
+    height x width float64 array, row 0 at ymax, by inverse distance
+    weighting or a value weighted gaussian kernel density with bandwidth
+    in bbox units. cells are evaluated in blocks of GRID_BLOCK_CELLS
+    cells x points, cells are nan without points"""
+    if method not in GRID_METHODS:
+        raise error.SensorError('unknown grid method %s' % (method,))
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    xmin, ymin, xmax, ymax = [float(item) for item in bbox]
+    grid = numpy.empty(width * height, dtype=numpy.float64)
+    grid.fill(numpy.nan)
+    if not len(values):
+        return grid.reshape(height, width)
+    if bandwidth is None:
+        bandwidth = max(xmax - xmin, ymax - ymin) / 20.0
+    cell_x = xmin + (numpy.arange(width) + 0.5) * (xmax - xmin) / width
+    cell_y = ymax - (numpy.arange(height) + 0.5) * (ymax - ymin) / height
+    cells_x = numpy.tile(cell_x, height)
+    cells_y = numpy.repeat(cell_y, width)
+    block = max(GRID_BLOCK_CELLS // len(values), 1)
+    for start in range(0, len(grid), block):
+        dx = cells_x[start:start + block, numpy.newaxis] - xs
+        dy = cells_y[start:start + block, numpy.newaxis] - ys
+        squared = dx * dx + dy * dy
+        if method == 'idw':
+            exact = squared == 0
+            with numpy.errstate(divide='ignore'):
+                weights = squared ** (-power / 2.0)
+            weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+            grid[start:start + block] = weights.dot(values) / weights.sum(axis=1)
+        else:
+            weights = numpy.exp(-squared / (2.0 * bandwidth * bandwidth))
+            grid[start:start + block] = weights.dot(values) / \
+                                        (2.0 * numpy.pi * bandwidth * bandwidth)
+    return grid.reshape(height, width)
+
 class SensorDataGroup:
-    def __init__(self,sensor_data_list,variable_data,vars):
+    def __init__(self,sensor_data_list,variable_data,vars,database_connection=None):
         self.sensor_data = sensor_data_list
+        self.database_connection = database_connection
+        # {proj: {sensor_id: geojson}} used instead of the database
+        self.transformed_geoms = {}
         self.variable_data = variable_data
         self._var_steps = {}
         self.variables = vars
@@ -57,15 +814,19 @@ class SensorDataGroup:
         for var in vars:
             self.__var_lookup[var.name] = var
         self.__var_info ={}
-        var_values ={}
+        self.__stats = {}
+        self.__sketches = {}
         for sensor_data in self.sensor_data:
             for data_table in sensor_data.data_tables:
-                var_values[data_table.var.name] = var_values.get(data_table.var.name,[])
-                var_values[data_table.var.name].append(data_table.live())
-        for var_name, values in var_values.iteritems():
-            values.sort()
-            min_val,max_val = values[0], values[-1]
-            self.__var_info[var_name] = {'min':min_val,'max':max_val,'avg':sum(values)/float(len(values))}
+                var_name = data_table.var.name
+                if var_name not in self.__stats:
+                    self.__stats[var_name] = stats.RunningStats()
+                    self.__sketches[var_name] = stats.QuantileSketch()
+                self.__stats[var_name].add(data_table.live())
+                self.__sketches[var_name].add(data_table.live())
+        for var_name, var_stats in self.__stats.items():
+            min_val,max_val = var_stats.min, var_stats.max
+            self.__var_info[var_name] = {'min':min_val,'max':max_val,'avg':var_stats.mean}
             if max_val == min_val:
                 rng = 0
             else:
@@ -77,6 +838,85 @@ class SensorDataGroup:
     def level(self,var_name,value):
         return min(range(len(self._var_steps[var_name])), key=lambda i: abs(self._var_steps[var_name][i]-value))
     
+    def levels(self,var_name):
+        """level() of every sensor's live value in one pass, returns
+        {sensor_id: level}"""
+        sensor_ids = []
+        values = []
+        for sensordata in self.sensor_data:
+            table = sensordata.table(var_name)
+            if table:
+                sensor_ids.append(sensordata.sensor.sensor_id)
+                values.append(table.live())
+        return dict(zip(sensor_ids, step_levels(self._var_steps[var_name],
+                                                values).tolist()))
+
+    def geoms_transformed(self, sensors, proj):
+        """{sensor_id: geojson} of sensors in the proj SRID, from
+        transformed_geoms or else the database. groups without a database
+        connection raise SensorError for a proj they were not given"""
+        if proj is None:
+            return {}
+        if proj in self.transformed_geoms:
+            return self.transformed_geoms[proj]
+        if self.database_connection is None:
+            raise error.SensorError('no geometries transformed to %s' % (proj,))
+        return transform_sensor_geoms(self.database_connection, sensors, proj)
+
+    def __points(self, var_name, proj):
+        """x, y and live value arrays of the point sensors with var_name"""
+        sensors = [sensordata.sensor for sensordata in self.sensor_data
+                   if sensordata.table(var_name)]
+        if proj is None:
+            geoms = dict((sensor.sensor_id, sensor.geom) for sensor in sensors)
+        else:
+            geoms = self.geoms_transformed(sensors, proj)
+        xs, ys, values = [], [], []
+        for sensordata in self.sensor_data:
+            table = sensordata.table(var_name)
+            geom = geoms.get(sensordata.sensor.sensor_id)
+            if table and geom and geom.get('type') == 'Point':
+                xs.append(geom['coordinates'][0])
+                ys.append(geom['coordinates'][1])
+                values.append(table.live())
+        return xs, ys, values
+
+    def grid(self, var_name, bbox, width, height, proj=None, method='idw',
+             power=2, bandwidth=None):
+        """rasterizes the live values of var_name over bbox in the proj
+        SRID, see rasterize()"""
+        xs, ys, values = self.__points(var_name, proj)
+        return rasterize(xs, ys, values, bbox, width, height, method, power,
+                         bandwidth)
+
+    def grid_payload(self, var_name, bbox, width, height, proj=None,
+                     method='idw', power=2, bandwidth=None, encoding='float32'):
+        """grid() as a json ready dict with the cells base64 encoded in
+        row order from the top, either as little endian float32 with nan
+        for no data or as uint8 variable_steps levels with NO_LEVEL for no
+        data"""
+        grid = self.grid(var_name, bbox, width, height, proj, method, power,
+                         bandwidth)
+        payload = {'variable':var_name, 'bbox':list(bbox), 'width':width,
+                   'height':height, 'proj':proj, 'method':method,
+                   'encoding':encoding}
+        cells = grid.ravel()
+        known = ~numpy.isnan(cells)
+        payload['min'] = float(cells[known].min()) if known.any() else None
+        payload['max'] = float(cells[known].max()) if known.any() else None
+        if encoding == 'levels':
+            levels = numpy.empty(len(cells), dtype=numpy.uint8)
+            levels.fill(NO_LEVEL)
+            levels[known] = step_levels(self._var_steps[var_name], cells[known])
+            payload['steps'] = self._var_steps[var_name]
+            data = levels.tobytes()
+        elif encoding == 'float32':
+            data = cells.astype('<f4').tobytes()
+        else:
+            raise error.SensorError('unknown grid encoding %s' % (encoding,))
+        payload['data'] = base64.b64encode(data).decode('ascii')
+        return payload
+
     def heatmap(self,var_name):
         heatmap_obj = {'max':self.__var_info[var_name]['max'],'data':[]}
         for sensordata in self.sensor_data:
@@ -89,15 +929,27 @@ class SensorDataGroup:
 
     def variable_summary(self,):
         var_summary = {}
-        for var,var_info in self.__var_info.iteritems():
+        for var,var_info in self.__var_info.items():
             var_summary[var] = var_info
-            count = 0
-            for sensor_data in self.sensor_data:
-                if sensor_data.table(var):
-                    count+=1
-            var_summary[var]['num'] = count
+            var_summary[var]['num'] = self.__stats[var].count
             var_summary[var]['units'] = self.__var_lookup[var].units
         return var_summary
+
+    def statistics(self,var_name):
+        """stats.RunningStats of the sensors' live values of var_name"""
+        return self.__stats.get(var_name)
+
+    def quantiles(self,var_name,qs=(0.5,)):
+        """approximate quantiles of the sensors' live values of var_name"""
+        if var_name in self.__sketches:
+            return self.__sketches[var_name].quantiles(qs)
+
+    def summaries(self,):
+        """{var_name: (RunningStats, QuantileSketch)} of the live values,
+        merge them with those of other groups for totals over shards"""
+        return dict((var_name, (self.__stats[var_name],
+                                self.__sketches[var_name]))
+                    for var_name in self.__stats)
     def latest(self,):
         all_latest = []
         for sensordata in self.sensor_data:
@@ -107,173 +959,311 @@ class SensorDataGroup:
         return all_latest[-1]
     
         
+def merge_aggregate(buckets, bucket, reading, units, theme, total, min_val,
+                    max_val, count):
+    """folds a partial (sum, min, max, count) aggregate into
+    buckets[(bucket, reading)]"""
+    if not count:
+        return
+    key = (bucket, reading)
+    if key not in buckets:
+        buckets[key] = [units, theme, total, min_val, max_val, count]
+        return
+    merged = buckets[key]
+    merged[2] += total
+    merged[3] = min(merged[3], min_val)
+    merged[4] = max(merged[4], max_val)
+    merged[5] += count
+
+def raw_aggregates_query(columns, sensors_id, starttime, endtime, timedelta,
+                         remove_outlier, time_clause=None):
+    """builds the per bucket and reading aggregate query over sensor_data,
+    values converted to default units. remove_outlier drops values more
+    than OUTLIER_WHISKER interquartile ranges outside the bucket's
+    quartiles, buckets of fewer than 4 values are kept whole"""
+    if time_clause is None:
+        time_clause = "%s > '%s' and %s <= '%s'" % (
+        columns['ts'], starttime, columns['ts'], endtime)
+    converted = "select date_round(%s, '%s') as bucket, \
+          sensor_data.info->'reading' as reading, \
+          sensor_data.info->'theme' as theme, \
+          readings.default_units as units, \
+          %s as value \
+        from sensor_data join readings \
+        on readings.reading_name = sensor_data.info->'reading' \
+        where %s \
+        and %s in (%s) \
+        and %s" % (columns['ts'], str(timedelta), db_tools.converted_value_sql(),
+                   time_clause, columns['sensor_id'], ','.join(sensors_id),
+                   columns['not_flagged'])
+    if not remove_outlier:
+        return "select bucket, reading, min(units), min(theme), \
+         sum(value), min(value), max(value), count(value) \
+        from (%s) as converted \
+        where value is not null group by bucket, reading" % (converted,)
+    return "with converted as (%s), \
+    quartiles as (select bucket, reading, count(*) as n, \
+        percentile_cont(array[0.25,0.75]) within group (order by value) as q \
+        from converted where value is not null group by bucket, reading) \
+    select bucket, reading, min(units), min(theme), \
+     sum(value), min(value), max(value), count(value) \
+    from converted join quartiles using (bucket, reading) \
+    where value is not null and (quartiles.n < 4 or value between \
+     q[1] - (q[2] - q[1]) * %s and q[2] + (q[2] - q[1]) * %s) \
+    group by bucket, reading" % (converted, OUTLIER_WHISKER, OUTLIER_WHISKER)
+
+def add_raw_aggregate_rows(buckets, rows):
+    for row in rows:
+        merge_aggregate(buckets, *row)
+
+def aggregates_from_buckets(buckets):
+    """turns merged buckets into {reading: {'variable', 'time', 'mean',
+    'min', 'max', 'count'}} arrays in bucket order"""
+    aggregates = {}
+    for (bucket, reading) in sorted(buckets.keys()):
+        units, theme, total, min_val, max_val, count = buckets[(bucket, reading)]
+        if reading not in aggregates:
+            aggregates[reading] = {'variable':Variable(reading, units, theme)}
+            for key in ('time','mean','min','max','count'):
+                aggregates[reading][key] = array.array('d')
+        aggregates[reading]['time'].append(sensor_tools.datetime_to_epoch_ms(bucket))
+        aggregates[reading]['mean'].append(total / float(count))
+        aggregates[reading]['min'].append(min_val)
+        aggregates[reading]['max'].append(max_val)
+        aggregates[reading]['count'].append(count)
+    for reading_aggregates in aggregates.values():
+        reading_aggregates['time'] = numpy.asarray(reading_aggregates['time'],
+                                                   dtype=numpy.int64)
+        for key in ('mean','min','max'):
+            reading_aggregates[key] = numpy.asarray(reading_aggregates[key])
+        reading_aggregates['count'] = numpy.asarray(reading_aggregates['count'],
+                                                    dtype=numpy.int64)
+    return aggregates
+
+def data_from_aggregates(aggregates):
+    """one Data table of bucket means per reading"""
+    data_tables = []
+    for reading_aggregates in aggregates.values():
+        data_tables.append(Data.from_arrays(reading_aggregates['variable'],
+                                            reading_aggregates['time'],
+                                            reading_aggregates['mean']))
+    return data_tables
+
 class AverageSensorDataFunctions:
     def __init__(self,sensordatafunctions):
         self.sensordatafunctions = sensordatafunctions
+
+    def aggregates(self,starttime,endtime,timedelta,remove_outlier=True):
+        """per timedelta bucket and reading mean, min, max and count of the
+        group's readings in default units. aggregated in the database,
+        remove_outlier drops values outside 1.5 interquartile ranges of
+        each bucket's quartiles before aggregating. returns {reading: {'variable', 'time', 'mean',
+        'min', 'max', 'count'}} with epoch millisecond times and arrays in
+        bucket order.
+
+        without outlier removal, datetime ranges and a timedelta matching
+        a rollup are read from the coarsest rollup, with raw rows only for
+        the partial buckets at the edges and rows not yet rolled up"""
+        sensors_id = [str(sensor.sensor_id) for sensor in
+                      self.sensordatafunctions.sensorgroup.sensors]
+        db_conn = self.sensordatafunctions.sensorgroup.sensorweb.database_connection
+        columns = db_tools.sensor_data_columns(db_conn)
+        buckets = {}
+        rollup = None
+        if not remove_outlier and isinstance(starttime, datetime.datetime) \
+         and isinstance(endtime, datetime.datetime):
+            rollup = db_tools.rollup_for(timedelta)
+        status = None
+        if rollup:
+            status = db_tools.rollup_status(db_conn)
+        if status:
+            table, width = rollup
+            width_ms = db_tools.timedelta_seconds(width) * 1000
+            # rollup buckets wholly inside (starttime, endtime] and before
+            # the last refresh
+            covered_start = sensor_tools.epoch_ms_to_datetime(
+                (sensor_tools.datetime_to_epoch_ms(starttime) // width_ms + 1) * width_ms)
+            covered_end = sensor_tools.epoch_ms_to_datetime(
+                sensor_tools.datetime_to_epoch_ms(min(endtime, status[1])) // width_ms * width_ms)
+        if status and covered_start < covered_end:
+            self.__rollup_aggregates(buckets, table, sensors_id, covered_start,
+                                     covered_end, timedelta)
+            time_clause = "((%(ts)s > '%(start)s' and %(ts)s < '%(covered_start)s') \
+             or (%(ts)s >= '%(covered_end)s' and %(ts)s <= '%(end)s') \
+             or (sensor_data.sensor__data_id > %(last_id)s \
+              and %(ts)s > '%(start)s' and %(ts)s <= '%(end)s'))" % {
+                'ts':columns['ts'],
+                'start':starttime, 'end':endtime, 'covered_start':covered_start,
+                'covered_end':covered_end, 'last_id':status[0]}
+            self.__raw_aggregates(buckets, sensors_id, starttime, endtime,
+                                  timedelta, False, time_clause)
+        else:
+            self.__raw_aggregates(buckets, sensors_id, starttime, endtime,
+                                  timedelta, remove_outlier)
+        return aggregates_from_buckets(buckets)
+
+    def __raw_aggregates(self, buckets, sensors_id, starttime, endtime,
+                         timedelta, remove_outlier, time_clause=None):
+        db_conn = self.sensordatafunctions.sensorgroup.sensorweb.database_connection
+        columns = db_tools.sensor_data_columns(db_conn)
+        query_string = raw_aggregates_query(columns, sensors_id, starttime,
+                                            endtime, timedelta, remove_outlier,
+                                            time_clause)
+        add_raw_aggregate_rows(buckets, db_conn.query(query_string))
+
+    def __rollup_aggregates(self, buckets, table, sensors_id, starttime,
+                            endtime, timedelta):
+        query_string = "select date_round(bucket, '%s') as round_bucket, reading, \
+         min(units), min(theme), sum(total), min(min_value), max(max_value), sum(n) \
+        from %s where bucket >= '%s' and bucket < '%s' and sensor_id in (%s) \
+        group by round_bucket, reading" % (str(timedelta), table, starttime,
+                                           endtime, ','.join(sensors_id))
+        db_conn = self.sensordatafunctions.sensorgroup.sensorweb.database_connection
+        for row in db_conn.query(query_string):
+            merge_aggregate(buckets, *row)
         
     def get(self,starttime,endtime,timedelta,remove_outlier=True):
-        sensors_id = [ ]
-        sensor_id_lookup = {}
-        for sensor in self.sensordatafunctions.sensorgroup.sensors:
-            sensors_id.append(sensor.sensor_id)
-            sensor_id_lookup[sensor.sensor_id] = sensor
-
-        checker = db_tools.ReadingChecker(self.sensordatafunctions.sensorgroup.sensorweb.database_connection)
-        query_string  = "select array_agg(array_to_string(hstore_to_matrix(info),'|')),\
-         date_round(proper_timestamp(info->'timestamp'), '%s')\
-        from sensor_data\
-         where proper_timestamp(info->'timestamp')   > '%s' \
-         and proper_timestamp(info->'timestamp') <= '%s' \
-         and sensor_int_id_caster(info -> 'sensor_id'::text) in \
-         (%s) \
-          and not info?'flag'group by \
-        date_round(proper_timestamp(info->'timestamp'), '%s')\
-           order by  date_round(proper_timestamp(info->'timestamp'), '%s')" %(
-        str(timedelta),starttime,endtime,','.join(sensors_id),str(timedelta),str(timedelta)
-        )
-        variables ={}
-        var_data = {}
-        for row in self.sensordatafunctions.sensorgroup.sensorweb.database_connection.query(query_string):
-            timestamp = row[1]
-            var_data_for_time = {}
-            for data in row[0]:
-                elements = data.split('|')
-                info = dict(zip(elements[0::2], elements[1::2]))
-                units = checker.default_units[info['reading']]
-                variable = Variable(info['reading'], units, info['theme'])
-                variables[info['reading']] = Variable(info['reading'], units, info['theme'])
-                if info['value']:
-                    reading_ok,value = checker.check(
-                    info['reading'],
-                    info['units'],
-                    info['value']
-                            )
-                    if reading_ok:
-                        var_data_for_time[info['reading']] = var_data_for_time.get(info['reading'],[])
-                        var_data_for_time[info['reading']].append(value)
-            for key,value in var_data_for_time.iteritems():
-                var_data[key] = var_data.get(key,[])
-                if remove_outlier == True:
-                    pass
-                mean_val = sum(value)/float(len(value))
-                var_data[key].append([timestamp,mean_val])
-        data_tables = []
-        for var_name,values in var_data.iteritems():
-            data_tables.append(Data(variables[var_name], values))
-        return data_tables
+        return data_from_aggregates(self.aggregates(starttime, endtime,
+                                                    timedelta, remove_outlier))
                 
 class SensorGroupDataFunctions:
     def __init__(self,sensorgroup):
         self.sensorgroup = sensorgroup
         self.average = AverageSensorDataFunctions(self)
+    def __cached(self, kind, variable, window, compute):
+        """runs compute(*window) through the connection's result cache,
+        with the window rounded to the cache bucket"""
+        cache = getattr(self.sensorgroup.sensorweb.database_connection,
+                        'result_cache', None)
+        if cache is None:
+            return compute(*window)[0]
+        window = tuple(cache.round_time(timestamp) for timestamp in window)
+        sensors_id = tuple(sorted(set(str(sensor.sensor_id)
+                                      for sensor in self.sensorgroup.sensors)))
+        key = (kind, sensors_id, variable, window)
+        return cache.get(key, sensors_id, lambda: compute(*window))
+
     def latest(self,variable,cutoff=DEFAULT_CUTOFF):
+        """latest readings of variable since cutoff for live views, served
+        from the result cache when the sensorweb has one"""
+        return self.__cached('latest', variable, (cutoff,),
+                             lambda cutoff: self.__latest(variable, cutoff))
+
+    def __latest(self,variable,cutoff):
         sensors_id = [ ]
         sensor_id_lookup = {}
         for sensor in self.sensorgroup.sensors:
             sensors_id.append(sensor.sensor_id)
             sensor_id_lookup[sensor.sensor_id] = sensor
-        query_string = "select hstore_to_matrix(info) from sensor_data where \
-                       proper_timestamp(info->'timestamp') \
-                        > '%s' and sensor_int_id_caster(info -> 'sensor_id'::text) in (%s)\
-                        and info->'reading' = '%s'\
-                         and not info?'flag' order by proper_timestamp(info->'timestamp')" \
-                        % (cutoff, ','.join(sensors_id),variable)
-        __sensor_data = {}
-        __variable_data = {}
-        variables = {}
+        query_string = sensor_data_query(self.sensorgroup.sensorweb.database_connection,
+                                         sensors_id, cutoff, variable=variable)
         checker = db_tools.ReadingChecker(self.sensorgroup.sensorweb.database_connection)
         dbase_data_rows = self.sensorgroup.sensorweb.database_connection.query(query_string)
         if not dbase_data_rows:
-            return None
-        for row in dbase_data_rows:
-            info = dict(row[0])
-            units = checker.default_units[info['reading']]
-            variable = Variable(info['reading'], units, info['theme'])
-            variables[info['reading']] = Variable(info['reading'], units, info['theme'])
-            __variable_data[info['reading']] = __variable_data.get(info['reading'],[])
-            
-            __sensor_data[info['sensor_id']] = __sensor_data.get(info['sensor_id'],{})
-            __sensor_data[info['sensor_id']][info['reading']] = __sensor_data[info['sensor_id']].get(info['reading'],{'variable':variable,'data':[]})
-
-            if info['value']:
-                reading_ok,value = checker.check(
-                    info['reading'],
-                    info['units'],
-                    info['value']
-                            )
-                if reading_ok:
-                    __sensor_data[info['sensor_id']][info['reading']]['data'].append([
-                        datetime.datetime.strptime(info['timestamp'].split('.')[0],
-                                                    DATETIME_STRFORMAT),
-                        float(value)
-                        ])
-                    __variable_data[info['reading']].append(float(value))
-        sensor_data =[]
-        for sensor_id, sensor_readings in __sensor_data.iteritems():
-            data_list = []
-            for data in sensor_readings.values():
-                if data['data']:
-                    data_list.append(Data(data['variable'], data['data']))
-            sensor_data.append(SensorData(
-                                sensor_id_lookup[sensor_id],
-                                data_list
-                                ))
-        return LiveSensorDataGroup(SensorDataGroup(sensor_data,__variable_data,variables.values()))
+            return None, 0
+        collector = SensorRowCollector(checker)
+        collector.add_rows(dbase_data_rows)
+        sensor_data_group = collector.sensor_data_group(sensor_id_lookup,
+                        self.sensorgroup.sensorweb.database_connection)
+        return (LiveSensorDataGroup(sensor_data_group),
+                data_group_size(sensor_data_group))
     
-    def get(self, starttime, endtime,variable=None):
-        
+    def get(self, starttime, endtime,variable=None, workers=None,
+            shard_size=SHARD_SIZE, time_shards=1):
+        """retrieves the group's data between 2 times. with workers the
+        sensors are split into shards of shard_size, and datetime ranges
+        into time_shards, fetched and decoded concurrently on up to
+        workers pooled connections and merged into the same result.
+        served from the result cache when the sensorweb has one"""
+        return self.__cached('get', variable, (starttime, endtime),
+                             lambda starttime, endtime: self.__get(
+                                starttime, endtime, variable, workers,
+                                shard_size, time_shards))
+
+    def __get(self, starttime, endtime, variable, workers, shard_size,
+              time_shards):
         sensors_id = [ ]
         sensor_id_lookup = {}
         for sensor in self.sensorgroup.sensors:
             sensors_id.append(sensor.sensor_id)
             sensor_id_lookup[sensor.sensor_id] = sensor
-        query_string = "select hstore_to_matrix(info) from sensor_data where \
-                       proper_timestamp(info->'timestamp') \
-                        > '%s' and proper_timestamp(info->'timestamp') < '%s' \
-                         and sensor_int_id_caster(info -> 'sensor_id'::text) in (%s)\
-                         and not info?'flag' order by proper_timestamp(info->'timestamp')" \
-                        % (starttime, endtime, ','.join(sensors_id),)
-        
-        __sensor_data = {}
-        __variable_data = {}
-        variables = {}
-        checker = db_tools.ReadingChecker(self.sensorgroup.sensorweb.database_connection)
-        for row in self.sensorgroup.sensorweb.database_connection.query(query_string):
-            info = dict(row[0])
-            units = checker.default_units[info['reading']]
-            variable = Variable(info['reading'], units, info['theme'])
-            variables[info['reading']] = Variable(info['reading'], units, info['theme'])
-            __variable_data[info['reading']] = __variable_data.get(info['reading'],[])
-            
-            __sensor_data[info['sensor_id']] = __sensor_data.get(info['sensor_id'],{})
-            __sensor_data[info['sensor_id']][info['reading']] = __sensor_data[info['sensor_id']].get(info['reading'],{'variable':variable,'data':[]})
+        db_conn = self.sensorgroup.sensorweb.database_connection
+        checker = db_tools.ReadingChecker(db_conn)
+        if workers:
+            collector = self.__sharded_collect(checker, sensors_id, starttime,
+                                               endtime, variable, workers,
+                                               shard_size, time_shards)
+        else:
+            query_string = sensor_data_query(db_conn, sensors_id, starttime,
+                                             endtime, variable)
+            collector = SensorRowCollector(checker)
+            collector.add_rows(db_conn.query(query_string))
+        sensor_data_group = collector.sensor_data_group(sensor_id_lookup,
+                                                        db_conn)
+        return sensor_data_group, data_group_size(sensor_data_group)
 
-            if info['value']:
-                reading_ok,value = checker.check(
-                    info['reading'],
-                    info['units'],
-                    info['value']
-                            )
-                if reading_ok:
-                    __sensor_data[info['sensor_id']][info['reading']]['data'].append([
-                        datetime.datetime.strptime(info['timestamp'].split('.')[0],
-                                                    DATETIME_STRFORMAT),
-                        float(value)
-                        ])
-                    __variable_data[info['reading']].append(float(value))
-        sensor_data =[]
-        for sensor_id, sensor_readings in __sensor_data.iteritems():
-            data_list = []
-            for data in sensor_readings.values():
-                if data['data']:
-                    data_list.append(Data(data['variable'], data['data']))
-            sensor_data.append(SensorData(
-                                sensor_id_lookup[sensor_id],
-                                data_list
-                                ))
-
-        return SensorDataGroup(sensor_data,__variable_data,variables.values())
+    def __sharded_collect(self, checker, sensors_id, starttime, endtime,
+                          variable, workers, shard_size, time_shards):
+        db_conn = self.sensorgroup.sensorweb.database_connection
+        # time shards outermost so each sensor's shards merge in time order
+        queries = []
+        for time_clause in time_range_clauses(db_conn, starttime, endtime,
+                                              time_shards):
+            for i in range(0, len(sensors_id), shard_size):
+                queries.append(sensor_data_query(db_conn,
+                                                 sensors_id[i:i + shard_size],
+                                                 starttime, endtime, variable,
+                                                 time_clause))
+        def collect(query_string):
+            shard_collector = SensorRowCollector(checker)
+            shard_collector.add_rows(db_conn.query(query_string))
+            return shard_collector
+        workers = min(workers, len(queries), db_conn.max_connections)
+        pool = ThreadPool(max(workers, 1))
+        try:
+            shard_collectors = pool.map(collect, queries)
+        finally:
+            pool.close()
+            pool.join()
+        collector = SensorRowCollector(checker)
+        for shard_collector in shard_collectors:
+            collector.merge(shard_collector)
+        return collector
     
+    def iter_get(self, starttime, endtime, variable=None,
+                 chunk_size=STREAM_CHUNK_SIZE, itersize=STREAM_ITERSIZE):
+        """streams the group's data between 2 times as SensorData blocks
+        holding one Data table of at most chunk_size readings"""
+        sensor_id_lookup = {}
+        for sensor in self.sensorgroup.sensors:
+            sensor_id_lookup[sensor.sensor_id] = sensor
+        query_string = sensor_data_query(self.sensorgroup.sensorweb.database_connection,
+                                         sensor_id_lookup.keys(), starttime,
+                                         endtime, variable)
+        for sensor_id, data in stream_data_blocks(
+                self.sensorgroup.sensorweb.database_connection,
+                query_string, chunk_size, itersize):
+            yield SensorData(sensor_id_lookup[sensor_id], [data])
+
+    def export(self, output, starttime, endtime, export_format='csv',
+               variable=None, proj=None, compress=None, progress=None,
+               itersize=exporters.EXPORT_ITERSIZE):
+        """streams the group's readings between 2 times to output, a file
+        name or file object, as csv, ndjson or geojson with the sensor
+        geometries, reprojected to proj when given. see exporters.export"""
+        sensorgroup = self.sensorgroup
+        if proj is None:
+            geoms = dict((sensor.sensor_id, sensor.geom)
+                         for sensor in sensorgroup.sensors)
+        else:
+            geoms = sensorgroup.geoms_transformed(proj)
+        db_conn = sensorgroup.sensorweb.database_connection
+        query_string = sensor_data_query(
+            db_conn, [sensor.sensor_id for sensor in sensorgroup.sensors],
+            starttime, endtime, variable)
+        return exporters.export(db_conn, query_string, output, export_format,
+                                geoms, compress, progress, itersize)
+
 class SensorGroup:
     """Class for group of sensors"""
     def __init__(self,sensorweb,_sensors):
@@ -293,6 +1283,50 @@ class SensorGroup:
             if sensor.type not in sensor_types:
                 sensor_types.append(sensor.type)
         return sensor_types
+    def add_many(self, readings, batch_size=BATCH_SIZE):
+        """adds readings for sensors in the group, one commit per batch.
+        readings are dicts with a sensor_id key plus the
+        SensorDataFunctions.add() argument names, or tuples of
+        (sensor_id, timestamp, reading, units, value, theme[, extra])"""
+        rows = (reading_args(reading) for reading in readings)
+        return insert_readings(self.sensorweb.database_connection, rows,
+                               batch_size)
+
+    def spatial_index(self,):
+        """SpatialIndex of the group's sensors, built on first use"""
+        cached = getattr(self, '_spatial_index', None)
+        if cached is None or cached[0] != len(self.sensors):
+            cached = (len(self.sensors), SpatialIndex(self.sensors))
+            self._spatial_index = cached
+        return cached[1]
+
+    def within_bbox(self, xmin, ymin, xmax, ymax):
+        """SensorGroup of the sensors inside the bbox, None when empty"""
+        sensors = self.spatial_index().within_bbox(xmin, ymin, xmax, ymax)
+        if sensors:
+            return SensorGroup(self.sensorweb, sensors)
+
+    def within_radius(self, x, y, radius):
+        sensors = self.spatial_index().within_radius(x, y, radius)
+        if sensors:
+            return SensorGroup(self.sensorweb, sensors)
+
+    def nearest(self, x, y, k=1):
+        """[(sensor, distance)] of the k sensors nearest x, y"""
+        return self.spatial_index().nearest(x, y, k)
+
+    def subscribe(self, variable, callback=None, cutoff=DEFAULT_CUTOFF):
+        """LiveSubscription holding the latest value of variable for each
+        sensor, loaded from the readings since cutoff and then updated as
+        readings are inserted"""
+        return LiveSubscription(self, variable, cutoff, callback)
+
+    def geoms_transformed(self, proj):
+        """reprojects every sensor geometry in the group, returns
+        {sensor_id: geojson}"""
+        return transform_sensor_geoms(self.sensorweb.database_connection,
+                                      self.sensors, proj)
+
     def sources(self,):
         sensor_sources= []
         for sensor in self.sensors:
@@ -300,6 +1334,64 @@ class SensorGroup:
                 sensor_sources.append(sensor.source)
         return sensor_sources
 
+def sensor_data_hstore(sensor_id, timestamp, reading, units, value, theme, extra):
+    """builds the hstore literal for a raw sensor reading"""
+    hstore = []
+    hstore.append('"sensor_id"=>"%s"' %(sensor_id,))
+    hstore.append('"timestamp"=>"%s"' %(timestamp,))
+    hstore.append('"reading"=>"%s"' %(reading,))
+    hstore.append('"units"=>"%s"' %(units,))
+    hstore.append('"value"=>"%s"' %(value,))
+    hstore.append('"theme"=>"%s"' %(theme,))
+    hstore.append('"raw"=>"True"' )
+    if extra:
+        for key, val in extra.items():
+            hstore.append('"%s"=>"%s"' %(key, val,))
+    return ','.join(hstore)
+
+def reading_args(reading, sensor_id=None):
+    """normalises a reading dict or tuple into
+    (sensor_id, timestamp, reading, units, value, theme, extra). a bound
+    sensor_id wins, a dict naming a different sensor is an error"""
+    if isinstance(reading, dict):
+        if sensor_id is None:
+            sensor_id = reading.get('sensor_id')
+        elif str(reading.get('sensor_id', sensor_id)) != str(sensor_id):
+            raise error.SensorError('reading for sensor %s added to sensor %s'
+                                    % (reading['sensor_id'], sensor_id))
+        return (sensor_id, reading['timestamp'],
+                reading['reading'], reading['units'], reading['value'],
+                reading['theme'], reading.get('extra') or {})
+    reading = tuple(reading)
+    if sensor_id is not None:
+        reading = (sensor_id,) + reading
+    if len(reading) == 6:
+        reading += ({},)
+    return reading
+
+def insert_readings(db_conn, rows, batch_size=BATCH_SIZE):
+    """writes (sensor_id, timestamp, reading, units, value, theme, extra)
+    rows as multi-row inserts, one commit and one new tag check per batch.
+    returns the number of rows written"""
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += _insert_reading_batch(db_conn, batch)
+            batch = []
+    if batch:
+        count += _insert_reading_batch(db_conn, batch)
+    return count
+
+def _insert_reading_batch(db_conn, batch):
+    db_conn.insert(db_tools.sensor_data_insert(
+        db_conn, [sensor_data_hstore(*row) for row in batch]))
+    db_tools.check_new_tags_many(db_conn,
+                                 set((row[2], row[3]) for row in batch))
+    invalidate_results(db_conn, set(row[0] for row in batch))
+    return len(batch)
+
 class SensorDataFunctions:
     def __init__(self,sensorid,db_connection):
         self.__sensor_id = sensorid
@@ -308,38 +1400,37 @@ class SensorDataFunctions:
         
     def add(self, timestamp, reading, units, value, theme, extra):
         """adds sensor data reading to database"""
-        hstore = []
-        hstore.append('"sensor_id"=>"%s"' %(self.__sensor_id,))
-        hstore.append('"timestamp"=>"%s"' %(timestamp,))
-        hstore.append('"reading"=>"%s"' %(reading,))
-        hstore.append('"units"=>"%s"' %(units,))
-        hstore.append('"value"=>"%s"' %(value,))
-        hstore.append('"theme"=>"%s"' %(theme,))
-        hstore.append('"raw"=>"True"' )
-        for key, val in extra.iteritems():
-            hstore.append('"%s"=>"%s"' %(key, val,))
-        insert_string = "insert into sensor_data (info) values ('%s')"\
-                                                        % (','.join(hstore),)
-        self.__db_conn.insert(insert_string)
+        hstore = sensor_data_hstore(self.__sensor_id, timestamp, reading,
+                                    units, value, theme, extra)
+        self.__db_conn.insert(db_tools.sensor_data_insert(self.__db_conn, [hstore]))
         db_tools.check_new_tags(self.__db_conn,reading,units)
+        invalidate_results(self.__db_conn, [self.__sensor_id])
+
+    def add_many(self, readings, batch_size=BATCH_SIZE):
+        """adds an iterable of readings to the database, one commit per batch.
+        readings are dicts with the add() argument names or tuples in the
+        add() argument order"""
+        rows = (reading_args(reading, self.__sensor_id) for reading in readings)
+        return insert_readings(self.__db_conn, rows, batch_size)
         
     def variables(self,
         start_time=datetime.datetime.now() - datetime.timedelta(hours=24),
         end_time=datetime.datetime.now()):
+        columns = db_tools.sensor_data_columns(self.__db_conn)
         query_string = "select distinct(info->'reading') from sensor_data \
-        where sensor_int_id_caster(info -> 'sensor_id'::text) = %s and\
-         proper_timestamp(info->'timestamp') > '%s' \
-        and proper_timestamp(info->'timestamp') < '%s'" % \
-        (self.__sensor_id,start_time,end_time)
+        where %s = %s and %s > '%s' and %s < '%s'" % \
+        (columns['sensor_id'],self.__sensor_id,columns['ts'],start_time,
+         columns['ts'],end_time)
         return [str(item[0]) for item in self.__db_conn.query(query_string)]
         
     def latest(self,):
         if self.__latest != False:
             return self.latest
 
-        query_string  =  " select proper_timestamp(info->'timestamp') from sensor_data \
-                                    where sensor_int_id_caster(info -> 'sensor_id'::text) = %s order by \
-                                    proper_timestamp(info->'timestamp') desc limit 2" % (self.__sensor_id)
+        columns = db_tools.sensor_data_columns(self.__db_conn)
+        query_string  =  " select %s from sensor_data where %s = %s \
+                            order by %s desc limit 2" % (columns['ts'],
+                            columns['sensor_id'], self.__sensor_id, columns['ts'])
         response = self.__db_conn.query(query_string)
         if response:
             self.__latest = response[0][0]
@@ -350,12 +1441,8 @@ class SensorDataFunctions:
         """retrieves all the data entries for a sensor between 2 times"""
         data_list = []
         _var_info = {}
-        query_string = "select hstore_to_matrix(info) from sensor_data where \
-                       proper_timestamp(info->'timestamp') \
-                        > '%s' and proper_timestamp(info->'timestamp') < '%s' \
-                         and sensor_int_id_caster(info -> 'sensor_id'::text) = %s\
-                         and not info?'flag' order by proper_timestamp(info->'timestamp')" \
-                        % (starttime, endtime, self.__sensor_id,)
+        query_string = sensor_data_query(self.__db_conn, [self.__sensor_id],
+                                         starttime, endtime)
                         
         for row in self.__db_conn.query(query_string):
             
@@ -363,36 +1450,44 @@ class SensorDataFunctions:
             
             units = db_tools.default_units(self.__db_conn,info['reading'])
             
-            variable = Variable(info['reading'], units, info['theme'])
-            _var_info[info['reading']] = _var_info.get(info['reading'],
-                                               {'variable':variable,'data':[]})
+            if info['reading'] not in _var_info:
+                variable = Variable(info['reading'], units, info['theme'])
+                _var_info[info['reading']] = DataBuffer(variable)
             if info['value']:
                 reading_ok,value = db_tools.check_reading(self.__db_conn,info['reading'],
                                                         info['units'],info['value'])
                 if reading_ok:
-                    _var_info[info['reading']]['data'].append([
-                        datetime.datetime.strptime(info['timestamp'].split('.')[0],
-                                                    DATETIME_STRFORMAT),
-                        float(value)
-                        ])
+                    _var_info[info['reading']].append(
+                        parse_timestamp(info['timestamp']), value)
         
         for data in _var_info.values():
-            if data['data']:
-                data_list.append(Data(data['variable'], data['data']))
+            if data:
+                data_list.append(data.data())
         return data_list
     
+    def iter_get(self, starttime, endtime, variable=None,
+                 chunk_size=STREAM_CHUNK_SIZE, itersize=STREAM_ITERSIZE):
+        """streams the data entries for a sensor between 2 times as Data
+        blocks of at most chunk_size readings"""
+        query_string = sensor_data_query(self.__db_conn, [self.__sensor_id],
+                                         starttime, endtime, variable)
+        for sensor_id, data in stream_data_blocks(self.__db_conn, query_string,
+                                                  chunk_size, itersize):
+            yield data
+
     def add_from_dict(self,readings_dict):
-        for name,info in readings_dict.iteritems():
-            if 'extra' not in info.keys():
-                info['extra'] ={}
-            self.add(info['timestamp'],name,info['units'],info['value'],info['theme'],info['extra'])
+        readings = []
+        for name,info in readings_dict.items():
+            readings.append((info['timestamp'], name, info['units'],
+                            info['value'], info['theme'], info.get('extra',{})))
+        self.add_many(readings)
     
 class Sensor:
     """Sensor class"""
     def __init__(self, database_connection, _name,
                                 _sensor_id,_geom, 
                                     _active, _source,
-                                    _type, _extra):
+                                    _type, _extra, _geojson=None):
         self.__database = database_connection
         self.sensor_id = _sensor_id
         
@@ -402,22 +1497,48 @@ class Sensor:
         self.source = _source
         self.type = _type
         self._raw_geom = _geom
-        
-        query_string = "select ST_AsGeoJSON('%s')" % (_geom,)
-        query_results = self.__database.query(query_string)
-        self.geom = simplejson.loads(query_results[0][0])
+        self._geom = None
+        if _geojson:
+            self._geom = simplejson.loads(_geojson)
         self.extra_info = _extra
         
         self.data = SensorDataFunctions(self.sensor_id,self.__database)
+
+    @property
+    def geom(self,):
+        """GeoJSON geometry, decoded on first use when it was not loaded
+        with the sensor, by the database unless it is EWKB"""
+        if self._geom is None:
+            try:
+                self._geom = geometry.from_ewkb(self._raw_geom)[0]
+                return self._geom
+            except error.SensorError:
+                pass
+            query_string = "select ST_AsGeoJSON('%s')" % (self._raw_geom,)
+            query_results = self.__database.query(query_string)
+            self._geom = simplejson.loads(query_results[0][0])
+        return self._geom
         
     def geom_transformed(self,proj):
+        key = (self.sensor_id, self._raw_geom, str(proj))
+        geom = TRANSFORMED_GEOMS.get(key)
+        if geom is TRANSFORM_FAILED:
+            return None
+        if geom is not None:
+            return geom
         try:
             geom_text = "ST_Transform('%s'::geometry, %s)"% (self._raw_geom,proj)
             query_string = "select ST_AsGeoJSON(%s)" % geom_text
             query_results = self.__database.query(query_string)
-            return simplejson.loads(query_results[0][0])
-        except:
+        except NameError:
+            # the database may just be unavailable, so try again next time
             return None
+        if not query_results[0][0]:
+            TRANSFORMED_GEOMS.set(key, TRANSFORM_FAILED)
+            return None
+        geom = simplejson.loads(query_results[0][0])
+        TRANSFORMED_GEOMS.set(key, geom)
+        return geom
         
     def link(self,):
         """links sensor to the database"""
@@ -433,12 +1554,13 @@ class Sensor:
         insert_string = "insert into sensors ( info)  values ('%s')" \
                                                         % (','.join(hstore),)
         self.__database.insert(insert_string)
+        invalidate_sensor_index(self.__database)
         
     def update(self, infodict):
         """updates sensor information"""
         hstore = []
         
-        for key, val in infodict.iteritems():
+        for key, val in infodict.items():
             
             hstore.append('"%s"=>"%s"' %(key, val,))
         
@@ -446,6 +1568,7 @@ class Sensor:
                             where info ->'name' = '%s' " \
                             % (','.join(hstore), self.name)
         self.__database.insert(insert_string)
+        invalidate_sensor_index(self.__database)
     
     def json(self,):
         """return json of sensor object"""
@@ -455,29 +1578,105 @@ class Sensor:
         
 
         
+class DataBuffer:
+    """accumulates readings for a Data table in flat arrays"""
+    def __init__(self, _var):
+        self.var = _var
+        self.times = array.array('d')
+        self.values = array.array('d')
+
+    def __len__(self,):
+        return len(self.values)
+
+    def append(self, timestamp, value):
+        self.times.append(sensor_tools.datetime_to_epoch_ms(timestamp))
+        self.values.append(float(value))
+
+    def extend(self, other):
+        self.times.extend(other.times)
+        self.values.extend(other.values)
+
+    def data(self,):
+        return Data.from_arrays(self.var, self.times, self.values)
+
 class Data:
-    """Data entry for sensor"""
+    """Data entry for sensor, held as an int64 epoch millisecond array
+    and a float64 value array in time order"""
     def __init__(self, _var, _data):
         self.var = _var
-        self.data = _data
-        self.values = [item[1] for item in self.data]
-        self.timesteps = [item[0] for item in self.data]
-        
+        self.time_array = numpy.array(
+            [sensor_tools.datetime_to_epoch_ms(item[0]) for item in _data],
+            dtype=numpy.int64)
+        self.value_array = numpy.array([item[1] for item in _data],
+                                       dtype=numpy.float64)
+
+    @classmethod
+    def from_arrays(cls, _var, times, values):
+        """builds a Data entry from epoch millisecond times and values"""
+        data = cls(_var, [])
+        data.time_array = numpy.asarray(times, dtype=numpy.int64)
+        data.value_array = numpy.asarray(values, dtype=numpy.float64)
+        return data
+
+    def __len__(self,):
+        return len(self.value_array)
+
+    @property
+    def timesteps(self,):
+        return [sensor_tools.epoch_ms_to_datetime(item)
+                for item in self.time_array.tolist()]
+
+    @property
+    def values(self,):
+        return self.value_array.tolist()
+
+    @property
+    def data(self,):
+        return [list(item) for item in zip(self.timesteps, self.values)]
+
+    def statistics(self,):
+        """stats.RunningStats of the values"""
+        return stats.RunningStats.from_values(self.value_array)
+
+    def sketch(self, relative_accuracy=stats.SKETCH_ACCURACY):
+        """stats.QuantileSketch of the values"""
+        sketch = stats.QuantileSketch(relative_accuracy)
+        sketch.add_many(self.value_array)
+        return sketch
+
     def latest_time(self,):
         """return latest reading time"""
-        return self.data[-1][0]
+        return sensor_tools.epoch_ms_to_datetime(int(self.time_array[-1]))
         
     def live(self,):
         """return latest data value"""
-        return self.data[-1][1]
+        return float(self.value_array[-1])
+
+    def min(self,):
+        return float(self.value_array.min())
+
+    def max(self,):
+        return float(self.value_array.max())
+
+    def mean(self,):
+        return float(self.value_array.mean())
+
+    def between(self, starttime, endtime):
+        """returns the readings with starttime <= time < endtime,
+        times are datetimes or epoch milliseconds"""
+        if isinstance(starttime, datetime.datetime):
+            starttime = sensor_tools.datetime_to_epoch_ms(starttime)
+        if isinstance(endtime, datetime.datetime):
+            endtime = sensor_tools.datetime_to_epoch_ms(endtime)
+        start, end = self.time_array.searchsorted([starttime, endtime])
+        return Data.from_arrays(self.var, self.time_array[start:end],
+                                self.value_array[start:end])
         
     def json(self,):
         """creates json from data entry"""
-        _json_data = []
-        for row in self.data:
-            _json_data.append([sensor_tools.timestamp_to_timedelta(row[0]),
-                                                                    row[1]])
-        return _json_data
+        seconds = self.time_array // 1000 * 1000
+        return [list(item) for item in zip(seconds.tolist(),
+                                           self.value_array.tolist())]
         
 class Variable:
     """variable"""
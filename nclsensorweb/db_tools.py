@@ -1,99 +1,430 @@
 import nclsensorweb.tools as tools
+import datetime
+import threading
+import time
 
-class ReadingChecker:
-    def __init__(self,db_connection):
+READING_CATALOGUE_TTL = 300
+
+TAG_VOCABULARY_TTL = 300
+
+TAG_MATCH_DISTANCE = 4
+
+READINGS_QUERY = "select reading_name,default_units, \
+ hstore_to_matrix(unit_conversion) from readings"
+
+NUMERIC_PATTERN = '^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?$'
+
+def converted_value_sql(table='sensor_data'):
+    """SQL expression for a sensor_data value in its reading's default
+    units, needs readings joined on the reading name. null when the value
+    is not numeric or the units have no conversion"""
+    return "case when not %(table)s.info->'value' ~ '%(pattern)s' then null \
+     when %(table)s.info->'units' = readings.default_units \
+     then (%(table)s.info->'value')::float \
+     when readings.unit_conversion ? (%(table)s.info->'units') \
+     then (readings.unit_conversion->(%(table)s.info->'units'))::float \
+      * (%(table)s.info->'value')::float end" % {'table':table,
+                                                 'pattern':NUMERIC_PATTERN}
+
+class ReadingCatalogue:
+    """cache of the readings table shared by everything using a database
+    connection. reloaded when older than ttl seconds or after invalidate(),
+    version counts the reloads. without a db_connection it never queries
+    and is only filled through load()"""
+    def __init__(self, db_connection, ttl=READING_CATALOGUE_TTL):
         self.__db_conn = db_connection
-        query_string = "select reading_name,default_units, \
-        hstore_to_matrix(unit_conversion) from readings"
-        self.__units_converter = {}
-        self.default_units = {}
-        for row in self.__db_conn.query(query_string):
-            self.default_units[row[0]] = row[1]
+        self.ttl = ttl
+        self.version = 0
+        self.__lock = threading.Lock()
+        self.__loaded_at = None
+        self.__snapshot = ({}, {})
+
+    def invalidate(self,):
+        """forces a reload on next use, e.g. after editing readings"""
+        with self.__lock:
+            self.__loaded_at = None
+
+    def expired(self,):
+        return self.__loaded_at is None or \
+             time.time() - self.__loaded_at > self.ttl
+
+    def __load(self, rows):
+        default_units = {}
+        units_converter = {}
+        for row in rows:
+            default_units[row[0]] = row[1]
+            units_converter[row[0]] = {}
             if row[2]:
-               self.__units_converter[row[0]] = dict(row[2])
-        
-    def check(self,reading_name,units,reading_value):
-        try:
-            float(reading_value)
-        except:
-            return (False,None,)
-        if reading_name not in self.default_units.keys():
-            return (False,None,)
-        if units == self.default_units[reading_name]:
-            return (True,float(reading_value))
-        if units not in self.__units_converter[reading_name].keys():
-            return (False,None,)
-        return (True,float(self.__units_converter[reading_name][units])* float(reading_value),)
-        
+                units_converter[row[0]] = dict(row[2])
+        self.__snapshot = (default_units, units_converter)
+        self.__loaded_at = time.time()
+        self.version += 1
 
+    def load(self, rows):
+        """replaces the cache with rows of READINGS_QUERY"""
+        with self.__lock:
+            self.__load(rows)
 
-def check_tag(db_connection,table_name,tag_name,tag_value):
-    query_string = "select info->'%s' from tags where table_name = '%s'" \
-                    % (tag_name,table_name)
-    existing_tags = db_connection.query(query_string)[0][0].strip('{}')
-    existing_tags = existing_tags.replace('"','')
-    existing_tags = existing_tags.split(',')
-    tag_scores = {}
-    for ex_tag in existing_tags:
-        tag_scores[tools.levenshtein(ex_tag,tag_value)] = ex_tag
-    min_score = min(tag_scores.keys())
-    if min_score < 4:
-
-        return False,tag_scores[min_score]
-    
-    return True,' '.join([part.capitalize() for part in tag_value.split(' ')])
+    def snapshot(self,):
+        """returns the current (default_units, units_converter) dicts"""
+        with self.__lock:
+            if self.__db_conn is not None and self.expired():
+                self.__load(self.__db_conn.query(READINGS_QUERY))
+            return self.__snapshot
 
-def check_reading(db_connection,reading_name,units,reading_value):
+    def default_units(self, reading_name):
+        return self.snapshot()[0].get(reading_name)
+
+    def known_units(self, reading_name):
+        """default and convertible units for a reading, None for a new
+        reading"""
+        default_units, units_converter = self.snapshot()
+        if reading_name not in default_units:
+            return None
+        return [str(default_units[reading_name])] + \
+                [str(units) for units in units_converter[reading_name].keys()]
+
+    def check(self, reading_name, units, reading_value):
+        default_units, units_converter = self.snapshot()
+        return convert_reading(default_units, units_converter,
+                               reading_name, units, reading_value)
+
+def convert_reading(default_units, units_converter, reading_name, units,
+                    reading_value):
+    """returns (reading_ok, value in default units)"""
     try:
         float(reading_value)
     except:
         return (False,None,)
-    query_string = "select default_units, hstore_to_matrix(unit_conversion)\
-     from readings where reading_name = '%s'" %(
-    reading_name,)
-    reading_info = db_connection.query(query_string)
-    if not reading_info:
-        
+    if reading_name not in default_units:
         return (False,None,)
-    reading_info = reading_info[0]
-    default_units = reading_info[0]
-    units_conversion = {}
-    if reading_info[1]:
-        units_conversion = dict(reading_info[1])
-    if units == default_units:
+    if units == default_units[reading_name]:
         return (True,float(reading_value))
-    if units not in units_conversion.keys():
+    if units not in units_converter.get(reading_name, {}):
         return (False,None,)
-    return (True,float(units_conversion[units])* float(reading_value),)
+    return (True,float(units_converter[reading_name][units])* float(reading_value),)
+
+def reading_catalogue(db_connection):
+    """returns the ReadingCatalogue shared by a database connection"""
+    catalogue = getattr(db_connection, 'reading_catalogue', None)
+    if catalogue is None:
+        with _CATALOGUE_LOCK:
+            catalogue = getattr(db_connection, 'reading_catalogue', None)
+            if catalogue is None:
+                catalogue = ReadingCatalogue(db_connection)
+                db_connection.reading_catalogue = catalogue
+    return catalogue
+
+_CATALOGUE_LOCK = threading.Lock()
+
+class ReadingChecker:
+    """unit checker over a snapshot of the reading catalogue"""
+    def __init__(self,db_connection):
+        catalogue = reading_catalogue(db_connection)
+        self.default_units, self.__units_converter = catalogue.snapshot()
+        self.version = catalogue.version
+        
+    def check(self,reading_name,units,reading_value):
+        return convert_reading(self.default_units, self.__units_converter,
+                               reading_name, units, reading_value)
+        
+
+
+class BKTree:
+    """metric index of strings under tools.levenshtein, each word keeps
+    the order it was last added in"""
+    def __init__(self, words=()):
+        # nodes are [word, order, {distance: child}]
+        self.root = None
+        for order, word in enumerate(words):
+            self.add(word, order)
+
+    def add(self, word, order):
+        node = [word, order, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = tools.levenshtein(word, current[0])
+            if distance == 0:
+                current[1] = order
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, word, max_distance):
+        """(distance, order, word) of the words within max_distance,
+        skipping subtrees the triangle inequality rules out"""
+        found = []
+        stack = []
+        if self.root is not None:
+            stack.append(self.root)
+        while stack:
+            node = stack.pop()
+            distance = tools.levenshtein(word, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1], node[0]))
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return found
+
+class TagVocabulary:
+    """cache of a tag's values in the tags table indexed in a BKTree,
+    with the matches of check_tag memoised. reloaded when older than ttl
+    seconds or after invalidate()"""
+    def __init__(self, db_connection, table_name, tag_name,
+                 ttl=TAG_VOCABULARY_TTL):
+        self.__db_conn = db_connection
+        self.table_name = table_name
+        self.tag_name = tag_name
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__loaded_at = None
+        self.__tree = None
+        self.__matches = {}
+
+    def invalidate(self,):
+        with self.__lock:
+            self.__loaded_at = None
+
+    def __load(self,):
+        query_string = "select info->'%s' from tags where table_name = '%s'" \
+                        % (self.tag_name,self.table_name)
+        existing_tags = self.__db_conn.query(query_string)[0][0].strip('{}')
+        existing_tags = existing_tags.replace('"','')
+        self.__tree = BKTree(existing_tags.split(','))
+        self.__matches = {}
+        self.__loaded_at = time.time()
+
+    def match(self, tag_value):
+        """check_tag result for tag_value"""
+        with self.__lock:
+            if self.__loaded_at is None or \
+             time.time() - self.__loaded_at > self.ttl:
+                self.__load()
+            if tag_value not in self.__matches:
+                found = self.__tree.search(tag_value, TAG_MATCH_DISTANCE - 1)
+                if found:
+                    # nearest tag, the last listed on ties
+                    self.__matches[tag_value] = (False, max(
+                        found, key=lambda item: (-item[0], item[1]))[2])
+                else:
+                    self.__matches[tag_value] = (True, ' '.join(
+                        [part.capitalize() for part in tag_value.split(' ')]))
+            return self.__matches[tag_value]
+
+def tag_vocabulary(db_connection, table_name, tag_name):
+    """returns the TagVocabulary of a tag shared by a database connection"""
+    with _CATALOGUE_LOCK:
+        vocabularies = getattr(db_connection, 'tag_vocabularies', None)
+        if vocabularies is None:
+            vocabularies = {}
+            db_connection.tag_vocabularies = vocabularies
+        key = (table_name, tag_name)
+        if key not in vocabularies:
+            vocabularies[key] = TagVocabulary(db_connection, table_name,
+                                              tag_name)
+        return vocabularies[key]
+
+def invalidate_tags(db_connection, table_name=None):
+    """forces the tag vocabularies of a table, or all, to reload"""
+    with _CATALOGUE_LOCK:
+        vocabularies = list(getattr(db_connection, 'tag_vocabularies', {}).values())
+    for vocabulary in vocabularies:
+        if table_name is None or vocabulary.table_name == table_name:
+            vocabulary.invalidate()
+
+def check_tag(db_connection,table_name,tag_name,tag_value):
+    """returns (new tag, tag value), the value of the closest existing tag
+    within TAG_MATCH_DISTANCE edits, otherwise tag_value capitalised"""
+    return tag_vocabulary(db_connection, table_name, tag_name).match(tag_value)
+
+def add_new_tag(db_connection,table_name,tag_name,tag_value):
+    """records a tag value in new_tags"""
+    query_string = "update new_tags set info = case  when info is not null \
+     then info||hstore('%s','%s') else hstore('%s','%s') end  \
+     where table_name = '%s'" % (tag_name,tag_value,tag_name,tag_value,
+                                  table_name)
+    db_connection.insert(query_string)
+    invalidate_tags(db_connection, table_name)
+
+def check_reading(db_connection,reading_name,units,reading_value):
+    return reading_catalogue(db_connection).check(reading_name, units,
+                                                  reading_value)
 
 def default_units(db_conn,reading_name):
-    query_string = "select default_units from readings \
-     where reading_name = '%s'" %(
-    reading_name,)
-    return db_conn.query(query_string)[0][0]
+    return reading_catalogue(db_conn).default_units(reading_name)
 
 
 def check_new_tags(db_conn,reading_name,units):
-    query_string = "select default_units,akeys(unit_conversion)\
-     from readings where reading_name = '%s'" %(
-    reading_name,)
-    reading_info = db_conn.query(query_string)
-    new_reading = reading_info == []
-    new_units = True
-    if not new_reading:
-        existing_units = [str(reading_info[0][0])]
-        if reading_info[0][1]:
-            existing_units += [str(item) for item in list(reading_info[0][1])]
-        new_units = units not in existing_units
-    if new_units:
-        query_string = "insert into new_reading \
-         (reading_name,units, new_reading) values ('%s','%s',%s)" %\
-        ( reading_name,units,new_reading)
+    check_new_tags_many(db_conn, [(reading_name, units)])
+
+def check_new_tags_many(db_conn,reading_units):
+    """check_new_tags for a set of (reading_name, units) pairs with a
+    single insert"""
+    query_string = new_reading_insert(reading_catalogue(db_conn), reading_units)
+    if query_string:
         db_conn.insert(query_string)
+
+def new_reading_insert(catalogue, reading_units):
+    """builds the new_reading insert for the (reading_name, units) pairs
+    missing from the catalogue, None when all are known"""
+    new_rows = []
+    for reading_name, units in sorted(set(reading_units)):
+        existing_units = catalogue.known_units(reading_name)
+        new_reading = existing_units is None
+        if new_reading or units not in existing_units:
+            new_rows.append("('%s','%s',%s)" % (reading_name,units,new_reading))
+    if new_rows:
+        return "insert into new_reading \
+         (reading_name,units, new_reading) values %s" % (','.join(new_rows),)
         
 def get_tag_values(db_conn,table,tag):
     """retrieves all the entries with the tag"""
     query_string = "select array_agg(distinct(info->'%s')) from %s" %(tag,table,)
     response = db_conn.query(query_string)
     if response:
-        return [str(item) for item in response[0][0]]
\ No newline at end of file
+        return [str(item) for item in response[0][0]]
+
+ROLLUPS = (
+    ('sensor_data_rollup_day', datetime.timedelta(days=1)),
+    ('sensor_data_rollup_hour', datetime.timedelta(hours=1)),
+    ('sensor_data_rollup_5min', datetime.timedelta(minutes=5)),
+)
+
+ROLLUP_TASK = 'rollups'
+
+def timedelta_seconds(timedelta):
+    return timedelta.days * 24 * 3600 + timedelta.seconds
+
+def rollup_for(timedelta):
+    """returns the coarsest (table, width) rollup that can answer averages
+    over timedelta buckets. date_round rounds to the nearest bucket, so
+    timedelta has to be a multiple of twice the rollup width for every
+    rollup bucket to fall into a single timedelta bucket"""
+    if not isinstance(timedelta, datetime.timedelta):
+        return None
+    seconds = timedelta_seconds(timedelta)
+    if timedelta.microseconds or not seconds:
+        return None
+    for table, width in ROLLUPS:
+        if seconds % (2 * timedelta_seconds(width)) == 0:
+            return table, width
+    return None
+
+def rollup_bucket_sql(timestamp_sql, width):
+    """SQL flooring a timestamp to the start of its rollup bucket"""
+    return "'epoch'::timestamp + floor(extract(epoch from %s) / %s) * %s \
+     * interval '1 second'" % (timestamp_sql, timedelta_seconds(width),
+                               timedelta_seconds(width))
+
+def rollup_status(db_conn):
+    """returns (last rolled up sensor__data_id, refresh time) or None when
+    the rollups have never been refreshed"""
+    try:
+        response = db_conn.query("select last_id, updated from maintenance_state \
+        where task_name = '%s'" % (ROLLUP_TASK,))
+    except NameError:
+        return None
+    if response:
+        return response[0]
+    return None
+
+
+TYPED_COLUMNS_MIGRATION = 'typed_sensor_data_columns'
+
+TYPED_BACKFILL_MIGRATION = 'typed_sensor_data_backfill'
+
+NOTIFY_MIGRATION = 'sensor_data_notify'
+
+SENSOR_ID_MIGRATION = 'sensor_int_id_sequence'
+
+SENSOR_ID_SEQUENCE = 'sensor_int_id_seq'
+
+NOTIFY_CHANNEL = 'sensor_data_insert'
+
+MIGRATIONS_TTL = 60
+
+MIGRATIONS_QUERY = "select name from schema_migrations"
+
+HSTORE_COLUMNS = {
+    'ts':"proper_timestamp(sensor_data.info->'timestamp')",
+    'sensor_id':"sensor_int_id_caster(sensor_data.info -> 'sensor_id'::text)",
+    'reading':"sensor_data.info->'reading'",
+    'not_flagged':"not sensor_data.info?'flag'",
+    'raw':"sensor_data.info -> 'raw' = 'True'",
+}
+
+TYPED_COLUMNS = {
+    'ts':"sensor_data.ts",
+    'sensor_id':"sensor_data.sensor_id",
+    'reading':"sensor_data.reading",
+    'not_flagged':"sensor_data.flag is not true",
+    'raw':"sensor_data.raw",
+}
+
+def applied_migrations(db_conn):
+    """names of the applied schema migrations, cached on the connection
+    for MIGRATIONS_TTL seconds"""
+    cached = getattr(db_conn, 'applied_migrations', None)
+    if cached and time.time() - cached[0] < MIGRATIONS_TTL:
+        return cached[1]
+    try:
+        applied = set(row[0] for row in db_conn.query(MIGRATIONS_QUERY))
+    except NameError:
+        applied = set()
+    db_conn.applied_migrations = (time.time(), applied)
+    return applied
+
+def forget_migrations(db_conn):
+    """drops the cached migration list after running a migration"""
+    db_conn.applied_migrations = None
+
+def sensor_data_columns(db_conn, applied=None):
+    """SQL for the hot sensor_data filters, the typed columns once they
+    have been backfilled, otherwise the hstore expressions. applied, the
+    migration names, saves looking them up on db_conn"""
+    if applied is None:
+        applied = applied_migrations(db_conn)
+    if TYPED_BACKFILL_MIGRATION in applied:
+        return TYPED_COLUMNS
+    return HSTORE_COLUMNS
+
+def typed_values_sql(info):
+    """SQL for the typed column values of a sensor_data hstore, in
+    sensor_id, ts, reading, units, value, flag, raw order"""
+    return "sensor_int_id_caster(%(info)s -> 'sensor_id'::text), \
+     proper_timestamp(%(info)s->'timestamp'), \
+     %(info)s->'reading', %(info)s->'units', \
+     case when %(info)s->'value' ~ '%(pattern)s' then (%(info)s->'value')::float end, \
+     %(info)s ? 'flag', %(info)s -> 'raw' = 'True'" % {'info':info,
+                                                      'pattern':NUMERIC_PATTERN}
+
+def sensor_data_insert(db_conn, hstores, applied=None):
+    """builds the insert for sensor_data hstore literals, filling the typed
+    columns too once they exist. applied as for sensor_data_columns"""
+    values = ','.join(["('%s'::hstore)" % (hstore,) for hstore in hstores])
+    if applied is None:
+        applied = applied_migrations(db_conn)
+    if TYPED_COLUMNS_MIGRATION not in applied:
+        return "insert into sensor_data (info) values %s" % (values,)
+    return "insert into sensor_data \
+     (info, sensor_id, ts, reading, units, value, flag, raw) \
+     select info, %s from (values %s) as new_rows (info)" % (
+     typed_values_sql('info'), values)
+
+def allocate_sensor_ids(db_conn, count):
+    """reserves count new sensor ids in one query, from the sensor id
+    sequence once it exists, otherwise after the current maximum"""
+    if SENSOR_ID_MIGRATION in applied_migrations(db_conn):
+        return [row[0] for row in db_conn.query(
+            "select nextval('%s') from generate_series(1, %s)"
+            % (SENSOR_ID_SEQUENCE, count))]
+    query_string = "select max(sensor_int_id_caster(info -> 'sensor_int_id'::text) ) from sensors"
+    last_id = db_conn.query(query_string)[0][0] or 0
+    return range(last_id + 1, last_id + count + 1)
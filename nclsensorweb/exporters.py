@@ -0,0 +1,125 @@
+"""Streaming exports of sensor_data as CSV, NDJSON or GeoJSON. rows are
+read from a server side cursor and written as they arrive, so memory does
+not grow with the size of the export"""
+import simplejson
+import nclsensorweb.tools as sensor_tools
+import nclsensorweb.db_tools as db_tools
+import nclsensorweb.errors as error
+import csv
+import gzip
+import time
+
+EXPORT_FORMATS = ('csv', 'ndjson', 'geojson')
+
+EXPORT_ITERSIZE = 5000
+
+PROGRESS_INTERVAL = 5
+
+CSV_HEADER = ['sensor_id', 'timestamp', 'reading', 'units', 'value', 'x', 'y']
+
+def export_rows(db_conn, query_string, itersize=EXPORT_ITERSIZE):
+    """yields (sensor_id, timestamp, reading, units, value) of the rows of
+    a sensor_data query in query order, converted to the default units.
+    readings that fail the check are skipped"""
+    checker = db_tools.ReadingChecker(db_conn)
+    for row in db_conn.stream(query_string, itersize):
+        info = dict(row[0])
+        if not info.get('value'):
+            continue
+        reading_ok, value = checker.check(info['reading'], info['units'],
+                                          info['value'])
+        if reading_ok:
+            yield (info['sensor_id'], info['timestamp'].split('.')[0],
+                   info['reading'], checker.default_units[info['reading']],
+                   value)
+
+class Progress:
+    """calls callback(rows, rows_per_second) at most every interval
+    seconds and once when finished"""
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.rows = 0
+        self.started = time.time()
+        self.__reported = self.started
+
+    def rate(self,):
+        elapsed = time.time() - self.started
+        if elapsed > 0:
+            return self.rows / elapsed
+        return 0.0
+
+    def add(self, rows=1):
+        self.rows += rows
+        if self.callback is not None and \
+         time.time() - self.__reported >= self.interval:
+            self.__reported = time.time()
+            self.callback(self.rows, self.rate())
+
+    def finish(self,):
+        if self.callback is not None:
+            self.callback(self.rows, self.rate())
+        return self.rows
+
+def point_coordinates(geom):
+    """[x, y] of a point geometry, [None, None] for anything else"""
+    if geom and geom.get('type') == 'Point':
+        return list(geom['coordinates'][:2])
+    return [None, None]
+
+def write_csv(outfile, rows, geoms, progress):
+    mycsv = csv.writer(outfile)
+    mycsv.writerow(CSV_HEADER)
+    for row in rows:
+        mycsv.writerow(list(row) + point_coordinates(geoms.get(row[0])))
+        progress.add()
+
+def write_ndjson(outfile, rows, geoms, progress):
+    for row in rows:
+        record = dict(zip(CSV_HEADER[:5], row))
+        record['geom'] = geoms.get(row[0])
+        outfile.write(simplejson.dumps(record))
+        outfile.write('\n')
+        progress.add()
+
+def write_geojson(outfile, rows, geoms, progress):
+    """a FeatureCollection written one feature at a time"""
+    outfile.write('{"type": "FeatureCollection", "features": [')
+    separator = ''
+    for row in rows:
+        feature = {'type':'Feature', 'id':row[0], 'geometry':geoms.get(row[0]),
+                   'properties':dict(zip(CSV_HEADER[:5], row))}
+        outfile.write(separator)
+        outfile.write(simplejson.dumps(feature))
+        separator = ','
+        progress.add()
+    outfile.write(']}')
+
+WRITERS = {'csv':write_csv, 'ndjson':write_ndjson, 'geojson':write_geojson}
+
+def export(db_conn, query_string, output, export_format='csv', geoms=None,
+           compress=None, progress=None, itersize=EXPORT_ITERSIZE):
+    """writes the rows of a sensor_data query to output, a file name or a
+    file object, and returns the number of rows written. output is
+    gzipped when compress is set or it is a file name ending in .gz, file
+    objects are left open. geoms is {sensor_id: geojson}, progress is
+    called with (rows, rows_per_second)"""
+    if export_format not in WRITERS:
+        raise error.SensorError('unknown export format %s' % (export_format,))
+    geoms = dict((str(sensor_id), geom) for sensor_id, geom in
+                 (geoms or {}).items())
+    counter = Progress(progress)
+    rows = export_rows(db_conn, query_string, itersize)
+    if not hasattr(output, 'write'):
+        outfile = sensor_tools.open_output(output, compress)
+    elif compress:
+        # closing the GzipFile writes the trailer but leaves output open
+        outfile = gzip.GzipFile(fileobj=output, mode='wb')
+    else:
+        WRITERS[export_format](output, rows, geoms, counter)
+        return counter.finish()
+    try:
+        WRITERS[export_format](outfile, rows, geoms, counter)
+    finally:
+        outfile.close()
+    return counter.finish()
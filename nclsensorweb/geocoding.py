@@ -0,0 +1,132 @@
+"""Persistent geocode cache and offline gazetteer for placename lookups"""
+import nclsensorweb.db_tools as db_tools
+import bisect
+import csv
+import re
+import sqlite3
+import threading
+import time
+
+GEOCODE_CACHE_TTL = 30 * 24 * 3600
+
+GAZETTEER_DISTANCE = 2
+
+def normalise_placename(placename):
+    """lower case words of a placename without punctuation"""
+    return ' '.join(re.sub(r'[^\w]+', ' ', placename.lower()).split())
+
+class GeocodeCache:
+    """sqlite file of geocoded placenames keyed by normalised name,
+    entries older than ttl seconds are ignored and replaced"""
+    def __init__(self, path, ttl=GEOCODE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock:
+            self.__conn.execute("create table if not exists geocodes ( \
+                key text primary key, lat real, lon real, stored real)")
+            self.__conn.commit()
+
+    def get(self, placename):
+        """(lat, lon) cached for placename, None when missing or expired"""
+        with self.__lock:
+            row = self.__conn.execute(
+                "select lat, lon from geocodes where key = ? and stored > ?",
+                (normalise_placename(placename), time.time() - self.ttl)).fetchone()
+        if row:
+            return row[0], row[1]
+
+    def set(self, placename, lat, lon):
+        with self.__lock:
+            self.__conn.execute(
+                "insert or replace into geocodes values (?, ?, ?, ?)",
+                (normalise_placename(placename), lat, lon, time.time()))
+            self.__conn.commit()
+
+    def purge(self,):
+        """deletes the expired entries"""
+        with self.__lock:
+            self.__conn.execute("delete from geocodes where stored <= ?",
+                                (time.time() - self.ttl,))
+            self.__conn.commit()
+
+    def close(self,):
+        with self.__lock:
+            self.__conn.close()
+
+class Gazetteer:
+    """offline placename index loaded from csv files of name, lat, lon
+    rows, queried by exact, prefix or fuzzy normalised name"""
+    def __init__(self, path=None):
+        self.__places = {}
+        self.__keys = []
+        self.__tree = db_tools.BKTree()
+        if path:
+            self.load(path)
+
+    def __len__(self,):
+        return len(self.__places)
+
+    def add(self, placename, lat, lon):
+        key = normalise_placename(placename)
+        if key not in self.__places:
+            bisect.insort(self.__keys, key)
+            self.__tree.add(key, len(self.__places))
+        self.__places[key] = (placename, float(lat), float(lon))
+
+    def load(self, path):
+        """adds the rows of a csv file, rows without numeric coordinates
+        such as a header are skipped, returns the number of places read"""
+        places = {}
+        with open(path) as gazetteer_file:
+            for row in csv.reader(gazetteer_file):
+                if len(row) < 3:
+                    continue
+                try:
+                    places[normalise_placename(row[0])] = (row[0], float(row[1]),
+                                                           float(row[2]))
+                except ValueError:
+                    continue
+        for key in sorted(places):
+            if key not in self.__places:
+                self.__tree.add(key, len(self.__places))
+                self.__places[key] = places[key]
+        self.__places.update(places)
+        self.__keys = sorted(self.__places)
+        return len(places)
+
+    def exact(self, placename):
+        """(lat, lon) of placename or None"""
+        place = self.__places.get(normalise_placename(placename))
+        if place:
+            return place[1], place[2]
+
+    def prefix(self, prefix, limit=10):
+        """[(name, lat, lon)] of up to limit places starting with prefix"""
+        key = normalise_placename(prefix)
+        found = []
+        for i in range(bisect.bisect_left(self.__keys, key), len(self.__keys)):
+            if not self.__keys[i].startswith(key) or len(found) >= limit:
+                break
+            found.append(self.__places[self.__keys[i]])
+        return found
+
+    def fuzzy(self, placename, max_distance=GAZETTEER_DISTANCE):
+        """(name, lat, lon) of the closest place within max_distance
+        edits, or None"""
+        found = self.__tree.search(normalise_placename(placename), max_distance)
+        if found:
+            return self.__places[min(found)[2]]
+
+    def lookup(self, placename):
+        """(lat, lon) by exact match, then an unambiguous prefix, then the
+        closest fuzzy match, None when nothing matches"""
+        location = self.exact(placename)
+        if location:
+            return location
+        places = self.prefix(placename, 2)
+        if len(places) != 1:
+            places = [self.fuzzy(placename)]
+        if places[0]:
+            return places[0][1], places[0][2]
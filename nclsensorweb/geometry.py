@@ -0,0 +1,207 @@
+"""EWKB and WKT encoding and decoding of 2d geometries without the database.
+EWKB is written as the upper case little endian hex PostGIS returns"""
+import nclsensorweb.errors as error
+import binascii
+import re
+import struct
+import numpy
+
+DEFAULT_SRID = 4326
+
+WKB_TYPES = {'Point':1, 'LineString':2, 'Polygon':3, 'MultiPoint':4,
+             'MultiLineString':5, 'MultiPolygon':6}
+
+WKB_NAMES = dict((code, name) for name, code in WKB_TYPES.items())
+
+WKT_NAMES = dict((name.upper(), name) for name in WKB_TYPES)
+
+EWKB_Z = 0x80000000
+
+EWKB_M = 0x40000000
+
+EWKB_SRID = 0x20000000
+
+def _hex(data):
+    return str(binascii.hexlify(data).decode('ascii').upper())
+
+def _header(geom_type, srid):
+    if srid is None:
+        return struct.pack('<BI', 1, WKB_TYPES[geom_type])
+    return struct.pack('<BII', 1, WKB_TYPES[geom_type] | EWKB_SRID, srid)
+
+def _points(coordinates):
+    return struct.pack('<I', len(coordinates)) + b''.join(
+        [struct.pack('<dd', float(x), float(y)) for x, y in
+         [point[:2] for point in coordinates]])
+
+def _body(geom_type, coordinates):
+    if geom_type == 'Point':
+        return struct.pack('<dd', float(coordinates[0]), float(coordinates[1]))
+    if geom_type == 'LineString':
+        return _points(coordinates)
+    if geom_type == 'Polygon':
+        return struct.pack('<I', len(coordinates)) + \
+                b''.join([_points(ring) for ring in coordinates])
+    part_type = geom_type[len('Multi'):]
+    return struct.pack('<I', len(coordinates)) + b''.join(
+        [_header(part_type, None) + _body(part_type, part)
+         for part in coordinates])
+
+def to_ewkb(geom, srid=DEFAULT_SRID):
+    """hex EWKB of a GeoJSON style {'type', 'coordinates'} geometry, plain
+    WKB when srid is None"""
+    if geom.get('type') not in WKB_TYPES:
+        raise error.SensorError('unsupported geometry %s' % (geom.get('type'),))
+    return _hex(_header(geom['type'], srid) + _body(geom['type'],
+                                                    geom['coordinates']))
+
+def point_ewkb(x, y, srid=DEFAULT_SRID):
+    return to_ewkb({'type':'Point', 'coordinates':[x, y]}, srid)
+
+def linestring_ewkb(coordinates, srid=DEFAULT_SRID):
+    return to_ewkb({'type':'LineString', 'coordinates':coordinates}, srid)
+
+def polygon_ewkb(rings, srid=DEFAULT_SRID):
+    return to_ewkb({'type':'Polygon', 'coordinates':rings}, srid)
+
+def points_ewkb(xs, ys, srid=DEFAULT_SRID):
+    """hex EWKB points for arrays of x and y, encoded in one numpy pass"""
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    header = _header('Point', srid)
+    records = numpy.zeros(len(xs), dtype=[('header', 'S%s' % (len(header),)),
+                                          ('x', '<f8'), ('y', '<f8')])
+    records['header'] = header
+    records['x'] = xs
+    records['y'] = ys
+    encoded = _hex(records.tobytes())
+    width = records.dtype.itemsize * 2
+    return [encoded[i:i + width] for i in range(0, len(encoded), width)]
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+def _read_geometry(reader):
+    byte_order = reader.read('B')[0]
+    order = '<' if byte_order == 1 else '>'
+    code = reader.read(order + 'I')[0]
+    srid = None
+    if code & EWKB_SRID:
+        srid = reader.read(order + 'I')[0]
+    dims = 2 + bool(code & EWKB_Z) + bool(code & EWKB_M)
+    code &= 0xffff
+    # iso wkb z, m and zm codes
+    if code > 1000:
+        dims = 2 + (code // 1000 in (1, 2)) + (code // 1000 == 3) * 2
+        code %= 1000
+    if code not in WKB_NAMES:
+        raise error.SensorError('unsupported wkb type %s' % (code,))
+    geom_type = WKB_NAMES[code]
+    point = order + 'd' * dims
+    def points():
+        count = reader.read(order + 'I')[0]
+        return [list(reader.read(point)) for i in range(count)]
+    if geom_type == 'Point':
+        coordinates = list(reader.read(point))
+    elif geom_type == 'LineString':
+        coordinates = points()
+    elif geom_type == 'Polygon':
+        coordinates = [points() for i in range(reader.read(order + 'I')[0])]
+    else:
+        coordinates = [_read_geometry(reader)[0]['coordinates']
+                       for i in range(reader.read(order + 'I')[0])]
+    return {'type':geom_type, 'coordinates':coordinates}, srid
+
+def from_ewkb(ewkb):
+    """(GeoJSON style geometry, srid or None) of hex EWKB or WKB"""
+    try:
+        data = binascii.unhexlify(ewkb)
+    except (TypeError, ValueError, binascii.Error):
+        raise error.SensorError('not hex ewkb')
+    try:
+        return _read_geometry(_Reader(data))
+    except struct.error:
+        raise error.SensorError('truncated ewkb')
+
+def _wkt_coordinates(geom):
+    if geom['type'] == 'Point':
+        return '(%s)' % (' '.join([repr(float(value)) for value in
+                                   geom['coordinates']]),)
+    def join(items, depth):
+        if depth == 0:
+            return ' '.join([repr(float(value)) for value in items])
+        return '(%s)' % (','.join([join(item, depth - 1) for item in items]),)
+    depth = {'LineString':1, 'MultiPoint':1, 'Polygon':2,
+             'MultiLineString':2, 'MultiPolygon':3}[geom['type']]
+    return join(geom['coordinates'], depth)
+
+def to_wkt(geom, srid=None):
+    """WKT of a GeoJSON style geometry, EWKT with an SRID= prefix when
+    srid is given"""
+    wkt = '%s%s' % (geom['type'].upper(), _wkt_coordinates(geom))
+    if srid is not None:
+        return 'SRID=%s;%s' % (srid, wkt)
+    return wkt
+
+WKT_TOKENS = re.compile(r'\s*([()]|,|[^\s(),]+)')
+
+def from_wkt(wkt):
+    """(GeoJSON style geometry, srid or None) of WKT or EWKT"""
+    srid = None
+    text = wkt.strip()
+    if text.upper().startswith('SRID='):
+        prefix, text = text.split(';', 1)
+        srid = int(prefix[len('SRID='):])
+    tokens = WKT_TOKENS.findall(text)
+    if not tokens or tokens[0].upper() not in WKT_NAMES:
+        raise error.SensorError('unsupported wkt %s' % (wkt,))
+    geom_type = WKT_NAMES[tokens[0].upper()]
+    position = [1]
+    while position[0] < len(tokens) and tokens[position[0]].upper() in ('Z', 'M', 'ZM'):
+        position[0] += 1
+    def parse():
+        if tokens[position[0]] != '(':
+            point = []
+            while position[0] < len(tokens) and tokens[position[0]] not in ('(', ')', ','):
+                point.append(float(tokens[position[0]]))
+                position[0] += 1
+            return point
+        position[0] += 1
+        items = [parse()]
+        while tokens[position[0]] == ',':
+            position[0] += 1
+            items.append(parse())
+        if tokens[position[0]] != ')':
+            raise error.SensorError('malformed wkt %s' % (wkt,))
+        position[0] += 1
+        return items
+    try:
+        coordinates = parse()
+    except (IndexError, ValueError):
+        raise error.SensorError('malformed wkt %s' % (wkt,))
+    if geom_type == 'Point':
+        coordinates = coordinates[0]
+    elif geom_type == 'MultiPoint':
+        # MULTIPOINT((1 2),(3 4)) as well as MULTIPOINT(1 2,3 4)
+        coordinates = [item[0] if item and isinstance(item[0], list) else item
+                       for item in coordinates]
+    return {'type':geom_type, 'coordinates':coordinates}, srid
+
+def wkt_to_ewkb(wkt, srid=DEFAULT_SRID):
+    """hex EWKB of WKT, an EWKT SRID= prefix overrides srid"""
+    geom, wkt_srid = from_wkt(wkt)
+    if wkt_srid is not None:
+        srid = wkt_srid
+    return to_ewkb(geom, srid)
+
+def ewkb_to_wkt(ewkb):
+    """EWKT of hex EWKB, plain WKT when it has no SRID"""
+    geom, srid = from_ewkb(ewkb)
+    return to_wkt(geom, srid)
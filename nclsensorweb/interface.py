@@ -2,98 +2,267 @@
  in the database"""
 import nclsensorweb.classes as cl
 import nclsensorweb.maintenance as maintenance
+import nclsensorweb.migrations as migrations
 import nclsensorweb.tools as tools
 import nclsensorweb.db_tools as db_tools
 import nclsensorweb.errors as error
+import nclsensorweb.geometry as geometry
+import nclsensorweb.geocoding as geocoding
 import datetime
 import psycopg2
-from pygeocoder import Geocoder
+import psycopg2.extensions
+import psycopg2.pool
+import collections
+import contextlib
+import threading
+import uuid
+from pygeocoder import Geocoder, GeocoderError
 import time
 class DatabaseConnection:
-    """handles all database connections"""
-    def __init__(self, host, db_name, user, password):
+    """handles all database connections through a thread safe pool,
+    each query or insert checks out its own connection"""
+    def __init__(self, host, db_name, user, password,
+                min_connections=1, max_connections=10, retries=1):
         self.__connection_string = 'host=%s dbname=%s user=%s password = %s' \
          % (host, db_name, user, password)
-        self.database = psycopg2.connect(self.__connection_string)
-        self.cur = self.database.cursor()
+        self.retries = retries
+        self.max_connections = max_connections
+        self.__slots = threading.BoundedSemaphore(max_connections)
+        self.__pool = psycopg2.pool.ThreadedConnectionPool(
+            min_connections, max_connections, self.__connection_string)
+        # the pool opens min_connections up front but closes any idle
+        # connection beyond minconn, keep up to max_connections idle instead
+        self.__pool.minconn = max_connections
+        self.reading_catalogue = db_tools.ReadingCatalogue(self)
+        self.result_cache = None
+        self.sensor_indexes = {}
+
+    def connect(self,):
+        """opens a dedicated connection outside of the pool"""
+        return psycopg2.connect(self.__connection_string)
+
+    def __checkout(self,):
+        """takes a healthy connection from the pool, blocking while all
+        connections are in use"""
+        self.__slots.acquire()
+        try:
+            while True:
+                conn = self.__pool.getconn()
+                if not conn.closed and conn.get_transaction_status() != \
+                 psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    return conn
+                self.__pool.putconn(conn, close=True)
+        except:
+            self.__slots.release()
+            raise
+
+    def __checkin(self, conn, broken=False):
+        """returns a connection to the pool, closing it if broken"""
+        try:
+            if not broken and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            self.__pool.putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            self.__slots.release()
+
+    @contextlib.contextmanager
+    def transaction(self,):
+        """checks out a connection for several statements, commits on
+        success and rolls back on failure"""
+        conn = self.__checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except psycopg2.extensions.QueryCanceledError:
+            # a timeout or cancel leaves the connection usable
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.__checkin(conn, broken)
+
+    def __execute(self, query_string, fetch):
+        """runs a statement on a pooled connection, retrying on a fresh
+        connection when the connection itself failed. cancelled statements
+        are not retried"""
+        attempt = 0
+        while True:
+            conn = self.__checkout()
+            try:
+                cur = conn.cursor()
+                cur.execute(query_string)
+                results = None
+                if fetch:
+                    results = cur.fetchall()
+            except psycopg2.extensions.QueryCanceledError:
+                # statement_timeout or a cancel, running it again would
+                # only double the load of the slowest statements
+                self.__checkin(conn)
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.__checkin(conn, broken=True)
+                if attempt < self.retries:
+                    attempt += 1
+                    continue
+                raise
+            except:
+                self.__checkin(conn)
+                raise
+            try:
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.__checkin(conn, broken=True)
+                raise
+            self.__checkin(conn)
+            return results
 
     def query(self, query_string):
         """queries the database and returns results"""
         try:
-            self.cur.execute(query_string)
-        
-            results = self.cur.fetchall()
-            return results
-        except:
-            self.database = psycopg2.connect(self.__connection_string)
-            self.cur = self.database.cursor()
+            return self.__execute(query_string, True)
+        except psycopg2.Error:
             raise NameError('DB ERROR')
-        
-    
+
     def insert(self, insert_string):
         """inserts data into the database"""
-        self.cur.execute(insert_string)
-        self.database.commit()
-        
-       
-    
-    
+        self.__execute(insert_string, False)
+
+    def stream(self, query_string, itersize=2000):
+        """yields the results of a query from a named server side cursor,
+        fetching itersize rows per round trip"""
+        with self.transaction() as conn:
+            cur = conn.cursor(name='sensorweb_%s' % (uuid.uuid4().hex,))
+            cur.itersize = itersize
+            cur.execute(query_string)
+            for row in cur:
+                yield row
+            cur.close()
+
+    def close(self,):
+        """closes all pooled connections"""
+        self.__pool.closeall()
+
+def dict_to_sensor(db_connection,info_dict,geojson=None):
+        name = info_dict['name']
+        id = info_dict['sensor_int_id']
+        geom = info_dict['geom']
+        active = info_dict['active']
+        source = info_dict['source']
+        type = info_dict['type']
+        del info_dict['name'],info_dict['sensor_int_id'],info_dict['geom'],
+        info_dict['active'],info_dict['source'], info_dict['type']
+        return cl.Sensor(
+                db_connection,
+                name,
+                id,
+                geom, 
+                active, 
+                source, 
+                type,
+                info_dict,
+                geojson
+                )
+
+def hstore_literal(info):
+    return ','.join(['"%s"=>"%s"' % (key, value) for key, value in info.items()])
+
+def rows_to_sensors(db_connection, rows):
+    """builds Sensors from (hstore matrix, geojson) rows"""
+    return [dict_to_sensor(db_connection, dict(row[0]), row[1]) for row in rows]
+
+def sensor_query(columns, key=False, value=False,last_record = False,active=True, not_flagged=True,logged_in=False):
+    """builds the sensors query for SensorFunctions.get"""
+    query_string = "select hstore_to_matrix(info) as info, \
+     ST_AsGeoJSON(info->'geom') as geojson from sensors "
+    clauses = []
+    if key and value:
+        clauses.append("info->'%s' = '%s'" % (key, value))
+    if active:
+        clauses.append("info->'active' = 'True' ")
+    if not_flagged:
+        clauses.append("info ? 'flag' = False ")
+    if not logged_in:
+        clauses.append("info->'auth_needed' = 'False'")
+    if last_record:
+        clauses.append("sensor_int_id_caster(info -> 'sensor_int_id'::text)  in \
+        (select distinct %s\
+         from sensor_data where %s > '%s'\
+         and info?'special_tag' = False)" %(columns['sensor_id'],
+                                            columns['ts'],last_record,))
+    if clauses:
+        query_string += ' where %s' % (' and '.join(clauses),)
+    return query_string
+
+def geospatial_hstore(geospatial_id, geom, theme, source, timestamp, reading,
+                      units, value, extra=None):
+    """builds the hstore literal for a geospatial entry"""
+    hstore = []
+    hstore.append('"id"=>"%s"' %(geospatial_id,))
+    hstore.append('"geom"=>"%s"' %(geom,))
+    hstore.append('"source"=>"%s"' %(source,))
+    hstore.append('"theme"=>"%s"' %(theme,))
+    hstore.append('"timestamp"=>"%s"' %(timestamp,))
+    hstore.append('"reading"=>"%s"' %(reading,))
+    hstore.append('"units"=>"%s"' %(units,))
+    hstore.append('"value"=>"%s"' %(value,))
+    hstore.append('"special_tag"=>"GEO"')
+    if extra:
+        for key, val in extra.items():
+            hstore.append('"%s"=>"%s"' %(key, val))
+    return ','.join(hstore)
+
+def geospatial_query(columns, starttime, endtime, not_flagged=True, key=None, value=None):
+    """builds the query for geospatial entries between 2 times"""
+    query_string = "select hstore_to_matrix(info) as info, ST_AsGeoJSON(info->'geom') as geojson from sensor_data"
+    clause = "info -> 'special_tag' = 'GEO' \
+            and %s > '%s' \
+            and %s < '%s'" % (columns['ts'], starttime, columns['ts'], endtime,)
+    if key:
+        clause += " and info->'%s'='%s'" % (key,value)
+    if not_flagged:
+        clause+= " and  info ? 'flag' = False "
+    if clause:
+        query_string += ' where %s' % (clause,)
+    return query_string
+
+def rows_to_geospatial(db_connection, rows):
+    """builds Geospatial entries from (hstore matrix, geojson) rows"""
+    geo = []
+    for sens in rows:
+        info = dict(sens[0])
+        geo.append(
+            cl.Geospatial(
+                db_connection,
+                str(info['id']), 
+                str(info['geom']),
+                str(sens[1]),
+                str(info['source']),
+                str(info['theme']),
+                str(info['timestamp']),
+                str(info['reading']),
+                str(info['units']),
+                str(info['value']),
+                info)
+                )
+    return geo
 
 class SensorFunctions:
     """handles all sensor functions"""
     def __init__(self, sensorweb):
         self.sensorweb = sensorweb
         
-    def __dict_to_sensor(self,info_dict):
-            name = info_dict['name']
-            id = info_dict['sensor_int_id']
-            geom = info_dict['geom']
-            active = info_dict['active']
-            source = info_dict['source']
-            type = info_dict['type']
-            del info_dict['name'],info_dict['sensor_int_id'],info_dict['geom'],
-            info_dict['active'],info_dict['source'], info_dict['type']
-            return cl.Sensor(
-                    self.sensorweb.database_connection,
-                    name,
-                    id,
-                    geom, 
-                    active, 
-                    source, 
-                    type,
-                    info_dict
-                    )
-
-        
-
-
-        
-        
     def get(self, key=False, value=False,last_record = False,active=True, not_flagged=True,logged_in=False):
         """retrives sensors matching the key value"""
-        query_string = "select hstore_to_matrix(info) as info from sensors "
-        clauses = []
-        if key and value:
-            clauses.append("info->'%s' = '%s'" % (key, value))
-        if active:
-            clauses.append("info->'active' = 'True' ")
-        if not_flagged:
-            clauses.append("info ? 'flag' = False ")
-        if not logged_in:
-            clauses.append("info->'auth_needed' = 'False'")
-        if last_record:
-            clauses.append("sensor_int_id_caster(info -> 'sensor_int_id'::text)  in \
-            (select distinct sensor_int_id_caster(info -> 'sensor_id'::text)\
-             from sensor_data where proper_timestamp(info->'timestamp') > '%s'\
-             and info?'special_tag' = False)" %(last_record,))
-        if clauses:
-            query_string += ' where %s' % (' and '.join(clauses),)
+        query_string = sensor_query(
+            db_tools.sensor_data_columns(self.sensorweb.database_connection),
+            key, value, last_record, active, not_flagged, logged_in)
         sens_row = self.sensorweb.database_connection.query(query_string)
-        sensors = []
-        for sens in sens_row:
-            info = dict(sens[0])
-            sensor = self.__dict_to_sensor(info)
-            sensors.append(sensor)
+        sensors = rows_to_sensors(self.sensorweb.database_connection, sens_row)
         if sensors:
             return cl.SensorGroup(self.sensorweb,sensors)
 
@@ -101,9 +270,7 @@ class SensorFunctions:
         """creates a sensor entry"""
         new_type ,_type = db_tools.check_tag(self.sensorweb.database_connection,'sensors','type',_type)
         new_source,_source = db_tools.check_tag(self.sensorweb.database_connection,'sensors','source',_source)
-        query_string = "select max(sensor_int_id_caster(info -> 'sensor_int_id'::text) ) from sensors"
-        sens_id = self.sensorweb.database_connection.query(query_string)
-        id = sens_id[0][0] +1
+        id = db_tools.allocate_sensor_ids(self.sensorweb.database_connection, 1)[0]
         sensor = cl.Sensor(
                     self.sensorweb.database_connection, 
                     _name,
@@ -116,15 +283,11 @@ class SensorFunctions:
                     
         sensor.link()
         if new_type:
-            query_string = "update new_tags set info = case  when info is not null \
-             then info||hstore('type','%s') else hstore('type','%s') end  \
-             where table_name = 'sensors'" % (_type,_type)
-            self.sensorweb.database_connection.insert(query_string)
+            db_tools.add_new_tag(self.sensorweb.database_connection,
+                                 'sensors','type',_type)
         if new_source:
-            query_string = "update new_tags set info = case  when info is not null \
-             then info||hstore('source','%s') else hstore('source','%s') end  \
-             where table_name = 'sensors'" % (_source,_source)
-            self.sensorweb.database_connection.insert(query_string)
+            db_tools.add_new_tag(self.sensorweb.database_connection,
+                                 'sensors','source',_source)
         return sensor
         
     def get_or_create(self, _name, _geom, _type,
@@ -143,17 +306,124 @@ class SensorFunctions:
         info_dict.update(_extra)
         sensor.update(info_dict)
         if new_type:
-            query_string = "update new_tags set info = case  when info is not null \
-             then info||hstore('type','%s') else hstore('type','%s') end  \
-             where table_name = 'sensors'" % (_type,_type,)
-            self.sensorweb.database_connection.insert(query_string)
+            db_tools.add_new_tag(self.sensorweb.database_connection,
+                                 'sensors','type',_type)
         if new_source:
-            query_string = "update new_tags set info = case  when info is not null \
-             then info||hstore('source','%s') else hstore('source','%s') end  \
-             where table_name = 'sensors'" % (_source,_source,)
-            self.sensorweb.database_connection.insert(query_string)
+            db_tools.add_new_tag(self.sensorweb.database_connection,
+                                 'sensors','source',_source)
         return sensor
         
+    def get_or_create_many(self, sensors, batch_size=cl.BATCH_SIZE):
+        """get_or_create for many sensors, as dicts with the create()
+        argument names or tuples in its argument order. names are resolved
+        with one query per batch, new sensors take ids reserved in one
+        block and are inserted with one statement, existing sensors are
+        updated with one statement. a name given more than once is written
+        once with its last values. returns the SensorGroup of a sensor for
+        every one given, in the given order"""
+        db_conn = self.sensorweb.database_connection
+        entries = collections.OrderedDict()
+        given_names = []
+        new_tags = []
+        for sensor in sensors:
+            if not isinstance(sensor, dict):
+                sensor = dict(zip(('_name', '_geom', '_type', '_source',
+                                   '_active', '_auth_needed', '_extra'), sensor))
+            sensor = dict((key.lstrip('_'), value) for key, value in sensor.items())
+            info = {'geom':sensor['geom'], 'active':sensor['active'],
+                    'auth_needed':sensor['auth_needed']}
+            for tag in ('type', 'source'):
+                new_tag, info[tag] = db_tools.check_tag(db_conn, 'sensors',
+                                                        tag, sensor[tag])
+                if new_tag and (tag, info[tag]) not in new_tags:
+                    new_tags.append((tag, info[tag]))
+            info.update(sensor.get('extra') or {})
+            given_names.append(sensor['name'])
+            entries[sensor['name']] = dict((key, str(value))
+                                           for key, value in info.items())
+        names = list(entries.keys())
+        found = {}
+        for i in range(0, len(names), batch_size):
+            self.__get_or_create_batch(names[i:i + batch_size], entries,
+                                       found)
+        for tag, value in new_tags:
+            db_tools.add_new_tag(db_conn, 'sensors', tag, value)
+        cl.invalidate_sensor_index(db_conn)
+        if found:
+            return cl.SensorGroup(self.sensorweb,
+                                  [found[name] for name in given_names])
+
+    def __get_or_create_batch(self, names, entries, found):
+        db_conn = self.sensorweb.database_connection
+        rows = db_conn.query("select hstore_to_matrix(info) as info, \
+         ST_AsGeoJSON(info->'geom') as geojson from sensors \
+         where info->'name' in (%s)" % (','.join(["'%s'" % (name,)
+                                                  for name in names]),))
+        existing = {}
+        for row in rows:
+            info = dict(row[0])
+            existing[info['name']] = (info, row[1])
+        new_names = [name for name in names if name not in existing]
+        sensor_ids = db_tools.allocate_sensor_ids(db_conn, len(new_names)) \
+                                if new_names else []
+        inserts = []
+        for name, sensor_id in zip(new_names, sensor_ids):
+            info = {'name':name, 'sensor_int_id':str(sensor_id)}
+            info.update(entries[name])
+            inserts.append("('%s'::hstore)" % (hstore_literal(info),))
+            found[name] = dict_to_sensor(db_conn, info)
+        if inserts:
+            db_conn.insert("insert into sensors (info) values %s"
+                           % (','.join(inserts),))
+        updates = []
+        for name, (info, geojson) in existing.items():
+            updates.append("('%s','%s'::hstore)" % (name,
+                                                    hstore_literal(entries[name])))
+            if info.get('geom') != entries[name]['geom']:
+                geojson = None
+            info.update(entries[name])
+            found[name] = dict_to_sensor(db_conn, info, geojson)
+        if updates:
+            db_conn.insert("update sensors set info = sensors.info || updates.info \
+             from (values %s) as updates (name, info) \
+             where sensors.info->'name' = updates.name" % (','.join(updates),))
+
+    def spatial_index(self, active=True, not_flagged=True, logged_in=False):
+        """cl.SpatialIndex of the sensors get() returns with these filters,
+        kept until sensors change here or for cl.SENSOR_INDEX_TTL seconds"""
+        db_conn = self.sensorweb.database_connection
+        key = (active, not_flagged, logged_in)
+        cached = db_conn.sensor_indexes.get(key)
+        if cached and time.time() - cached[0] < cl.SENSOR_INDEX_TTL:
+            return cached[1]
+        built_at = time.time()
+        group = self.get(active=active, not_flagged=not_flagged,
+                         logged_in=logged_in)
+        index = cl.SpatialIndex(group.sensors if group else [])
+        db_conn.sensor_indexes[key] = (built_at, index)
+        return index
+
+    def within_bbox(self, xmin, ymin, xmax, ymax, active=True,
+                    not_flagged=True, logged_in=False):
+        """sensors inside the bbox in the SRID of their geometries"""
+        sensors = self.spatial_index(active, not_flagged,
+                                     logged_in).within_bbox(xmin, ymin, xmax, ymax)
+        if sensors:
+            return cl.SensorGroup(self.sensorweb, sensors)
+
+    def within_radius(self, x, y, radius, active=True, not_flagged=True,
+                      logged_in=False):
+        sensors = self.spatial_index(active, not_flagged,
+                                     logged_in).within_radius(x, y, radius)
+        if sensors:
+            return cl.SensorGroup(self.sensorweb, sensors)
+
+    def nearest(self, x, y, k=1, active=True, not_flagged=True,
+                logged_in=False):
+        """[(sensor, distance)] of the k sensors nearest x, y"""
+        return self.spatial_index(active, not_flagged,
+                                  logged_in).nearest(x, y, k)
+
     def sources(self,):
         return db_tools.get_tag_values(self.sensorweb.database_connection,'sensors','source')
         
@@ -168,84 +438,27 @@ class GeospatialFunctions:
     def create_geospatial(self, geospatial_id, geom, theme, source, 
                             timestamp, reading, units, value, extra=None):
         """create geospatial class"""
-        hstore = []
-        hstore.append('"id"=>"%s"' %(geospatial_id,))
-        hstore.append('"geom"=>"%s"' %(geom,))
-        hstore.append('"source"=>"%s"' %(source,))
-        hstore.append('"theme"=>"%s"' %(theme,))
-        hstore.append('"timestamp"=>"%s"' %(timestamp,))
-        hstore.append('"reading"=>"%s"' %(reading,))
-        hstore.append('"units"=>"%s"' %(units,))
-        hstore.append('"value"=>"%s"' %(value,))
-        hstore.append('"special_tag"=>"GEO"')
-        if extra:
-            for key, val in extra.iteritems():
-                hstore.append('"%s"=>"%s"' %(key, val))
-        query_string = "insert into sensor_data (info) values ('%s')"\
-                        % (','.join(hstore),)
+        hstore = geospatial_hstore(geospatial_id, geom, theme, source,
+                                   timestamp, reading, units, value, extra)
+        query_string = db_tools.sensor_data_insert(
+                        self.sensorweb.database_connection, [hstore])
         self.sensorweb.database_connection.insert(query_string)
         
     def get_all(self, starttime, endtime,not_flagged=True,):
         """Retrives all geospatial entries between 2 times"""
-        query_string = "select hstore_to_matrix(info) as info, ST_AsGeoJSON(info->'geom') as geojson from sensor_data"
-        clause = "info -> 'special_tag' = 'GEO' \
-                and proper_timestamp(info->'timestamp') > '%s' \
-                and proper_timestamp(info->'timestamp') < '%s'" % (starttime, endtime,)
-                
-        if not_flagged:
-            clause+= " and  info ? 'flag' = False "
-        if clause:
-            query_string += ' where %s' % (clause,)
-
+        query_string = geospatial_query(
+            db_tools.sensor_data_columns(self.sensorweb.database_connection),
+            starttime, endtime, not_flagged)
         sens_row = self.sensorweb.database_connection.query(query_string)
-        geo = []
-        for sens in sens_row:
-            info = dict(sens[0])
-            geo.append(
-                cl.Geospatial(
-                    self.sensorweb.database_connection,
-                    str(info['id']), 
-                    str(info['geom']),
-                    str(sens[1]),
-                    str(info['source']),
-                    str(info['theme']),
-                    str(info['timestamp']),
-                    str(info['reading']),
-                    str(info['units']),
-                    str(info['value']),
-                    info)
-                    )
-        return geo
+        return rows_to_geospatial(self.sensorweb.database_connection, sens_row)
     
     def get(self, starttime, endtime, key, value,not_flagged=True ):
         """Retrives all geospatial entries between 2 times"""
-        query_string = "select hstore_to_matrix(info) as info, ST_AsGeoJSON(info->'geom') as geojson from sensor_data"
-        clause = "info -> 'special_tag' = 'GEO' \
-                and proper_timestamp(info->'timestamp') > '%s' \
-                and proper_timestamp(info->'timestamp') < '%s' and info->'%s'='%s'" % (starttime, endtime,key,value)
-        if not_flagged:
-            clause+= " and  info ? 'flag' = False "
-        if clause:
-            query_string += ' where %s' % (clause,)
+        query_string = geospatial_query(
+            db_tools.sensor_data_columns(self.sensorweb.database_connection),
+            starttime, endtime, not_flagged, key, value)
         sens_row = self.sensorweb.database_connection.query(query_string)
-        geo = []
-        for sens in sens_row:
-            info = dict(sens[0])
-            geo.append(
-                cl.Geospatial(
-                    self.sensorweb.database_connection,
-                    str(info['id']), 
-                    str(info['geom']),
-                    str(sens[1]),
-                    str(info['source']),
-                    str(info['theme']),
-                    str(info['timestamp']),
-                    str(info['reading']),
-                    str(info['units']),
-                    str(info['value']),
-                    info)
-                    )
-        return geo
+        return rows_to_geospatial(self.sensorweb.database_connection, sens_row)
     
 class VariableFunctions:
     def __init__(self,sensorweb):
@@ -256,43 +469,100 @@ class VariableFunctions:
         variables = self.sensorweb.database_connection.query(query_string)
         return variables[0][0]
 class GeometryFunctions:
-    def __init__(self,sensorweb):
+    def __init__(self,sensorweb,geocode_cache=None,gazetteer=None):
         self.sensorweb = sensorweb
+        # optional geocoding.GeocodeCache and geocoding.Gazetteer
+        self.geocode_cache = geocode_cache
+        self.gazetteer = gazetteer
         
     def latlon(self,lat,lon):
         """creates postgis binary geometry from lat and lon"""
-        query_string = "select ST_SetSRID(ST_MakePoint(%s,%s),4326)" \
-                        % (lon, lat,)
-        geom = self.sensorweb.database_connection.query(query_string)
-        return geom[0][0]
+        return geometry.point_ewkb(lon, lat, 4326)
+
+    def latlons(self,lats,lons):
+        """latlon for arrays of lats and lons"""
+        return geometry.points_ewkb(lons, lats, 4326)
     
+    def geocode(self,placename):
+        """(lat, lon) of a placename from an exact gazetteer match, the
+        geocode cache or the geocoder, falling back to a gazetteer prefix
+        or fuzzy match when the geocoder fails. the geocoder's error is
+        raised when nothing matches"""
+        if self.gazetteer is not None:
+            location = self.gazetteer.exact(placename)
+            if location:
+                return location
+        if self.geocode_cache is not None:
+            location = self.geocode_cache.get(placename)
+            if location:
+                return location
+        try:
+            lat,lon = Geocoder.geocode(placename)[0].coordinates
+        except (GeocoderError, IndexError):
+            if self.gazetteer is not None:
+                location = self.gazetteer.lookup(placename)
+                if location:
+                    return location
+            raise
+        if self.geocode_cache is not None:
+            self.geocode_cache.set(placename, lat, lon)
+        return lat,lon
+
     def placename(self,placename):
-        geom_results = Geocoder.geocode(placename)
-        lat,lon = geom_results[0].coordinates
+        lat,lon = self.geocode(placename)
         geom_binary = self.latlon(lat,lon)
         return geom_binary
+
+    def placenames(self,placenames):
+        """placename for a list of names, each normalised name is looked
+        up once. names that are not found give None"""
+        locations = {}
+        for placename in placenames:
+            key = geocoding.normalise_placename(placename)
+            if key not in locations:
+                try:
+                    locations[key] = self.geocode(placename)
+                except (GeocoderError, IndexError):
+                    locations[key] = None
+        found = [key for key in locations if locations[key]]
+        geoms = dict(zip(found, self.latlons(
+            [locations[key][0] for key in found],
+            [locations[key][1] for key in found])))
+        return [geoms.get(geocoding.normalise_placename(placename))
+                for placename in placenames]
     
     def wkt(self,wkt):
-        query_string = "select ST_GeomFromText('%s',4326)" % (wkt,)
-        geom = self.database_connection.query(query_string)
-        return geom[0][0]
+        """creates postgis binary geometry from WKT in 4326 or EWKT"""
+        return geometry.wkt_to_ewkb(wkt, 4326)
 
     
 class SensorWeb:
     """SensorWeb class handles all interactions with the database"""
-    def __init__(self, host, db_name, user, password, add_ons=None):
+    def __init__(self, host, db_name, user, password, add_ons=None,
+                min_connections=1, max_connections=10, result_cache=None,
+                geocode_cache=None, gazetteer=None):
         self.database_connection = DatabaseConnection(host, db_name, 
-                                                    user, password)
+                                                    user, password,
+                                                    min_connections,
+                                                    max_connections)
+        # opt in cl.ResultCache for SensorGroup.data latest and get
+        self.database_connection.result_cache = result_cache
+        self.readings = self.database_connection.reading_catalogue
         self.sensors = SensorFunctions(self)
         self.geospatial = GeospatialFunctions(self)
-        self.geometry = GeometryFunctions(self)
+        self.geometry = GeometryFunctions(self, geocode_cache, gazetteer)
         self.variables = VariableFunctions(self)
         self.maintenance = maintenance.maintenance_class(self)
+        self.migrations = migrations.migration_class(self)
         if add_ons:
             for add_on in add_ons:
                 setattr(self, add_on.name, add_on(self))
     def measure_distance(self,e1,n1,e2,n2):
         q = "select st_distance(st_makepoint(%s,%s),st_makepoint(%s,%s))" % (e1,n1,e2,n2)
         return self.database_connection.query(q)[0][0]
+
+    def measure_distances(self,e1,n1,e2,n2):
+        """measure_distance for arrays of points without the database"""
+        return cl.planar_distances(e1,n1,e2,n2)
         
 
@@ -1,36 +1,310 @@
+import logging
+import time
+import nclsensorweb.db_tools as db_tools
+
+LOGGER = logging.getLogger(__name__)
+
+FLAG_CHUNK_SIZE = 10000
+
+FLAG_TASK = 'flag_suspect_values'
+
+FLAG_SWEEP_WINDOW = 100000
+
+ROLLUP_CHUNK_SIZE = 50000
+
+ROLLUP_PENDING_TASK = 'rollups_pending'
+
+ROLLUP_STALL_SECONDS = 3600
 
 class maintenance_class:
     def __init__(self,sensorweb):
         self.sensorweb = sensorweb
-        
-    def flag_suspect_values(self,):
-        query_string = "select reading_name, hstore_to_matrix(flag_checker) from readings "
-        reading_flag_checker = {}
-        reading_flag_checker_rows = self.sensorweb.database_connection.query(query_string)
-        for row in reading_flag_checker_rows:
-            if row[1]:
-                reading_flag_checker[row[0]]= dict(row[1])
-        query_string = "select sensor__data_id,hstore_to_matrix(info) from sensor_data where info -> 'raw' = 'True'"
-        raw_data_readings = self.sensorweb.database_connection.query(query_string)
-        i = 0
-        for row in raw_data_readings:
-            i+=1
-            row_number = row[0]
-            info = dict(row[1])
-            if info['reading'] not in reading_flag_checker.keys():
-                query_string = "update sensor_data set info = delete(info,'raw') where sensor__data_id = %s " % ( row_number,)
-                self.sensorweb.database_connection.insert(query_string)
-                continue
-            flag_value = False
-            if 'min_val' in reading_flag_checker[info['reading']].keys():
-                if float(info['value']) < float(reading_flag_checker[info['reading']]['min_val']):
-                    flag_value = True
-            if 'max_val' in reading_flag_checker[info['reading']].keys():
-                if float(info['value']) > float(reading_flag_checker[info['reading']]['max_val']):
-                    flag_value = True
-            info_string = "delete(info,'raw')"
-            if flag_value:
-                info_string+="||hstore('flag','True')"
-            query_string = "update sensor_data set info = %s where sensor__data_id = %s " % ( info_string,row_number,)
-            self.sensorweb.database_connection.insert(query_string)
-        
\ No newline at end of file
+        self.progress = {}
+        self.__state_table_ready = False
+
+    def __ensure_state_table(self,):
+        if not self.__state_table_ready:
+            self.sensorweb.database_connection.insert(
+                "create table if not exists maintenance_state ( \
+                task_name text primary key, \
+                last_id bigint not null default 0, \
+                rows_processed bigint not null default 0, \
+                updated timestamp)")
+            self.sensorweb.database_connection.insert(
+                "alter table maintenance_state \
+                add column if not exists snapshot_xmax bigint")
+            self.__state_table_ready = True
+
+    def watermark(self, task_name):
+        """returns the last sensor__data_id processed by an incremental task"""
+        self.__ensure_state_table()
+        response = self.sensorweb.database_connection.query(
+            "select last_id from maintenance_state where task_name = '%s'"
+            % (task_name,))
+        if response:
+            return response[0][0]
+        return 0
+
+    def reset_watermark(self, task_name):
+        """makes the next incremental run of a task start from scratch"""
+        self.__ensure_state_table()
+        self.sensorweb.database_connection.insert(
+            "delete from maintenance_state where task_name = '%s'" % (task_name,))
+
+    def _save_watermark(self, cur, task_name, last_id, rows_processed):
+        """moves a task's watermark inside the caller's transaction"""
+        cur.execute("insert into maintenance_state \
+            (task_name, last_id, rows_processed, updated) values ('%s', %s, %s, now()) \
+            on conflict (task_name) do update set last_id = excluded.last_id, \
+            rows_processed = maintenance_state.rows_processed + excluded.rows_processed, \
+            updated = excluded.updated" % (task_name, last_id, rows_processed))
+
+    def __flag_chunk(self, after_id, chunk_size, task_name=None, upto_id=None):
+        """clears the raw tag of the next chunk_size raw readings after
+        after_id, and up to upto_id when given, flagging values outside
+        the reading's flag_checker min_val/max_val. when task_name is given
+        the task's watermark is moved in the same transaction. returns the
+        [sensor__data_id, flagged] rows"""
+        db_conn = self.sensorweb.database_connection
+        typed_columns = ''
+        if db_tools.TYPED_COLUMNS_MIGRATION in db_tools.applied_migrations(db_conn):
+            typed_columns = ", flag = checked.flag, raw = False"
+        query_string = "with chunk as ( \
+            select sensor__data_id, info from sensor_data \
+            where %s and sensor__data_id > %s%s \
+            order by sensor__data_id limit %s \
+        ), checked as ( \
+            select chunk.sensor__data_id, coalesce(case \
+                when chunk.info->'value' ~ '%s' then \
+                (readings.flag_checker ? 'min_val' and \
+                 (chunk.info->'value')::float < (readings.flag_checker->'min_val')::float) \
+                or (readings.flag_checker ? 'max_val' and \
+                 (chunk.info->'value')::float > (readings.flag_checker->'max_val')::float) \
+                end, False) as flag \
+            from chunk left join readings \
+            on readings.reading_name = chunk.info->'reading' \
+        ) \
+        update sensor_data set info = case when checked.flag \
+            then delete(sensor_data.info,'raw')||hstore('flag','True') \
+            else delete(sensor_data.info,'raw') end%s \
+        from checked where sensor_data.sensor__data_id = checked.sensor__data_id \
+        returning sensor_data.sensor__data_id, checked.flag" \
+        % (db_tools.sensor_data_columns(db_conn)['raw'], after_id,
+           '' if upto_id is None else ' and sensor__data_id <= %s' % (upto_id,),
+           chunk_size,
+           db_tools.NUMERIC_PATTERN, typed_columns)
+        with db_conn.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute(query_string)
+            rows = cur.fetchall()
+            if rows and task_name:
+                self._save_watermark(cur, task_name,
+                                     max(row[0] for row in rows), len(rows))
+            return rows
+
+    def flag_suspect_values(self, chunk_size=FLAG_CHUNK_SIZE, incremental=False):
+        """checks raw readings against readings.flag_checker with one set
+        based update and commit per chunk of chunk_size rows. readings
+        without a checker or with a non numeric value are just marked as
+        checked.
+
+        incremental runs start after the watermark saved in
+        maintenance_state and save it with every chunk, so an interrupted
+        run resumes where it stopped. each incremental run first sweeps
+        the raw rows at or below the watermark, which picks up rows that
+        committed after a chunk with higher ids had passed them. until the
+        typed columns are backfilled only the FLAG_SWEEP_WINDOW ids below
+        the watermark are swept.
+
+        returns a summary of rows processed and flagged, swept counts the
+        late rows among them. self.progress holds the same counters while
+        the run is going"""
+        task_name = None
+        last_id = 0
+        if incremental:
+            task_name = FLAG_TASK
+            last_id = self.watermark(task_name)
+        start = time.time()
+        summary = {'processed':0, 'flagged':0, 'chunks':0, 'swept':0,
+                   'watermark':last_id, 'rows_per_second':0.0}
+        self.progress[FLAG_TASK] = summary
+        def add_rows(rows):
+            summary['chunks'] += 1
+            summary['processed'] += len(rows)
+            summary['flagged'] += len([row for row in rows if row[1]])
+            summary['rows_per_second'] = summary['processed'] / \
+                                            max(time.time() - start, 1e-6)
+        swept_id = 0
+        db_conn = self.sensorweb.database_connection
+        if db_tools.TYPED_BACKFILL_MIGRATION not in \
+         db_tools.applied_migrations(db_conn):
+            # no index covers the hstore raw tag, so only the ids below the
+            # watermark are scanned where late rows are likely
+            swept_id = max(last_id - FLAG_SWEEP_WINDOW, 0)
+        while last_id:
+            # the typed raw column filter uses the partial index on raw rows
+            rows = self.__flag_chunk(swept_id, chunk_size, upto_id=last_id)
+            if not rows:
+                break
+            swept_id = max(row[0] for row in rows)
+            summary['swept'] += len(rows)
+            add_rows(rows)
+        while True:
+            rows = self.__flag_chunk(last_id, chunk_size, task_name)
+            if not rows:
+                break
+            last_id = max(row[0] for row in rows)
+            summary['watermark'] = last_id
+            add_rows(rows)
+        summary['seconds'] = time.time() - start
+        cache = db_conn.result_cache
+        if cache is not None and summary['flagged']:
+            # flagged readings drop out of cached results
+            cache.clear()
+        return summary
+
+    def __ensure_rollup_tables(self,):
+        for table, width in db_tools.ROLLUPS:
+            self.sensorweb.database_connection.insert(
+                "create table if not exists %s ( \
+                sensor_id integer not null, \
+                reading text not null, \
+                bucket timestamp not null, \
+                units text, \
+                theme text, \
+                n bigint not null, \
+                total double precision not null, \
+                min_value double precision not null, \
+                max_value double precision not null, \
+                primary key (sensor_id, reading, bucket))" % (table,))
+
+    def __rollup_bound(self, last_id, columns):
+        """(upper_id, pending, stalled) for refresh_rollups. ids are handed
+        out before their rows commit, so the highest id seen is only
+        recorded as pending. it becomes the bound once every transaction
+        open when it was seen has finished, and rows still raw hold the
+        bound below them. pending is the (max id, snapshot xmax) to record,
+        stalled why the bound has been held for ROLLUP_STALL_SECONDS"""
+        response = self.sensorweb.database_connection.query(
+            "select txid_snapshot_xmin(txid_current_snapshot()), \
+            txid_snapshot_xmax(txid_current_snapshot()), \
+            (select coalesce(max(sensor__data_id), 0) from sensor_data), \
+            (select min(sensor__data_id) from sensor_data \
+             where sensor__data_id > %s and %s), \
+            pending.last_id, pending.snapshot_xmax, \
+            extract(epoch from now() - pending.updated) \
+            from (select 1) as one left join maintenance_state as pending \
+            on pending.task_name = '%s'" % (last_id, columns['raw'],
+                                            ROLLUP_PENDING_TASK))
+        xmin, xmax, max_id, raw_id, pending_id, pending_xmax, pending_age = \
+                                                                response[0]
+        if pending_id is None or pending_id <= last_id:
+            return last_id, (max_id, xmax), None
+        upper_id = last_id
+        if xmin >= pending_xmax:
+            upper_id = pending_id
+            if raw_id is not None:
+                upper_id = max(last_id, min(upper_id, raw_id - 1))
+        stalled = None
+        if upper_id < pending_id and pending_age > ROLLUP_STALL_SECONDS:
+            if xmin < pending_xmax:
+                stalled = 'a transaction open since sensor__data_id %s ' \
+                          'was seen' % (pending_id,)
+            else:
+                stalled = 'sensor__data_id %s not checked by ' \
+                          'flag_suspect_values' % (raw_id,)
+        if upper_id >= pending_id:
+            return upper_id, (max_id, xmax), stalled
+        return upper_id, None, stalled
+
+    def refresh_rollups(self, chunk_size=ROLLUP_CHUNK_SIZE):
+        """folds readings added since the last refresh into the 5 minute,
+        hourly and daily rollups (count, sum, min, max per sensor, reading
+        and bucket in default units). only rows already checked by
+        flag_suspect_values are rolled up, so run it after flagging.
+        each chunk of sensor__data_id and the watermark commit together,
+        processed counts the sensor__data_id range covered.
+
+        a refresh only goes up to the highest id seen by an earlier
+        refresh, once no transaction that could still add rows below it is
+        open, so the first refresh just records that id. summary['stalled']
+        says what has held the watermark back for ROLLUP_STALL_SECONDS, it
+        is logged as a warning too"""
+        self.__ensure_state_table()
+        self.__ensure_rollup_tables()
+        last_id = self.watermark(db_tools.ROLLUP_TASK)
+        columns = db_tools.sensor_data_columns(self.sensorweb.database_connection)
+        upper_id, pending, stalled = self.__rollup_bound(last_id, columns)
+        if stalled:
+            LOGGER.warning('rollup refresh held at %s by %s', last_id, stalled)
+        start = time.time()
+        summary = {'processed':0, 'chunks':0, 'watermark':last_id,
+                   'rows_per_second':0.0, 'stalled':stalled}
+        self.progress[db_tools.ROLLUP_TASK] = summary
+        while last_id < upper_id:
+            chunk_end = min(last_id + chunk_size, upper_id)
+            with self.sensorweb.database_connection.transaction() as conn:
+                cur = conn.cursor()
+                for table, width in db_tools.ROLLUPS:
+                    cur.execute(self.__rollup_insert(table, width, last_id,
+                                                     chunk_end, columns))
+                self._save_watermark(cur, db_tools.ROLLUP_TASK, chunk_end,
+                                     chunk_end - last_id)
+            summary['chunks'] += 1
+            summary['processed'] += chunk_end - last_id
+            last_id = chunk_end
+            summary['watermark'] = last_id
+            summary['rows_per_second'] = summary['processed'] / \
+                                            max(time.time() - start, 1e-6)
+        with self.sensorweb.database_connection.transaction() as conn:
+            cur = conn.cursor()
+            if not summary['chunks']:
+                # record the refresh time even when nothing was new
+                self._save_watermark(cur, db_tools.ROLLUP_TASK, last_id, 0)
+            if pending:
+                cur.execute("insert into maintenance_state \
+                (task_name, last_id, updated, snapshot_xmax) \
+                values ('%s', %s, now(), %s) on conflict (task_name) do update \
+                set last_id = excluded.last_id, updated = excluded.updated, \
+                snapshot_xmax = excluded.snapshot_xmax" % (ROLLUP_PENDING_TASK,
+                                                           pending[0],
+                                                           pending[1]))
+        summary['seconds'] = time.time() - start
+        return summary
+
+    def rebuild_rollups(self, chunk_size=ROLLUP_CHUNK_SIZE):
+        """empties the rollups and refreshes them from scratch, e.g. after
+        changing unit conversions or flagging old rows"""
+        self.__ensure_rollup_tables()
+        for table, width in db_tools.ROLLUPS:
+            self.sensorweb.database_connection.insert("truncate %s" % (table,))
+        self.reset_watermark(db_tools.ROLLUP_TASK)
+        return self.refresh_rollups(chunk_size)
+
+    def __rollup_insert(self, table, width, after_id, upto_id, columns):
+        return "insert into %(table)s as rollup \
+        (sensor_id, reading, bucket, units, theme, n, total, min_value, max_value) \
+        select sensor_id, reading, bucket, min(units), min(theme), \
+         count(value), sum(value), min(value), max(value) \
+        from (select %(sensor_id)s as sensor_id, \
+              sensor_data.info->'reading' as reading, \
+              %(bucket)s as bucket, \
+              readings.default_units as units, \
+              sensor_data.info->'theme' as theme, \
+              %(value)s as value \
+            from sensor_data join readings \
+            on readings.reading_name = sensor_data.info->'reading' \
+            where sensor_data.sensor__data_id > %(after_id)s \
+            and sensor_data.sensor__data_id <= %(upto_id)s \
+            and sensor_data.info ? 'sensor_id' \
+            and %(not_flagged)s) as converted \
+        where value is not null group by sensor_id, reading, bucket \
+        on conflict (sensor_id, reading, bucket) do update set \
+         n = rollup.n + excluded.n, \
+         total = rollup.total + excluded.total, \
+         min_value = least(rollup.min_value, excluded.min_value), \
+         max_value = greatest(rollup.max_value, excluded.max_value)" % {
+        'table':table, 'after_id':after_id, 'upto_id':upto_id,
+        'sensor_id':columns['sensor_id'], 'not_flagged':columns['not_flagged'],
+        'bucket':db_tools.rollup_bucket_sql(columns['ts'], width),
+        'value':db_tools.converted_value_sql()}
@@ -0,0 +1,383 @@
+"""Schema migrations for the sensor web database"""
+import nclsensorweb.db_tools as db_tools
+import nclsensorweb.errors as error
+import datetime
+
+BACKFILL_CHUNK_SIZE = 50000
+
+BACKFILL_TASK = 'typed_backfill'
+
+PARTITION_MIGRATION = 'partitioned_sensor_data'
+
+PARTITION_PERIODS = ('day', 'week', 'month')
+
+PARTITIONS_AHEAD = 3
+
+PARTITIONED_TS_ERROR = 'sensor_data is partitioned on ts, insert ts along with info'
+
+def period_start(timestamp, period):
+    """start of the partition period holding timestamp"""
+    day = datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    return datetime.datetime(timestamp.year, timestamp.month, 1)
+
+def next_period(start, period):
+    """start of the partition period after the one starting at start"""
+    if period == 'day':
+        return start + datetime.timedelta(days=1)
+    if period == 'week':
+        return start + datetime.timedelta(days=7)
+    if start.month == 12:
+        return datetime.datetime(start.year + 1, 1, 1)
+    return datetime.datetime(start.year, start.month + 1, 1)
+
+def partition_name(start):
+    return 'sensor_data_p%s' % (start.strftime('%Y%m%d'),)
+
+class migration_class:
+    def __init__(self,sensorweb):
+        self.sensorweb = sensorweb
+
+    def __ensure_migrations_table(self,):
+        self.sensorweb.database_connection.insert(
+            "create table if not exists schema_migrations ( \
+            name text primary key, \
+            applied timestamp not null default now())")
+
+    def applied(self,):
+        """names of the migrations applied to the database"""
+        db_tools.forget_migrations(self.sensorweb.database_connection)
+        return db_tools.applied_migrations(self.sensorweb.database_connection)
+
+    def _record(self, name):
+        self.__ensure_migrations_table()
+        self.sensorweb.database_connection.insert(
+            "insert into schema_migrations (name) values ('%s') \
+            on conflict (name) do nothing" % (name,))
+        db_tools.forget_migrations(self.sensorweb.database_connection)
+
+    def _run_outside_transaction(self, statements):
+        """runs statements such as create index concurrently on a dedicated
+        autocommit connection"""
+        conn = self.sensorweb.database_connection.connect()
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            for statement in statements:
+                cur.execute(statement)
+        finally:
+            conn.close()
+
+    def __create_typed_columns_trigger(self, cur, table, drop_from=None):
+        if drop_from:
+            cur.execute("drop trigger if exists sensor_data_typed_columns on %s"
+                        % (drop_from,))
+        cur.execute("drop trigger if exists sensor_data_typed_columns on %s"
+                    % (table,))
+        cur.execute("create trigger sensor_data_typed_columns \
+            before insert or update of info on %s for each row \
+            execute procedure sensor_data_typed_columns()" % (table,))
+
+    def __create_typed_columns_function(self, cur, partitioned=False):
+        check = ''
+        if partitioned:
+            # the row went to a partition on its null ts before this ran
+            check = "if tg_op = 'INSERT' and new.ts is not null then \
+                raise exception '%s'; \
+            end if;" % (PARTITIONED_TS_ERROR,)
+        cur.execute("create or replace function sensor_data_typed_columns() \
+            returns trigger as $$ \
+            begin \
+                if tg_op = 'UPDATE' or new.ts is null then \
+                    select %s into new.sensor_id, new.ts, new.reading, \
+                    new.units, new.value, new.flag, new.raw; \
+                    %s \
+                end if; \
+                return new; \
+            end $$ language plpgsql" % (db_tools.typed_values_sql('new.info'),
+                                        check))
+
+    def add_typed_columns(self,):
+        """adds typed sensor_id, ts, reading, units, value, flag and raw
+        columns to sensor_data with (sensor_id, ts) and (reading, ts)
+        indexes. a before insert or update trigger fills them from info
+        for writers that leave them out, such as processes that have not
+        seen the migration yet. once sensor_data is partitioned rows are
+        routed on ts before the trigger runs, so inserts that leave ts out
+        but have an info timestamp are rejected. ts stays a timestamp
+        without time zone like the info timestamps it is parsed from"""
+        partitioned = PARTITION_MIGRATION in self.applied()
+        with self.sensorweb.database_connection.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("alter table sensor_data \
+                add column if not exists sensor_id integer, \
+                add column if not exists ts timestamp, \
+                add column if not exists reading text, \
+                add column if not exists units text, \
+                add column if not exists value double precision, \
+                add column if not exists flag boolean, \
+                add column if not exists raw boolean")
+            self.__create_typed_columns_function(cur, partitioned)
+            self.__create_typed_columns_trigger(cur, 'sensor_data')
+        if not partitioned:
+            # partition_sensor_data makes these on the partitioned parent
+            self._run_outside_transaction([
+                "create index concurrently if not exists sensor_data_sensor_id_ts \
+                on sensor_data (sensor_id, ts)",
+                "create index concurrently if not exists sensor_data_reading_ts \
+                on sensor_data (reading, ts)",
+                "create index concurrently if not exists sensor_data_raw_id \
+                on sensor_data (sensor__data_id) where raw",
+            ])
+        self._record(db_tools.TYPED_COLUMNS_MIGRATION)
+
+    def backfill_typed_columns(self, chunk_size=BACKFILL_CHUNK_SIZE):
+        """fills the typed columns of existing rows in chunks of
+        sensor__data_id, resuming from its watermark. once every row is
+        filled the read paths switch to the typed columns. the columns and
+        their trigger are added first if needed, rows written after that
+        are filled by the trigger. returns the number of rows updated"""
+        # idempotent, also adds the trigger to columns added without one
+        self.add_typed_columns()
+        maintenance = self.sensorweb.maintenance
+        last_id = maintenance.watermark(BACKFILL_TASK)
+        upper_id = self.sensorweb.database_connection.query(
+            "select coalesce(max(sensor__data_id), 0) from sensor_data")[0][0]
+        updated = 0
+        while last_id < upper_id:
+            chunk_end = min(last_id + chunk_size, upper_id)
+            with self.sensorweb.database_connection.transaction() as conn:
+                cur = conn.cursor()
+                cur.execute("update sensor_data set \
+                (sensor_id, ts, reading, units, value, flag, raw) = (%s) \
+                where sensor__data_id > %s and sensor__data_id <= %s \
+                and ts is null" % (db_tools.typed_values_sql('info'),
+                                   last_id, chunk_end))
+                updated += cur.rowcount
+                maintenance._save_watermark(cur, BACKFILL_TASK, chunk_end,
+                                            cur.rowcount)
+            last_id = chunk_end
+        self._record(db_tools.TYPED_BACKFILL_MIGRATION)
+        return updated
+
+    def __create_notify_trigger(self, table, drop_from=None):
+        with self.sensorweb.database_connection.transaction() as conn:
+            cur = conn.cursor()
+            if drop_from:
+                cur.execute("drop trigger if exists sensor_data_notify on %s"
+                            % (drop_from,))
+            cur.execute("drop trigger if exists sensor_data_notify on %s" % (table,))
+            cur.execute("create trigger sensor_data_notify \
+                after insert on %s for each row \
+                execute procedure sensor_data_notify()" % (table,))
+
+    def add_insert_notify(self,):
+        """notifies NOTIFY_CHANNEL listeners of every reading inserted into
+        sensor_data, with a json payload of its sensor_id, reading, units,
+        value, timestamp and theme. used by SensorGroup.subscribe"""
+        self.sensorweb.database_connection.insert(
+            "create or replace function sensor_data_notify() returns trigger as $$ \
+            begin \
+                if not new.info ? 'special_tag' then \
+                    perform pg_notify('%s', json_build_object( \
+                        'sensor_id', new.info->'sensor_id', \
+                        'reading', new.info->'reading', \
+                        'units', new.info->'units', \
+                        'value', new.info->'value', \
+                        'timestamp', new.info->'timestamp', \
+                        'theme', new.info->'theme')::text); \
+                end if; \
+                return null; \
+            end $$ language plpgsql" % (db_tools.NOTIFY_CHANNEL,))
+        self.__create_notify_trigger('sensor_data')
+        self._record(db_tools.NOTIFY_MIGRATION)
+
+    def add_sensor_id_sequence(self,):
+        """allocates new sensor ids from a sequence starting after the
+        current maximum, instead of scanning sensors for it"""
+        with self.sensorweb.database_connection.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("lock table sensors in exclusive mode")
+            cur.execute("create sequence if not exists %s" % (db_tools.SENSOR_ID_SEQUENCE,))
+            cur.execute("select setval('%s', coalesce(max( \
+                sensor_int_id_caster(info -> 'sensor_int_id'::text)), 0) + 1, false) \
+                from sensors" % (db_tools.SENSOR_ID_SEQUENCE,))
+        self._record(db_tools.SENSOR_ID_MIGRATION)
+
+    def __partition_config(self,):
+        response = self.sensorweb.database_connection.query(
+            "select period, history_until from sensor_data_partitioning")
+        if not response:
+            raise error.SensorError('sensor_data is not partitioned')
+        return response[0]
+
+    def __own_id_sequence(self, cur):
+        # the parent's sensor__data_id default uses the sequence the old
+        # table owns, which must not go when the history is dropped
+        cur.execute("select pg_get_serial_sequence('sensor_data_history', \
+            'sensor__data_id')")
+        sequence = cur.fetchone()[0]
+        if sequence:
+            cur.execute("alter sequence %s owned by sensor_data.sensor__data_id"
+                        % (sequence,))
+
+    def partition_sensor_data(self, period='month', ahead=PARTITIONS_AHEAD):
+        """turns sensor_data into a table range partitioned on ts by day,
+        week or month. the existing table becomes the sensor_data_history
+        partition for everything before the first new period, rows without
+        a timestamp go to sensor_data_default. needs the typed columns to be
+        backfilled, queries filtering on ts then prune partitions. writers
+        must then insert ts themselves, as sensor_data_insert does, rows
+        with only an info timestamp are rejected.
+
+        the history range is checked by a constraint validated while
+        writes carry on, meanwhile inserts outside it are redirected to
+        sensor_data_default. the final switch takes an exclusive lock but
+        neither scans nor indexes the history"""
+        if period not in PARTITION_PERIODS:
+            raise error.SensorError('unknown partition period %s' % (period,))
+        applied = self.applied()
+        if PARTITION_MIGRATION in applied:
+            return
+        if db_tools.TYPED_BACKFILL_MIGRATION not in applied:
+            raise error.SensorError('backfill the typed columns before partitioning')
+        db_conn = self.sensorweb.database_connection
+        latest = db_conn.query(
+            "select max(ts) from sensor_data")[0][0] or datetime.datetime.now()
+        history_until = next_period(period_start(latest, period), period)
+        # matches the parent's index so attaching reuses it
+        self._run_outside_transaction([
+            "create index concurrently if not exists sensor_data_data_id \
+            on sensor_data (sensor__data_id)"])
+        with db_conn.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("create table if not exists sensor_data_default \
+                (like sensor_data including defaults)")
+            # fires after sensor_data_typed_columns has set ts
+            cur.execute("create or replace function sensor_data_upto_history() \
+                returns trigger as $$ \
+                begin \
+                    if new.ts is null or new.ts >= '%s' then \
+                        insert into sensor_data_default select new.*; \
+                        return null; \
+                    end if; \
+                    return new; \
+                end $$ language plpgsql" % (history_until,))
+            cur.execute("drop trigger if exists sensor_data_upto_history \
+                on sensor_data")
+            cur.execute("create trigger sensor_data_upto_history \
+                before insert on sensor_data for each row \
+                execute procedure sensor_data_upto_history()")
+            cur.execute("alter table sensor_data \
+                drop constraint if exists sensor_data_history_range")
+            cur.execute("alter table sensor_data \
+                add constraint sensor_data_history_range \
+                check (ts is not null and ts < '%s') not valid" % (history_until,))
+        with db_conn.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("with moved as (delete from sensor_data \
+                where ts is null or ts >= '%s' returning *) \
+                insert into sensor_data_default select * from moved"
+                        % (history_until,))
+            cur.execute("alter table sensor_data \
+                validate constraint sensor_data_history_range")
+        with db_conn.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("alter table sensor_data rename to sensor_data_history")
+            cur.execute("drop trigger sensor_data_upto_history \
+                on sensor_data_history")
+            cur.execute("drop function sensor_data_upto_history()")
+            cur.execute("create table sensor_data \
+                (like sensor_data_history including defaults) partition by range (ts)")
+            self.__own_id_sequence(cur)
+            cur.execute("alter table sensor_data attach partition sensor_data_default \
+                default")
+            cur.execute("alter table sensor_data attach partition sensor_data_history \
+                for values from (minvalue) to ('%s')" % (history_until,))
+            for index in ("(sensor_id, ts)", "(reading, ts)", "(sensor__data_id)"):
+                cur.execute("create index on sensor_data %s" % (index,))
+            cur.execute("create index on sensor_data (sensor__data_id) where raw")
+            self.__create_typed_columns_function(cur, partitioned=True)
+            self.__create_typed_columns_trigger(cur, 'sensor_data',
+                                                'sensor_data_history')
+            cur.execute("create table sensor_data_partitioning ( \
+                period text not null, history_until timestamp not null)")
+            cur.execute("insert into sensor_data_partitioning values ('%s', '%s')"
+                        % (period, history_until))
+        self._record(PARTITION_MIGRATION)
+        if db_tools.NOTIFY_MIGRATION in applied:
+            # the trigger stayed on the old table, now the history partition
+            self.__create_notify_trigger('sensor_data', 'sensor_data_history')
+        self.create_future_partitions(ahead)
+
+    def create_future_partitions(self, ahead=PARTITIONS_AHEAD):
+        """makes sure partitions exist from the end of the history up to
+        ahead periods past the current one. run regularly, readings beyond
+        the last partition land in sensor_data_default and are moved into
+        their partition when it is created"""
+        period, history_until = self.__partition_config()
+        start = history_until
+        last = datetime.datetime.now()
+        for i in range(ahead + 1):
+            last = next_period(period_start(last, period), period)
+        existing = set(row[0] for row in self.sensorweb.database_connection.query(
+            "select child.relname from pg_inherits \
+            join pg_class child on child.oid = pg_inherits.inhrelid \
+            join pg_class parent on parent.oid = pg_inherits.inhparent \
+            where parent.relname = 'sensor_data'"))
+        created = []
+        while start < last:
+            end = next_period(start, period)
+            name = partition_name(start)
+            if name not in existing:
+                # the default partition may already hold rows of the period,
+                # which partition of would refuse
+                with self.sensorweb.database_connection.transaction() as conn:
+                    cur = conn.cursor()
+                    cur.execute("create table %s (like sensor_data including defaults)"
+                                % (name,))
+                    cur.execute("alter table %s add constraint %s_range \
+                        check (ts is not null and ts >= '%s' and ts < '%s')"
+                                % (name, name, start, end))
+                    cur.execute("with moved as (delete from sensor_data_default \
+                        where ts >= '%s' and ts < '%s' returning *) \
+                        insert into %s select * from moved" % (start, end, name))
+                    cur.execute("alter table sensor_data attach partition %s \
+                        for values from ('%s') to ('%s')" % (name, start, end))
+                created.append(name)
+            start = end
+        return created
+
+    def apply_retention(self, cutoff, archive_schema=None):
+        """removes whole partitions holding only readings before cutoff,
+        instead of deleting rows. partitions are dropped, or detached and
+        moved to archive_schema when given. returns the partitions removed"""
+        period, history_until = self.__partition_config()
+        partitions = []
+        if history_until <= cutoff:
+            partitions.append('sensor_data_history')
+        for row in self.sensorweb.database_connection.query(
+                "select child.relname from pg_inherits \
+                join pg_class child on child.oid = pg_inherits.inhrelid \
+                join pg_class parent on parent.oid = pg_inherits.inhparent \
+                where parent.relname = 'sensor_data' \
+                and child.relname like 'sensor\\_data\\_p%' order by child.relname"):
+            start = datetime.datetime.strptime(row[0][len('sensor_data_p'):], '%Y%m%d')
+            if next_period(start, period) <= cutoff:
+                partitions.append(row[0])
+        for partition in partitions:
+            with self.sensorweb.database_connection.transaction() as conn:
+                cur = conn.cursor()
+                if partition == 'sensor_data_history':
+                    # tables partitioned before the sequence moved to the parent
+                    self.__own_id_sequence(cur)
+                cur.execute("alter table sensor_data detach partition %s" % (partition,))
+                if archive_schema:
+                    cur.execute("create schema if not exists %s" % (archive_schema,))
+                    cur.execute("alter table %s set schema %s" % (partition, archive_schema))
+                else:
+                    cur.execute("drop table %s" % (partition,))
+        return partitions
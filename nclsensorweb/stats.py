@@ -0,0 +1,168 @@
+"""Streaming and mergeable summary statistics"""
+import nclsensorweb.errors as error
+import math
+import numpy
+
+SKETCH_ACCURACY = 0.01
+
+SKETCH_MAX_BUCKETS = 2048
+
+SKETCH_MIN_VALUE = 1e-9
+
+class RunningStats:
+    """count, min, max, mean and variance in one pass with Welford's
+    algorithm, merged across shards with Chan's parallel update"""
+    def __init__(self,):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def from_values(cls, values):
+        """RunningStats of an array of values, computed with numpy"""
+        stats = cls()
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(values):
+            stats.count = len(values)
+            stats.mean = float(values.mean())
+            stats.m2 = float(((values - stats.mean) ** 2).sum())
+            stats.min = float(values.min())
+            stats.max = float(values.max())
+        return stats
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add_many(self, values):
+        self.merge(RunningStats.from_values(values))
+
+    def merge(self, other):
+        """adds the values summarised by other"""
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self,):
+        """population variance, None without values"""
+        if self.count:
+            return self.m2 / self.count
+
+    @property
+    def std(self,):
+        if self.count:
+            return math.sqrt(self.variance)
+
+    def json(self,):
+        return {'count':self.count, 'min':self.min, 'max':self.max,
+                'mean':self.mean if self.count else None,
+                'variance':self.variance, 'std':self.std}
+
+class QuantileSketch:
+    """mergeable quantile sketch after DDSketch. values fall in logarithmic
+    buckets so quantiles are within relative_accuracy of a true value.
+    beyond max_buckets per sign the buckets nearest zero are collapsed"""
+    def __init__(self, relative_accuracy=SKETCH_ACCURACY,
+                 max_buckets=SKETCH_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.__log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zero = 0
+        self.positive = {}
+        self.negative = {}
+
+    def __keys(self, magnitudes):
+        return numpy.ceil(numpy.log(magnitudes) / self.__log_gamma).astype(numpy.int64)
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        if abs(value) <= SKETCH_MIN_VALUE:
+            self.zero += 1
+            return
+        store = self.positive if value > 0 else self.negative
+        key = int(math.ceil(math.log(abs(value)) / self.__log_gamma))
+        store[key] = store.get(key, 0) + 1
+        self.__collapse(store)
+
+    def add_many(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        self.count += len(values)
+        self.zero += int((numpy.abs(values) <= SKETCH_MIN_VALUE).sum())
+        for store, selected in ((self.positive, values[values > SKETCH_MIN_VALUE]),
+                                (self.negative, -values[values < -SKETCH_MIN_VALUE])):
+            if len(selected):
+                keys, counts = numpy.unique(self.__keys(selected),
+                                            return_counts=True)
+                for key, count in zip(keys.tolist(), counts.tolist()):
+                    store[key] = store.get(key, 0) + count
+                self.__collapse(store)
+
+    def __collapse(self, store):
+        if len(store) <= self.max_buckets:
+            return
+        keys = sorted(store.keys())
+        excess = len(keys) - self.max_buckets
+        collapsed = sum(store.pop(key) for key in keys[:excess])
+        store[keys[excess]] += collapsed
+
+    def merge(self, other):
+        """adds the values summarised by other, which must have the same
+        relative accuracy"""
+        if other.gamma != self.gamma:
+            raise error.SensorError('sketches of different accuracy')
+        self.count += other.count
+        self.zero += other.zero
+        for store, other_store in ((self.positive, other.positive),
+                                   (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+            self.__collapse(store)
+        return self
+
+    def __value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """approximate q quantile, 0 <= q <= 1, None without values"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative.keys(), reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.__value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive.keys()):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.__value(key)
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
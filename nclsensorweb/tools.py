@@ -1,14 +1,27 @@
 """Misc tools"""
 import csv
 import datetime
+import gzip
+
+def open_output(fname, compress=None):
+    """opens a file for writing, gzipped when compress is set or, when
+    it is None, when fname ends in .gz"""
+    if compress is None:
+        compress = fname.endswith('.gz')
+    if compress:
+        return gzip.open(fname, 'wb')
+    return open(fname, 'wb')
 
 def write_csv_file(fname, data, *args, **kwargs):
-    """writes data to a csv file"""
-    outfile = open(fname, 'wb')
-    mycsv = csv.writer(outfile, *args, **kwargs)
-    for row in data:
-        mycsv.writerow(row)
-    outfile.close()
+    """writes the rows of an iterable to a csv file one at a time,
+    gzipped when fname ends in .gz"""
+    outfile = open_output(fname)
+    try:
+        mycsv = csv.writer(outfile, *args, **kwargs)
+        for row in data:
+            mycsv.writerow(row)
+    finally:
+        outfile.close()
     
 def timestamp_to_timedelta(timestamp):
     """converts timestamp to timedelta"""
@@ -17,12 +30,23 @@ def timestamp_to_timedelta(timestamp):
     timedelta = ((timedelta.microseconds + total_seconds * 10**6) / 10**6)*1000
     return timedelta
 
+def datetime_to_epoch_ms(timestamp):
+    """converts naive datetime to epoch milliseconds"""
+    timedelta = (timestamp-datetime.datetime(1970, 1, 1))
+    return (timedelta.days * 24 * 3600 + timedelta.seconds) * 1000 \
+                + timedelta.microseconds // 1000
+
+def epoch_ms_to_datetime(epoch_ms):
+    """converts epoch milliseconds to naive datetime"""
+    return datetime.datetime(1970, 1, 1) + \
+                datetime.timedelta(milliseconds=epoch_ms)
+
 def levenshtein(seq1, seq2):
     oneago = None
-    thisrow = range(1, len(seq2) + 1) + [0]
-    for x in xrange(len(seq1)):
+    thisrow = list(range(1, len(seq2) + 1)) + [0]
+    for x in range(len(seq1)):
         twoago, oneago, thisrow = oneago, thisrow, [0] * len(seq2) + [x + 1]
-        for y in xrange(len(seq2)):
+        for y in range(len(seq2)):
             delcost = oneago[y] + 1
             addcost = thisrow[y - 1] + 1
             subcost = oneago[y - 1] + (seq1[x] != seq2[y])
@@ -0,0 +1 @@
+"""run from the repository root with python -m unittest discover -s tests -t ."""
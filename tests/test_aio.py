@@ -0,0 +1,156 @@
+"""asyncio client against a scratch PostgreSQL database with hstore, named
+by NCLSENSORWEB_TEST_DB with NCLSENSORWEB_TEST_HOST, NCLSENSORWEB_TEST_USER
+and NCLSENSORWEB_TEST_PASSWORD. the tables it uses are dropped and created
+again, so never point it at a real sensor web. skipped without a database"""
+import datetime
+import os
+import sys
+import unittest
+
+TEST_DB = os.environ.get('NCLSENSORWEB_TEST_DB')
+
+TEST_HOST = os.environ.get('NCLSENSORWEB_TEST_HOST', 'localhost')
+
+TEST_USER = os.environ.get('NCLSENSORWEB_TEST_USER', 'postgres')
+
+TEST_PASSWORD = os.environ.get('NCLSENSORWEB_TEST_PASSWORD', '')
+
+PROJ = 27700
+
+SCHEMA = [
+    "create extension if not exists hstore",
+    "drop table if exists sensor_data, readings, new_reading, schema_migrations",
+    "create table readings (reading_name text primary key, default_units text, \
+     unit_conversion hstore)",
+    "create table new_reading (reading_name text, units text, new_reading boolean)",
+    "create table schema_migrations (name text primary key, \
+     applied timestamp not null default now())",
+    "create table sensor_data (sensor__data_id bigserial primary key, info hstore)",
+    "create or replace function proper_timestamp(text) returns timestamp as \
+     $$ select $1::timestamp $$ language sql immutable",
+    "create or replace function sensor_int_id_caster(text) returns integer as \
+     $$ select $1::integer $$ language sql immutable",
+    "create or replace function date_round(timestamp, interval) \
+     returns timestamp as $$ select 'epoch'::timestamp + \
+     round(extract(epoch from $1) / extract(epoch from $2)) * $2 \
+     $$ language sql immutable",
+    "insert into readings values ('temp', 'C', 'F=>0.5')",
+]
+
+TYPED_SCHEMA = [
+    "alter table sensor_data add column sensor_id integer, \
+     add column ts timestamp, add column reading text, add column units text, \
+     add column value double precision, add column flag boolean, \
+     add column raw boolean",
+    "insert into schema_migrations (name) values \
+     ('typed_sensor_data_columns'), ('typed_sensor_data_backfill')",
+]
+
+def skip_reason():
+    if sys.version_info < (3, 5):
+        return 'the asyncio client needs python 3'
+    if not TEST_DB:
+        return 'NCLSENSORWEB_TEST_DB names no test database'
+    try:
+        import aiopg
+        import nclsensorweb.aio
+    # pygeocoder does not import on python 3.10 and later
+    except (ImportError, AttributeError) as e:
+        return 'cannot import the asyncio client: %s' % (e,)
+
+SKIP_REASON = skip_reason()
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class AsyncSensorWebTest(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        import psycopg2
+        import nclsensorweb.aio as aio
+        import nclsensorweb.classes as cl
+        import nclsensorweb.db_tools as db_tools
+        self.aio = aio
+        self.cl = cl
+        self.db_tools = db_tools
+        try:
+            self.conn = psycopg2.connect(host=TEST_HOST, dbname=TEST_DB,
+                                         user=TEST_USER, password=TEST_PASSWORD)
+        except psycopg2.OperationalError as e:
+            self.skipTest('no test database: %s' % (e,))
+        self.conn.autocommit = True
+        self.execute(SCHEMA)
+        self.loop = asyncio.new_event_loop()
+        self.web = self.run_async(aio.AsyncSensorWeb.create(
+            TEST_HOST, TEST_DB, TEST_USER, TEST_PASSWORD))
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.group = aio.AsyncSensorGroup(self.web, [self.sensor('1'),
+                                                     self.sensor('2')])
+
+    def tearDown(self):
+        self.cl.TRANSFORMED_GEOMS.clear()
+        self.run_async(self.web.close())
+        self.loop.close()
+        self.conn.close()
+
+    def execute(self, statements):
+        cur = self.conn.cursor()
+        for statement in statements:
+            cur.execute(statement)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def sensor(self, sensor_id):
+        sensor = self.cl.Sensor(self.web.database_connection, 's%s' % (sensor_id,),
+                                sensor_id, 'geom%s' % (sensor_id,), True, 'test',
+                                'air', {})
+        # stands in for postgis, which the test database need not have
+        self.cl.TRANSFORMED_GEOMS.set((sensor_id, sensor._raw_geom, str(PROJ)),
+                                      {'type':'Point',
+                                       'coordinates':[int(sensor_id) * 10, 0]})
+        return sensor
+
+    def add_readings(self):
+        minute = datetime.timedelta(minutes=1)
+        return self.run_async(self.group.add_many([
+            (1, self.now - 3 * minute, 'temp', 'C', 3, 'weather'),
+            (1, self.now - 2 * minute, 'temp', 'C', 4, 'weather'),
+            {'sensor_id':2, 'timestamp':self.now - minute, 'reading':'temp',
+             'units':'F', 'value':20, 'theme':'weather'},
+            (2, self.now - minute, 'rain', 'mm', 1, 'weather'),
+        ]))
+
+    def check_readings(self):
+        cutoff = self.now - datetime.timedelta(hours=1)
+        latest = self.run_async(self.group.data.latest('temp', cutoff, PROJ))
+        self.assertEqual(sorted(latest.csv(PROJ)), [[10, 0, 4.0], [20, 0, 10.0]])
+        table = self.run_async(self.group.data.get(cutoff, self.now, 'temp'))
+        values = dict((sensor_data.sensor.sensor_id,
+                       list(sensor_data.table('temp').values))
+                      for sensor_data in table.sensor_data)
+        self.assertEqual(values, {'1':[3.0, 4.0], '2':[10.0]})
+        averages = self.run_async(self.group.data.average.aggregates(
+            cutoff, self.now, datetime.timedelta(hours=1)))
+        self.assertEqual(sum(averages['temp']['count']), 3)
+        self.assertEqual(max(averages['temp']['max']), 10.0)
+
+    def test_add_many_and_read_back(self):
+        self.assertEqual(self.add_readings(), 4)
+        self.check_readings()
+        cur = self.conn.cursor()
+        cur.execute("select reading_name, units, new_reading from new_reading")
+        self.assertEqual(cur.fetchall(), [('rain', 'mm', True)])
+
+    def test_typed_columns_with_expired_migrations(self):
+        self.execute(TYPED_SCHEMA)
+        # blocking migration lookups would get a coroutine from this connection
+        self.addCleanup(setattr, self.db_tools, 'MIGRATIONS_TTL',
+                        self.db_tools.MIGRATIONS_TTL)
+        self.db_tools.MIGRATIONS_TTL = 0
+        self.add_readings()
+        cur = self.conn.cursor()
+        cur.execute("select count(*) from sensor_data where ts is not null")
+        self.assertEqual(cur.fetchone()[0], 4)
+        self.check_readings()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""SpatialIndex queries against brute force over the same sensors"""
+import random
+import unittest
+
+import simplejson
+
+import nclsensorweb.classes as cl
+import nclsensorweb.geometry as geometry
+
+def sensors(count, seed):
+    rng = random.Random(seed)
+    found = []
+    for i in range(count):
+        # clustered points, some sharing a position, around a negative origin
+        x = rng.choice([-500.0, 0.0, 250.0]) + round(rng.gauss(0, 40), 1)
+        y = rng.choice([-100.0, 300.0]) + round(rng.gauss(0, 40), 1)
+        if i % 2:
+            sensor = cl.Sensor(None, 's%s' % (i,), str(i), geometry.point_ewkb(x, y),
+                               True, 'test', 'air', {})
+        else:
+            geojson = simplejson.dumps({'type':'Point', 'coordinates':[x, y]})
+            sensor = cl.Sensor(None, 's%s' % (i,), str(i), None, True, 'test',
+                               'air', {}, geojson)
+        found.append((sensor, x, y))
+    return found
+
+class SpatialIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.points = sensors(400, 1)
+        self.indexes = [cl.SpatialIndex([sensor for sensor, x, y in self.points],
+                                        cell_size)
+                        for cell_size in [None, 1.0, 30.0, 10000.0]]
+
+    def ids(self, sensor_list):
+        return [sensor.sensor_id for sensor in sensor_list]
+
+    def test_within_bbox(self):
+        for xmin, ymin, xmax, ymax in [(-600, -200, 300, 400), (-520, -120, -480, -80),
+                                       (0, 300, 0, 300), (1000, 1000, 2000, 2000)]:
+            expected = [sensor.sensor_id for sensor, x, y in self.points
+                        if xmin <= x <= xmax and ymin <= y <= ymax]
+            for index in self.indexes:
+                self.assertEqual(self.ids(index.within_bbox(xmin, ymin, xmax, ymax)),
+                                 expected)
+
+    def test_within_radius(self):
+        for x0, y0, radius in [(0, 300, 50), (-500, -100, 0.5), (250, -100, 1000),
+                               (5000, 5000, 10)]:
+            expected = [sensor.sensor_id for sensor, x, y in self.points
+                        if ((x - x0) ** 2 + (y - y0) ** 2) ** 0.5 <= radius]
+            for index in self.indexes:
+                self.assertEqual(self.ids(index.within_radius(x0, y0, radius)),
+                                 expected)
+
+    def test_nearest(self):
+        for x0, y0 in [(0, 300), (-1000, 0), (260.5, -95.5)]:
+            distances = sorted(((x - x0) ** 2 + (y - y0) ** 2) ** 0.5
+                               for sensor, x, y in self.points)
+            for k in [1, 5, 400, 500]:
+                for index in self.indexes:
+                    nearest = index.nearest(x0, y0, k)
+                    self.assertEqual(len(nearest), min(k, len(self.points)))
+                    for (sensor, distance), expected in zip(nearest, distances):
+                        self.assertAlmostEqual(distance, expected)
+                        x, y = cl.geom_point(sensor.geom)
+                        self.assertAlmostEqual(distance,
+                                               ((x - x0) ** 2 + (y - y0) ** 2) ** 0.5)
+
+    def test_empty(self):
+        index = cl.SpatialIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.within_bbox(0, 0, 1, 1), [])
+        self.assertEqual(index.within_radius(0, 0, 1), [])
+        self.assertEqual(index.nearest(0, 0, 3), [])
+
+if __name__ == '__main__':
+    unittest.main()
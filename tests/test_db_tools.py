@@ -0,0 +1,45 @@
+"""BKTree searches against a linear levenshtein scan"""
+import random
+import unittest
+
+from nclsensorweb.db_tools import BKTree
+from nclsensorweb.tools import levenshtein
+
+def words(count, seed):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('abcd') for i in range(rng.randint(0, 6)))
+            for j in range(count)]
+
+def linear_search(word_list, word, max_distance):
+    orders = {}
+    for order, existing in enumerate(word_list):
+        orders[existing] = order
+    return sorted((levenshtein(word, existing), order, existing)
+                  for existing, order in orders.items()
+                  if levenshtein(word, existing) <= max_distance)
+
+class BKTreeTest(unittest.TestCase):
+    def test_levenshtein(self):
+        self.assertEqual(levenshtein('kitten', 'sitting'), 3)
+        self.assertEqual(levenshtein('', 'abc'), 3)
+        self.assertEqual(levenshtein('Air', 'Air'), 0)
+
+    def test_search_matches_linear_scan(self):
+        # a small alphabet gives many duplicates and ties at every distance
+        word_list = words(300, 1)
+        tree = BKTree(word_list)
+        for word in words(40, 2) + ['', 'abcdabcd']:
+            for max_distance in range(5):
+                self.assertEqual(sorted(tree.search(word, max_distance)),
+                                 linear_search(word_list, word, max_distance))
+
+    def test_added_words_keep_last_order(self):
+        tree = BKTree()
+        self.assertEqual(tree.search('Air', 3), [])
+        for order, word in enumerate(['Air', 'Traffic', 'Air', 'Water']):
+            tree.add(word, order)
+        self.assertEqual(sorted(tree.search('Air', 0)), [(0, 2, 'Air')])
+        self.assertEqual(sorted(tree.search('Wter', 1)), [(1, 3, 'Water')])
+
+if __name__ == '__main__':
+    unittest.main()
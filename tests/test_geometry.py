@@ -0,0 +1,140 @@
+"""EWKB and WKT encoding against known PostGIS output and round trips"""
+import binascii
+import struct
+import unittest
+
+import nclsensorweb.errors as error
+import nclsensorweb.geometry as geometry
+
+GEOMS = [
+    {'type':'Point', 'coordinates':[1.5, -2.25]},
+    {'type':'LineString', 'coordinates':[[0.0, 0.0], [1.0, 2.0], [3.5, 4.0]]},
+    {'type':'Polygon', 'coordinates':[[[0.0, 0.0], [4.0, 0.0], [4.0, 4.0],
+                                       [0.0, 0.0]],
+                                      [[1.0, 1.0], [2.0, 1.0], [2.0, 2.0],
+                                       [1.0, 1.0]]]},
+    {'type':'MultiPoint', 'coordinates':[[1.0, 2.0], [3.0, 4.0]]},
+    {'type':'MultiLineString', 'coordinates':[[[0.0, 0.0], [1.0, 1.0]],
+                                              [[2.0, 2.0], [3.0, 1.0]]]},
+    {'type':'MultiPolygon', 'coordinates':[[[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0],
+                                             [0.0, 0.0]]],
+                                           [[[5.0, 5.0], [6.0, 5.0], [6.0, 6.0],
+                                             [5.0, 5.0]]]]},
+]
+
+# select ST_AsEWKB(ST_SetSRID(ST_MakePoint(1, 2), 4326))
+POINT_EWKB = '0101000020E6100000000000000000F03F0000000000000040'
+
+def wkb(fmt, *values):
+    return binascii.hexlify(struct.pack(fmt, *values)).decode('ascii')
+
+class EWKBTest(unittest.TestCase):
+    def test_known_point(self):
+        self.assertEqual(geometry.point_ewkb(1, 2), POINT_EWKB)
+        self.assertEqual(geometry.from_ewkb(POINT_EWKB),
+                         ({'type':'Point', 'coordinates':[1.0, 2.0]}, 4326))
+        self.assertEqual(geometry.point_ewkb(1, 2, None),
+                         '0101000000000000000000F03F0000000000000040')
+
+    def test_round_trips(self):
+        for geom in GEOMS:
+            for srid in [geometry.DEFAULT_SRID, 27700, None]:
+                ewkb = geometry.to_ewkb(geom, srid)
+                self.assertEqual(ewkb, ewkb.upper())
+                self.assertEqual(geometry.from_ewkb(ewkb), (geom, srid))
+                self.assertEqual(geometry.from_ewkb(ewkb.lower()), (geom, srid))
+
+    def test_helpers(self):
+        self.assertEqual(geometry.linestring_ewkb(GEOMS[1]['coordinates'], 27700),
+                         geometry.to_ewkb(GEOMS[1], 27700))
+        self.assertEqual(geometry.polygon_ewkb(GEOMS[2]['coordinates']),
+                         geometry.to_ewkb(GEOMS[2]))
+        xs, ys = [1, -2.5, 1e6], [2, 0, -3]
+        self.assertEqual(geometry.points_ewkb(xs, ys, 27700),
+                         [geometry.point_ewkb(x, y, 27700) for x, y in zip(xs, ys)])
+        self.assertEqual(geometry.points_ewkb(xs, ys, None),
+                         [geometry.point_ewkb(x, y, None) for x, y in zip(xs, ys)])
+        self.assertEqual(geometry.points_ewkb([], []), [])
+
+    def test_extra_dimensions_dropped_on_write(self):
+        self.assertEqual(geometry.to_ewkb({'type':'LineString',
+                                           'coordinates':[[0, 0, 9], [1, 2, 9]]}),
+                         geometry.to_ewkb({'type':'LineString',
+                                           'coordinates':[[0, 0], [1, 2]]}))
+
+    def test_iso_dimensions(self):
+        for code, coordinates in [(1001, [1.0, 2.0, 3.0]), (2001, [1.0, 2.0, 4.0]),
+                                  (3001, [1.0, 2.0, 3.0, 4.0])]:
+            data = wkb('<BI' + 'd' * len(coordinates), 1, code, *coordinates)
+            self.assertEqual(geometry.from_ewkb(data),
+                             ({'type':'Point', 'coordinates':coordinates}, None))
+        data = wkb('<BII6d', 1, 1002, 2, 0, 0, 1, 1, 2, 2)
+        self.assertEqual(geometry.from_ewkb(data),
+                         ({'type':'LineString',
+                           'coordinates':[[0.0, 0.0, 1.0], [1.0, 2.0, 2.0]]}, None))
+        data = wkb('<BII', 1, 3004, 1) + wkb('<BI4d', 1, 3001, 1, 2, 3, 4)
+        self.assertEqual(geometry.from_ewkb(data),
+                         ({'type':'MultiPoint', 'coordinates':[[1.0, 2.0, 3.0, 4.0]]},
+                          None))
+
+    def test_ewkb_dimension_flags(self):
+        code = 1 | geometry.EWKB_Z | geometry.EWKB_M | geometry.EWKB_SRID
+        data = wkb('<BII4d', 1, code, 27700, 1, 2, 3, 4)
+        self.assertEqual(geometry.from_ewkb(data),
+                         ({'type':'Point', 'coordinates':[1.0, 2.0, 3.0, 4.0]}, 27700))
+        data = wkb('>BII3d', 0, 1 | geometry.EWKB_Z | geometry.EWKB_SRID, 4326,
+                   1, 2, 3)
+        self.assertEqual(geometry.from_ewkb(data),
+                         ({'type':'Point', 'coordinates':[1.0, 2.0, 3.0]}, 4326))
+
+    def test_errors(self):
+        self.assertRaises(error.SensorError, geometry.to_ewkb,
+                          {'type':'GeometryCollection', 'geometries':[]})
+        self.assertRaises(error.SensorError, geometry.from_ewkb, 'not hex')
+        self.assertRaises(error.SensorError, geometry.from_ewkb, POINT_EWKB[:-4])
+        self.assertRaises(error.SensorError, geometry.from_ewkb,
+                          wkb('<BI', 1, 7))
+
+class WKTTest(unittest.TestCase):
+    def test_known_wkt(self):
+        self.assertEqual(geometry.to_wkt(GEOMS[0]), 'POINT(1.5 -2.25)')
+        self.assertEqual(geometry.to_wkt(GEOMS[3], 4326),
+                         'SRID=4326;MULTIPOINT(1.0 2.0,3.0 4.0)')
+        self.assertEqual(geometry.ewkb_to_wkt(POINT_EWKB), 'SRID=4326;POINT(1.0 2.0)')
+
+    def test_round_trips(self):
+        for geom in GEOMS:
+            for srid in [4326, None]:
+                self.assertEqual(geometry.from_wkt(geometry.to_wkt(geom, srid)),
+                                 (geom, srid))
+                ewkb = geometry.to_ewkb(geom, srid)
+                self.assertEqual(geometry.wkt_to_ewkb(geometry.ewkb_to_wkt(ewkb),
+                                                      srid),
+                                 ewkb)
+
+    def test_srid(self):
+        self.assertEqual(geometry.wkt_to_ewkb('POINT(1 2)'), POINT_EWKB)
+        self.assertEqual(geometry.wkt_to_ewkb('SRID=27700;POINT(1 2)'),
+                         geometry.point_ewkb(1, 2, 27700))
+        self.assertEqual(geometry.wkt_to_ewkb('srid=27700;POINT(1 2)', 4326),
+                         geometry.point_ewkb(1, 2, 27700))
+        self.assertEqual(geometry.wkt_to_ewkb('POINT(1 2)', None),
+                         geometry.point_ewkb(1, 2, None))
+
+    def test_forms(self):
+        self.assertEqual(geometry.from_wkt(' multipoint ((1 2), (3 4)) '),
+                         (GEOMS[3], None))
+        self.assertEqual(geometry.from_wkt('POINT Z (1 2 3)'),
+                         ({'type':'Point', 'coordinates':[1.0, 2.0, 3.0]}, None))
+        self.assertEqual(geometry.from_wkt('LINESTRING ZM (0 0 1 2, 1 1 3 4)'),
+                         ({'type':'LineString',
+                           'coordinates':[[0.0, 0.0, 1.0, 2.0],
+                                          [1.0, 1.0, 3.0, 4.0]]}, None))
+
+    def test_errors(self):
+        for wkt in ['', 'CIRCLE(1 2)', 'POINT(1 2', 'LINESTRING(0 0, 1 x)',
+                    'POLYGON((0 0, 1 1]']:
+            self.assertRaises(error.SensorError, geometry.from_wkt, wkt)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""streaming statistics against numpy over the same values"""
+import random
+import unittest
+
+import numpy
+
+import nclsensorweb.errors as error
+from nclsensorweb.stats import RunningStats, QuantileSketch
+
+QUANTILES = [0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0]
+
+def sample(count, seed):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(0, 2) * rng.choice([-1, 1, 1]) for i in range(count)]
+
+def true_quantile(values, q):
+    # the sketch returns the value at rank floor(q * (count - 1))
+    return sorted(values)[int(q * (len(values) - 1))]
+
+class RunningStatsTest(unittest.TestCase):
+    def assertStatsEqual(self, stats, values):
+        self.assertEqual(stats.count, len(values))
+        self.assertEqual(stats.min, min(values))
+        self.assertEqual(stats.max, max(values))
+        self.assertAlmostEqual(stats.mean, numpy.mean(values), places=9)
+        self.assertAlmostEqual(stats.variance / numpy.var(values), 1.0, places=9)
+
+    def test_single_pass(self):
+        values = sample(1000, 1)
+        stats = RunningStats()
+        for value in values:
+            stats.add(value)
+        self.assertStatsEqual(stats, values)
+        self.assertStatsEqual(RunningStats.from_values(values), values)
+
+    def test_merge_matches_single_pass(self):
+        values = sample(1000, 2)
+        merged = RunningStats()
+        for start, end in [(0, 1), (1, 10), (10, 400), (400, 401), (401, 1000)]:
+            shard = RunningStats()
+            for value in values[start:end]:
+                shard.add(value)
+            merged.merge(shard)
+        self.assertStatsEqual(merged, values)
+        stats = RunningStats()
+        stats.add_many(values[:500])
+        stats.add_many(values[500:])
+        self.assertStatsEqual(stats, values)
+
+    def test_merge_empty(self):
+        stats = RunningStats.from_values([1.0, 2.0, 4.0])
+        stats.merge(RunningStats())
+        self.assertStatsEqual(stats, [1.0, 2.0, 4.0])
+        empty = RunningStats().merge(stats)
+        self.assertStatsEqual(empty, [1.0, 2.0, 4.0])
+        self.assertEqual(RunningStats().json(),
+                         {'count':0, 'min':None, 'max':None, 'mean':None,
+                          'variance':None, 'std':None})
+
+class QuantileSketchTest(unittest.TestCase):
+    def assertWithinAccuracy(self, sketch, values, quantiles=QUANTILES):
+        for q in quantiles:
+            expected = true_quantile(values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - expected),
+                                 sketch.relative_accuracy * abs(expected) + 1e-12,
+                                 'quantile %s' % (q,))
+
+    def test_quantiles_within_accuracy(self):
+        values = sample(5000, 3) + [0.0] * 50
+        for accuracy in [0.01, 0.05]:
+            sketch = QuantileSketch(accuracy)
+            for value in values:
+                sketch.add(value)
+            self.assertEqual(sketch.count, len(values))
+            self.assertWithinAccuracy(sketch, values)
+            sketch = QuantileSketch(accuracy)
+            sketch.add_many(values)
+            self.assertEqual(sketch.count, len(values))
+            self.assertWithinAccuracy(sketch, values)
+
+    def test_empty(self):
+        self.assertEqual(QuantileSketch().quantile(0.5), None)
+
+    def test_merge_matches_single_sketch(self):
+        values = sample(4000, 4)
+        single = QuantileSketch()
+        single.add_many(values)
+        merged = QuantileSketch()
+        for start in range(0, len(values), 700):
+            shard = QuantileSketch()
+            shard.add_many(values[start:start + 700])
+            merged.merge(shard)
+        self.assertEqual(merged.count, single.count)
+        self.assertEqual(merged.quantiles(QUANTILES), single.quantiles(QUANTILES))
+        self.assertWithinAccuracy(merged, values)
+
+    def test_merge_different_accuracy(self):
+        self.assertRaises(error.SensorError, QuantileSketch(0.01).merge,
+                          QuantileSketch(0.02))
+
+    def test_collapse_keeps_upper_quantiles(self):
+        # values over twelve orders of magnitude need far more than 20 buckets
+        values = [10 ** (i / 100.0) for i in range(-600, 600)]
+        sketch = QuantileSketch(0.01, max_buckets=20)
+        sketch.add_many(values)
+        self.assertEqual(len(sketch.positive), 20)
+        self.assertEqual(sketch.count, len(values))
+        self.assertWithinAccuracy(sketch, values, [0.99, 0.995, 1.0])
+        # the collapsed low values are reported as the lowest kept bucket
+        self.assertGreater(sketch.quantile(0.0), values[0])
+        merged = QuantileSketch(0.01, max_buckets=20)
+        for value in values:
+            merged.merge(QuantileSketch(0.01, max_buckets=20))
+            merged.add(value)
+        self.assertEqual(len(merged.positive), 20)
+        self.assertEqual(sum(merged.positive.values()), len(values))
+        self.assertWithinAccuracy(merged, values, [0.99, 0.995, 1.0])
+
+if __name__ == '__main__':
+    unittest.main()